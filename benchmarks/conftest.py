@@ -0,0 +1,86 @@
+"""
+Shared fixtures of the benchmark suite.
+
+Results are printed at the end of the session, and written as JSON with
+`--benchmark-json`. With `--benchmark-compare`, a benchmark fails when it is more than
+`--benchmark-max-slowdown` times slower than in a previous JSON report.
+"""
+
+import json
+from pathlib import Path
+
+import pytest
+from imagegen import build_scenario
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("docker-unpack benchmarks")
+    group.addoption("--benchmark-scale", type=float, default=1, help="multiplier for the size of the generated images")
+    group.addoption("--benchmark-json", help="write the results to this file")
+    group.addoption("--benchmark-compare", help="compare the results to this JSON report")
+    group.addoption(
+        "--benchmark-max-slowdown",
+        type=float,
+        default=1.5,
+        help="fail benchmarks slower than this factor of the compared report",
+    )
+
+
+_RESULTS: dict[str, dict] = {}
+
+
+@pytest.fixture(scope="session")
+def image(request, tmp_path_factory):
+    """
+    Returns the path of a generated image archive, building each one once.
+    """
+    scale = request.config.getoption("--benchmark-scale")
+    images = {}
+
+    def get(scenario: str, compression: str = "tar", layer_compression: str | None = None) -> Path:
+        key = (scenario, compression, layer_compression)
+        if key not in images:
+            path = tmp_path_factory.mktemp("images") / f"{scenario}.{compression}"
+            build_scenario(scenario, str(path), compression, scale, layer_compression)
+            images[key] = path
+        return images[key]
+
+    return get
+
+
+@pytest.fixture(scope="session")
+def baseline(request):
+    path = request.config.getoption("--benchmark-compare")
+    if path is None:
+        return {}
+    return json.loads(Path(path).read_text())
+
+
+@pytest.fixture
+def record(request, baseline):
+    """
+    Records the metrics of the current benchmark. `seconds` is compared to the baseline.
+    """
+    max_slowdown = request.config.getoption("--benchmark-max-slowdown")
+
+    def record(seconds: float, **metrics):
+        name = request.node.name
+        _RESULTS[name] = {"seconds": round(seconds, 4), **metrics}
+        previous = baseline.get(name)
+        if previous and seconds > previous["seconds"] * max_slowdown:
+            pytest.fail(f"{name} took {seconds:.2f}s, {seconds / previous['seconds']:.2f}x the baseline")
+
+    return record
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not _RESULTS:
+        return
+    terminalreporter.section("docker-unpack benchmarks")
+    for name, metrics in _RESULTS.items():
+        details = ", ".join(f"{key}={value}" for key, value in metrics.items() if key != "seconds")
+        terminalreporter.write_line(f"{name:<55} {metrics['seconds']:8.2f}s  {details}")
+
+    path = config.getoption("--benchmark-json")
+    if path:
+        Path(path).write_text(json.dumps(_RESULTS, indent=2))
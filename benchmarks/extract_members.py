@@ -0,0 +1,91 @@
+"""
+Compares the throughput of `TarFile.extract`, `MemberWriter` and the threaded writer
+on a layer made of many small files, like Python site-packages or node_modules.
+
+Usage: python benchmarks/extract_members.py [NUM_FILES] [FILE_SIZE]
+
+Each extractor runs a few times, alternating, and the best times are reported. User
+CPU time shows the per-member overhead in Python; on filesystems where creating a file
+is expensive, the kernel (sys) time dominates the wall time of both.
+"""
+
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+
+from docker_unpack.utils import set_attrs
+from docker_unpack.writer import open_writer
+
+REPEAT = 3
+WRITE_JOBS = 8
+
+
+def make_layer(num_files: int, file_size: int) -> bytes:
+    buf = io.BytesIO()
+    data = os.urandom(file_size)
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for i in range(0, num_files, 100):
+            info = tarfile.TarInfo(f"pkg{i // 100}")
+            info.type, info.mode = tarfile.DIRTYPE, 0o755
+            tar.addfile(info)
+            for j in range(i, min(i + 100, num_files)):
+                info = tarfile.TarInfo(f"pkg{i // 100}/module{j}.py")
+                info.size, info.mode = file_size, 0o644
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def extract_tarfile(layer: bytes, root: str):
+    directories = []
+    with tarfile.open(fileobj=io.BytesIO(layer), mode="r|") as tar:
+        for member in tar:
+            tar.extract(member, root, set_attrs=not member.isdir())
+            if member.isdir():
+                directories.append(member)
+    for member in reversed(directories):
+        set_attrs(member, os.path.join(root, member.name))
+
+
+def extract_writer(layer: bytes, root: str, jobs: int = 1):
+    directories = []
+    with tarfile.open(fileobj=io.BytesIO(layer), mode="r|") as tar, open_writer(root, jobs) as writer:
+        for member in tar:
+            writer.write(tar, member, member.name)
+            if member.isdir():
+                directories.append(member)
+    for member in reversed(directories):
+        set_attrs(member, os.path.join(root, member.name))
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    file_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    layer = make_layer(num_files, file_size)
+
+    extractors = {
+        "tarfile.extract": extract_tarfile,
+        "MemberWriter": extract_writer,
+        f"{WRITE_JOBS} write threads": lambda layer, root: extract_writer(layer, root, WRITE_JOBS),
+    }
+    best = {name: (float("inf"), float("inf"), float("inf")) for name in extractors}
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(REPEAT):
+            for name, extract in extractors.items():
+                root = os.path.join(tmp, name)
+                start = os.times()
+                extract(layer, root)
+                end = os.times()
+                shutil.rmtree(root)
+                times = (end.elapsed - start.elapsed, end.user - start.user, end.system - start.system)
+                best[name] = tuple(map(min, best[name], times))
+
+    for name, (wall, user, system) in best.items():
+        print(f"{name:>18}: {num_files / wall:8.0f} files/s ({wall:.2f}s wall, {user:.2f}s user, {system:.2f}s sys)")
+    for name in list(extractors)[1:]:
+        print(f"{'speedup':>18}: {best['tarfile.extract'][0] / best[name][0]:.2f}x ({name})")
+
+if __name__ == "__main__":
+    main()
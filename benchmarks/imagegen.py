@@ -0,0 +1,483 @@
+"""
+Generates synthetic images in the `docker save` format, without Docker.
+
+A layer is described by a list of `Entry`s, and `build_image` writes the layer blobs
+(optionally compressed), the image config with the layers' diff_ids, `manifest.json`
+and the OCI `index.json` into an archive, optionally compressed as a whole.
+
+The scenarios below exercise the shapes of images that matter for unpack
+performance: many tiny files, a few huge files, zero-filled files, deep trees,
+whiteout and opaque directory churn, many layers, and every compression type
+`StreamProxy` detects.
+Layers can also be written as eStargz or zstd:chunked (with a table of contents).
+
+Usage: python benchmarks/imagegen.py SCENARIO OUTPUT [--compression TYPE] [--scale N] [--layer-compression TYPE]
+"""
+
+import argparse
+import bz2
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import random
+import shutil
+import struct
+import tarfile
+import tempfile
+import typing
+from dataclasses import dataclass
+
+import zstandard
+
+# Compression types detected by StreamProxy, and the corresponding media type suffixes
+COMPRESSIONS = {"tar": "", "gz": "+gzip", "bz2": "", "xz": "", "zst": "+zstd"}
+# Layer formats with a table of contents, and their media type suffixes
+CHUNKED_COMPRESSIONS = {"estargz": "+gzip", "zstd:chunked": "+zstd"}
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class Entry:
+    """
+    A layer member: a regular file (`data`, or `size` pseudo-random bytes or zeros
+    with `zeros`), a directory, a symlink or a hardlink (`linkname`).
+    """
+
+    name: str
+    type: bytes = tarfile.REGTYPE
+    data: bytes = b""
+    size: int = 0
+    linkname: str = ""
+    mode: int = 0o644
+    zeros: bool = False
+
+
+def file(name: str, data: bytes = b"", size: int = 0, mode: int = 0o644, zeros: bool = False) -> Entry:
+    return Entry(name, data=data, size=size, mode=mode, zeros=zeros)
+
+
+def directory(name: str, mode: int = 0o755) -> Entry:
+    return Entry(name, tarfile.DIRTYPE, mode=mode)
+
+
+def symlink(name: str, target: str) -> Entry:
+    return Entry(name, tarfile.SYMTYPE, linkname=target, mode=0o777)
+
+
+def hardlink(name: str, target: str) -> Entry:
+    return Entry(name, tarfile.LNKTYPE, linkname=target)
+
+
+def whiteout(path: str) -> Entry:
+    dirname, basename = os.path.split(path)
+    return file(os.path.join(dirname, f".wh.{basename}"))
+
+
+def opaque(path: str) -> Entry:
+    return file(os.path.join(path, ".wh..wh..opq"))
+
+
+class _PatternReader(io.RawIOBase):
+    """
+    Yields `size` bytes of a repeated pseudo-random pattern, compressible about as well
+    as binaries are, without holding them in memory. The pattern is the same on every
+    run, so generated images are reproducible.
+    """
+
+    _PATTERN = random.Random(0).randbytes(64 * 1024) + bytes(64 * 1024)
+    _ZEROS = bytes(128 * 1024)
+
+    def __init__(self, size: int, zeros: bool = False):
+        self.remaining = size
+        self.pattern = self._ZEROS if zeros else self._PATTERN
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining, len(self.pattern))
+        b[:n] = self.pattern[:n]
+        self.remaining -= n
+        return n
+
+
+def _compressor(fileobj, compression: str) -> typing.BinaryIO:
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=1)
+    if compression == "bz2":
+        return bz2.BZ2File(fileobj, "wb", compresslevel=1)
+    if compression == "xz":
+        return lzma.LZMAFile(fileobj, "wb", preset=0)
+    if compression == "zst":
+        return zstandard.ZstdCompressor(level=1).stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Unknown compression {compression!r}")
+
+
+class _HashingWriter(io.RawIOBase):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.size += len(b)
+        return self.fileobj.write(b)
+
+
+def _write_layer(entries: typing.Iterable[Entry], fileobj):
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for entry in entries:
+            info = tarfile.TarInfo(entry.name)
+            info.type, info.mode, info.linkname = entry.type, entry.mode, entry.linkname
+            info.mtime = 1700000000
+            if entry.type == tarfile.REGTYPE:
+                info.size = len(entry.data) or entry.size
+                tar.addfile(info, io.BytesIO(entry.data) if entry.data else _PatternReader(info.size, entry.zeros))
+            else:
+                tar.addfile(info)
+            # Written members are kept by tarfile, which would take gigabytes for the largest layers
+            tar.members.clear()
+
+
+def _write_chunked(src, dst, layer_type: str, chunk_size: int = 4 * 1024 * 1024):
+    """
+    Writes a layer tarball as eStargz or zstd:chunked: the tar stream is split where
+    each chunk of file contents starts, each part is compressed separately, and the
+    table of contents is appended.
+    """
+    estargz = layer_type == "estargz"
+    with tarfile.open(fileobj=src) as tar:
+        members = tar.getmembers()
+        # eStargz layers end with the TOC (a tar of its own) instead of end-of-archive blocks
+        end = tar.offset if estargz else os.fstat(src.fileno()).st_size
+
+    cuts = sorted({m.offset_data + i for m in members if m.isreg() for i in range(0, m.size, chunk_size)})
+    offsets = {}
+    for start, stop in zip([0, *cuts], [*cuts, end]):
+        offsets[start] = dst.tell()
+        src.seek(start)
+        data = src.read(stop - start)
+        dst.write(gzip.compress(data, compresslevel=1) if estargz else zstandard.ZstdCompressor(level=1).compress(data))
+    offsets[end] = dst.tell()
+    following = dict(zip(cuts, [*cuts[1:], end]))
+
+    types = {tarfile.REGTYPE: "reg", tarfile.DIRTYPE: "dir", tarfile.SYMTYPE: "symlink", tarfile.LNKTYPE: "hardlink"}
+    entries = []
+    for m in members:
+        mtime = datetime.datetime.fromtimestamp(m.mtime, datetime.timezone.utc)
+        entry = {
+            "name": m.name,
+            "type": types[m.type],
+            "mode": m.mode,
+            "modtime": mtime.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "linkName": m.linkname,
+        }
+        entries.append(entry)
+        if not m.isreg():
+            continue
+        entry["size"] = m.size
+        for i in range(0, m.size, chunk_size):
+            chunk = entry if i == 0 else {"name": m.name, "type": "chunk"}
+            if i:
+                entries.append(chunk)
+            start = m.offset_data + i
+            # The last chunk of eStargz files has no size: it extends to the end of the file
+            size = min(chunk_size, m.size - i) if not estargz or i + chunk_size < m.size else 0
+            chunk |= {"offset": offsets[start], "chunkOffset": i, "chunkSize": size}
+            if not estargz:
+                chunk["endOffset"] = offsets[following[start]]
+    toc = json.dumps({"version": 1, "entries": entries}).encode()
+
+    if estargz:
+        toc_offset = dst.tell()
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            _add_bytes(tar, "stargz.index.json", toc)
+        dst.write(gzip.compress(buf.getvalue()))
+        extra = b"SG" + struct.pack("<H", 22) + b"%016xSTARGZ" % toc_offset
+        dst.write(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff" + struct.pack("<H", len(extra)) + extra)
+        dst.write(b"\x01\x00\x00\xff\xff" + b"\0" * 8)
+    else:
+        manifest = zstandard.ZstdCompressor().compress(toc)
+        dst.write(b"\x50\x2a\x4d\x18" + struct.pack("<I", len(manifest)))
+        offset = dst.tell()
+        dst.write(manifest)
+        dst.write(b"\x50\x2a\x4d\x18" + struct.pack("<I", 64))
+        dst.write(struct.pack("<7Q", offset, len(manifest), len(toc), 1, 0, 0, 0) + b"GNUlInUx")
+
+
+def _add_file(tar: tarfile.TarFile, name: str, path: str):
+    with open(path, "rb") as f:
+        tar.addfile(tar.gettarinfo(arcname=name, fileobj=f), f)
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 1700000000
+    tar.addfile(info, io.BytesIO(data))
+
+
+def build_image(
+    path: str,
+    layers: list[typing.Iterable[Entry]],
+    layer_compression: str | list[str] = "tar",
+    compression: str = "tar",
+    config: dict | None = None,
+):
+    """
+    Writes an image archive with the given layers (bottom to top) to `path`. Layers
+    are compressed with `layer_compression` (one type, or one per layer), and the
+    archive itself with `compression`.
+    """
+    if isinstance(layer_compression, str):
+        layer_compression = [layer_compression] * len(layers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        blobs, diff_ids, descriptors = [], [], []
+        for i, (entries, layer_type) in enumerate(zip(layers, layer_compression)):
+            tar_path = os.path.join(tmp, f"{i}.tar")
+            with open(tar_path, "wb") as f:
+                writer = _HashingWriter(f)
+                _write_layer(entries, writer)
+            diff_ids.append(f"sha256:{writer.sha256.hexdigest()}")
+
+            blob_path = tar_path
+            if layer_type in CHUNKED_COMPRESSIONS:
+                blob_path = os.path.join(tmp, f"{i}.chunked")
+                with open(tar_path, "rb") as src, open(blob_path, "wb") as dst:
+                    _write_chunked(src, dst, layer_type)
+                os.unlink(tar_path)
+            elif layer_type != "tar":
+                blob_path = os.path.join(tmp, f"{i}.{layer_type}")
+                with open(tar_path, "rb") as src, open(blob_path, "wb") as dst, _compressor(dst, layer_type) as c:
+                    shutil.copyfileobj(src, c, _CHUNK_SIZE)
+                os.unlink(tar_path)
+            digest = _file_digest(blob_path)
+            blobs.append((f"blobs/sha256/{digest}", blob_path))
+            descriptors.append(
+                {
+                    "mediaType": f"application/vnd.oci.image.layer.v1.tar{(COMPRESSIONS | CHUNKED_COMPRESSIONS)[layer_type]}",
+                    "digest": f"sha256:{digest}",
+                    "size": os.path.getsize(blob_path),
+                }
+            )
+
+        config = {
+            "architecture": "amd64",
+            "os": "linux",
+            "config": {"Env": ["PATH=/usr/local/bin:/usr/bin:/bin"], "Cmd": ["/bin/sh"]},
+            **(config or {}),
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+        }
+        config_data = json.dumps(config).encode()
+        config_digest = hashlib.sha256(config_data).hexdigest()
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {
+                "mediaType": "application/vnd.oci.image.config.v1+json",
+                "digest": f"sha256:{config_digest}",
+                "size": len(config_data),
+            },
+            "layers": descriptors,
+        }
+        manifest_data = json.dumps(manifest).encode()
+        manifest_digest = hashlib.sha256(manifest_data).hexdigest()
+        index = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": [
+                {
+                    "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                    "digest": f"sha256:{manifest_digest}",
+                    "size": len(manifest_data),
+                    "annotations": {"io.containerd.image.name": "docker.io/library/synthetic:latest"},
+                }
+            ],
+        }
+        docker_manifest = [
+            {
+                "Config": f"blobs/sha256/{config_digest}",
+                "RepoTags": ["synthetic:latest"],
+                "Layers": [name for name, _ in blobs],
+            }
+        ]
+
+        with open(path, "wb") as out:
+            with (
+                _compressor(out, compression) if compression != "tar" else contextlib.nullcontext(out) as f,
+                tarfile.open(fileobj=f, mode="w|") as tar,
+            ):
+                _add_bytes(tar, "oci-layout", b'{"imageLayoutVersion": "1.0.0"}')
+                for name, blob_path in dict(blobs).items():
+                    _add_file(tar, name, blob_path)
+                _add_bytes(tar, f"blobs/sha256/{config_digest}", config_data)
+                _add_bytes(tar, f"blobs/sha256/{manifest_digest}", manifest_data)
+                _add_bytes(tar, "index.json", json.dumps(index).encode())
+                _add_bytes(tar, "manifest.json", json.dumps(docker_manifest).encode())
+
+
+def _file_digest(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# MARK: Scenarios
+
+
+def tiny_files(scale: float = 1) -> list[list[Entry]]:
+    """
+    One layer of small files spread over package directories, like site-packages.
+    """
+    num_files = int(10_000 * scale)
+    entries = [directory("usr"), directory("usr/lib")]
+    for i in range(0, num_files, 50):
+        pkg = f"usr/lib/pkg{i // 50}"
+        entries.append(directory(pkg))
+        entries += [file(f"{pkg}/mod{j}.py", size=1024 + j % 7 * 512) for j in range(i, min(i + 50, num_files))]
+    return [entries]
+
+
+def huge_files(scale: float = 1) -> list[list[Entry]]:
+    """
+    A few large files, like model weights or toolchains.
+    """
+    size = int(64 * 1024 * 1024 * scale)
+    return [[directory("opt"), *(file(f"opt/blob{i}.bin", size=size) for i in range(3))]]
+
+
+def zero_filled(scale: float = 1) -> list[list[Entry]]:
+    """
+    Large preallocated files of zeros, like disk images or model placeholders.
+    """
+    size = int(128 * 1024 * 1024 * scale)
+    return [[directory("var"), file("var/disk.img", size=size, zeros=True), file("var/header", size=64 * 1024)]]
+
+
+def deep_tree(scale: float = 1) -> list[list[Entry]]:
+    """
+    A deeply nested directory chain with a few files at every level.
+    """
+    entries, path = [], ""
+    for depth in range(int(100 * scale)):
+        path = f"{path}/d{depth}" if path else f"d{depth}"
+        entries.append(directory(path))
+        entries += [file(f"{path}/f{i}", size=256) for i in range(5)]
+    return [entries]
+
+
+def whiteout_churn(scale: float = 1) -> list[list[Entry]]:
+    """
+    Layers that repeatedly delete, replace and hide the files of the layers below.
+    """
+    num_files = int(1000 * scale)
+    layers = [[directory("data"), *(file(f"data/f{i}", size=512) for i in range(num_files))]]
+    for n in range(1, 10):
+        entries = [whiteout(f"data/f{i}") for i in range(n % 2, num_files, 2)]
+        entries += [file(f"data/f{i}", size=512) for i in range(n % 3, num_files, 3)]
+        if n % 4 == 0:
+            entries += [directory(f"data/opq{n}"), opaque(f"data/opq{n}")]
+            entries += [file(f"data/opq{n}/f{i}", size=512) for i in range(num_files // 10)]
+        layers.append(entries)
+    layers.append([opaque("data"), file("data/final", data=b"final")])
+    return layers
+
+
+def many_layers(scale: float = 1) -> list[list[Entry]]:
+    """
+    Many thin layers, like images built with a RUN per package.
+    """
+    return [
+        [directory("etc"), file(f"etc/layer{i}", size=128), file("etc/shared", data=f"{i}".encode())]
+        for i in range(int(100 * scale))
+    ]
+
+
+def mixed_compression(scale: float = 1) -> list[list[Entry]]:
+    """
+    One layer per compression type, all holding small and large files.
+    """
+    layers = []
+    for c in COMPRESSIONS:
+        entries = [directory(c), *(file(f"{c}/f{i}", size=4096) for i in range(int(500 * scale)))]
+        entries.append(file(f"{c}/big", size=int(8 * 1024 * 1024 * scale)))
+        layers.append(entries)
+    return layers
+
+
+def many_entries(scale: float = 1) -> list[typing.Iterable[Entry]]:
+    """
+    One layer of millions of empty files and hardlinks, like a conda or node_modules
+    tree. Entries are generated as the layer is written, so that generating it
+    doesn't take gigabytes of memory either.
+    """
+    num_files = int(2_000_000 * scale)
+
+    def entries():
+        yield directory("env")
+        for i in range(0, num_files, 1000):
+            pkg = f"env/lib/pkg{i // 1000}"
+            yield directory(pkg)
+            for j in range(i, min(i + 1000, num_files)):
+                yield hardlink(f"{pkg}/link{j}", f"{pkg}/file{j - 1}") if j % 100 == 99 else file(f"{pkg}/file{j}")
+
+    return [entries()]
+
+
+SCENARIOS = {
+    "tiny_files": tiny_files,
+    "huge_files": huge_files,
+    "zero_filled": zero_filled,
+    "deep_tree": deep_tree,
+    "whiteout_churn": whiteout_churn,
+    "many_layers": many_layers,
+    "mixed_compression": mixed_compression,
+}
+# Scenarios too large to run in every benchmark
+LARGE_SCENARIOS = {
+    "many_entries": many_entries,
+}
+
+
+def build_scenario(
+    name: str, path: str, compression: str = "tar", scale: float = 1, layer_compression: str | None = None
+):
+    """
+    Writes the image of a scenario to `path`, with its layers compressed with
+    `layer_compression` (uncompressed by default).
+    """
+    layers = (SCENARIOS | LARGE_SCENARIOS)[name](scale)
+    if layer_compression is None:
+        layer_compression = list(COMPRESSIONS) if name == "mixed_compression" else "tar"
+    build_image(path, layers, layer_compression, compression)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic image archive.")
+    parser.add_argument("scenario", choices=[*SCENARIOS, *LARGE_SCENARIOS])
+    parser.add_argument("output")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="tar", help="compression of the whole archive")
+    parser.add_argument("--scale", type=float, default=1, help="multiplier for the number and size of files")
+    parser.add_argument(
+        "--layer-compression", choices=[*COMPRESSIONS, *CHUNKED_COMPRESSIONS], help="compression of the layers"
+    )
+    args = parser.parse_args()
+    build_scenario(args.scenario, args.output, args.compression, args.scale, args.layer_compression)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Benchmarks of the layer index on trees with millions of entries (at scale 1).
+"""
+
+import time
+
+from docker_unpack.layers import LayerIndex
+
+ENTRIES = 1_000_000
+
+
+def _paths(n: int):
+    for i in range(n):
+        yield f"usr/share/d{i // 1000}/sub{i // 100 % 10}/file{i}"
+
+
+def test_layer_index(request, record):
+    n = int(ENTRIES * request.config.getoption("--benchmark-scale"))
+    index = LayerIndex()
+
+    start = time.perf_counter()
+    for path in _paths(n):
+        if not index.is_hidden(path):
+            index.claim(path, isdir=False)
+    index.commit()
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert all(index.is_hidden(path) for path in _paths(n))
+    lookup = time.perf_counter() - start
+
+    # Whiting out the tree drops it from the index in one go
+    start = time.perf_counter()
+    index.whiteout("usr/share")
+    index.commit()
+    whiteout = time.perf_counter() - start
+    assert index.is_hidden("usr/share/d0/sub0/file0")
+    assert not index.is_hidden("usr/lib")
+    assert index._root.children["usr"].children == {"share": 4}
+
+    record(
+        build + lookup + whiteout,
+        build_s=round(build, 3),
+        lookup_s=round(lookup, 3),
+        whiteout_s=round(whiteout, 3),
+        entries_per_s=round(n / build),
+    )
@@ -0,0 +1,273 @@
+"""
+Benchmarks of `docker-unpack unpack` on generated images.
+
+End-to-end benchmarks run the CLI in a subprocess, so that its peak RSS can be
+measured, and fail if it exceeds `DOCKER_UNPACK_BENCH_MAX_RSS_MB`. Phase benchmarks
+time the library functions behind each step of an unpack.
+
+Run with: pdm run pytest benchmarks [--benchmark-scale 0.1] [--benchmark-json results.json]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+from imagegen import CHUNKED_COMPRESSIONS, COMPRESSIONS, SCENARIOS, build_scenario
+
+from docker_unpack.analysis import analyze_layers
+from docker_unpack.apptainer_base_env import make_base_env
+from docker_unpack.catalog import load_catalog
+from docker_unpack.image import open_indexed, read_streaming
+from docker_unpack.layers import StagedLayers, apply_layers
+from docker_unpack.manifest import HASHES
+from docker_unpack.utils import generate_env, generate_runscript
+
+MAX_RSS_MB = int(os.environ.get("DOCKER_UNPACK_BENCH_MAX_RSS_MB", 1024))
+READAHEAD_MB = 128
+
+_CLI = [sys.executable, "-c", "from docker_unpack.cli import app; app()"]
+
+# The peak RSS of a process includes that of the process it was started from (the
+# high-water mark carries over `exec`), so the CLI is started by a small wrapper
+# process, which writes the peak RSS of its children to the descriptor in argv[1].
+_RSS_WRAPPER = [
+    sys.executable,
+    "-c",
+    "import os, resource, subprocess, sys\n"
+    "status = subprocess.call(sys.argv[2:])\n"
+    "os.write(int(sys.argv[1]), str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss).encode())\n"
+    "sys.exit(status)",
+]
+
+
+def _run_unpack(args: list[str], stdin_path=None, stdout=None) -> tuple[float, int]:
+    """
+    Runs the CLI and returns its wall time and peak RSS in bytes.
+    """
+    stdin = open(stdin_path, "rb") if stdin_path else subprocess.DEVNULL
+    read_fd, write_fd = os.pipe()
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [*_RSS_WRAPPER, str(write_fd), *_CLI, "unpack", *args],
+            stdin=stdin,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            pass_fds=(write_fd,),
+        )
+        os.close(write_fd)
+        stderr = proc.stderr.read()
+        proc.wait()
+        elapsed = time.perf_counter() - start
+        with open(read_fd, "rb") as f:
+            maxrss = f.read()
+    finally:
+        if stdin_path:
+            stdin.close()
+    assert proc.returncode == 0, stderr.decode(errors="replace")[-4000:]
+    # ru_maxrss is in KiB on Linux
+    return elapsed, int(maxrss) * 1024
+
+
+def _count_entries(root) -> int:
+    return sum(len(dirnames) + len(filenames) for _, dirnames, filenames in os.walk(root))
+
+
+@pytest.mark.parametrize("source", ["file", "stdin"])
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_unpack(scenario, source, image, record, tmp_path):
+    path = image(scenario)
+    out = tmp_path / "out"
+    args = ["--readahead-mb", str(READAHEAD_MB)]
+    if source == "file":
+        elapsed, rss = _run_unpack([*args, str(path), str(out)])
+    else:
+        elapsed, rss = _run_unpack([*args, "-", str(out)], stdin_path=path)
+
+    entries = _count_entries(out)
+    record(
+        elapsed,
+        mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1),
+        entries_per_s=round(entries / elapsed),
+        peak_rss_mb=round(rss / 2**20),
+    )
+    assert rss < MAX_RSS_MB * 2**20
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_unpack_to_tar(scenario, image, record, tmp_path):
+    path = image(scenario)
+    with open(tmp_path / "flat.tar", "wb") as out:
+        elapsed, rss = _run_unpack(["--readahead-mb", str(READAHEAD_MB), str(path), "-"], stdout=out)
+    record(
+        elapsed,
+        mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1),
+        output_mb=round((tmp_path / "flat.tar").stat().st_size / 1e6, 1),
+        peak_rss_mb=round(rss / 2**20),
+    )
+    assert rss < MAX_RSS_MB * 2**20
+
+
+@pytest.mark.parametrize("compression", [c for c in COMPRESSIONS if c != "tar"])
+def test_unpack_compressed_archive(compression, image, record, tmp_path):
+    path = image("tiny_files", compression)
+    elapsed, rss = _run_unpack(["--readahead-mb", str(READAHEAD_MB), "-", str(tmp_path / "out")], stdin_path=path)
+    record(elapsed, mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1), peak_rss_mb=round(rss / 2**20))
+    assert rss < MAX_RSS_MB * 2**20
+
+
+@pytest.mark.parametrize("layer_compression", ["gz", "zst", *CHUNKED_COMPRESSIONS])
+@pytest.mark.parametrize("scenario", ["tiny_files", "huge_files"])
+def test_unpack_layer_compression(scenario, layer_compression, image, record, tmp_path):
+    path = image(scenario, layer_compression=layer_compression)
+    elapsed, rss = _run_unpack(["--readahead-mb", str(READAHEAD_MB), str(path), str(tmp_path / "out")])
+    record(elapsed, mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1), peak_rss_mb=round(rss / 2**20))
+    assert rss < MAX_RSS_MB * 2**20
+
+
+@pytest.mark.parametrize("manifest_hash", [None, "sha256", "blake3", "xxh128"])
+@pytest.mark.parametrize("scenario", ["tiny_files", "huge_files"])
+def test_unpack_manifest(scenario, manifest_hash, image, record, tmp_path):
+    args = ["--readahead-mb", str(READAHEAD_MB)]
+    if manifest_hash is not None:
+        pytest.importorskip(HASHES[manifest_hash][0])
+        args += ["--manifest", str(tmp_path / "manifest"), "--manifest-hash", manifest_hash]
+    path = image(scenario)
+    elapsed, rss = _run_unpack([*args, str(path), str(tmp_path / "out")])
+    record(elapsed, mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1), peak_rss_mb=round(rss / 2**20))
+
+
+@pytest.mark.parametrize("verify", [True, False])
+@pytest.mark.parametrize("layer_compression", ["tar", "gz", "zst"])
+def test_unpack_verify(layer_compression, verify, image, record, tmp_path):
+    path = image("huge_files", layer_compression=layer_compression)
+    args = ["--readahead-mb", str(READAHEAD_MB), "--verify" if verify else "--no-verify"]
+    elapsed, rss = _run_unpack([*args, str(path), str(tmp_path / "out")])
+    record(elapsed, mb_per_s=round(path.stat().st_size / elapsed / 1e6, 1), peak_rss_mb=round(rss / 2**20))
+
+
+@pytest.mark.parametrize("durability", ["none", "end", "strict"])
+def test_unpack_durability(durability, image, record, tmp_path):
+    path = image("tiny_files")
+    out = tmp_path / "out"
+    elapsed, rss = _run_unpack(["--readahead-mb", str(READAHEAD_MB), "--durability", durability, str(path), str(out)])
+    record(elapsed, entries_per_s=round(_count_entries(out) / elapsed), peak_rss_mb=round(rss / 2**20))
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("layer_compression", ["tar", "zst"])
+def test_unpack_sparse(layer_compression, sparse, image, record, tmp_path):
+    path = image("zero_filled", layer_compression=layer_compression)
+    out = tmp_path / "out"
+    args = ["--readahead-mb", str(READAHEAD_MB), "--sparse" if sparse else "--no-sparse"]
+    elapsed, rss = _run_unpack([*args, str(path), str(out)])
+    disk = sum(os.lstat(os.path.join(d, f)).st_blocks * 512 for d, _, files in os.walk(out) for f in files)
+    record(elapsed, disk_mb=round(disk / 2**20, 1), peak_rss_mb=round(rss / 2**20))
+
+
+@pytest.mark.parametrize("source", ["file", "stdin"])
+def test_unpack_many_entries(source, request, record, tmp_path):
+    """
+    Unpacks a layer of millions of entries (2M at scale 1) and a layer of a
+    hundredth of them: members aren't kept once extracted, so peak RSS shouldn't
+    grow with the number of entries. The read-ahead buffers are kept small, so
+    that they don't hide that growth.
+    """
+    scale = request.config.getoption("--benchmark-scale")
+    results = {}
+    for name, factor in (("small", 0.01), ("large", 1)):
+        path = tmp_path / f"{name}.tar"
+        build_scenario("many_entries", str(path), scale=scale * factor)
+        out = tmp_path / name
+        args = ["--readahead-mb", "8"]
+        if source == "file":
+            results[name] = _run_unpack([*args, str(path), str(out)])
+        else:
+            results[name] = _run_unpack([*args, "-", str(out)], stdin_path=path)
+        entries = _count_entries(out)
+        path.unlink()
+        shutil.rmtree(out)
+
+    (small_elapsed, small_rss), (elapsed, rss) = results["small"], results["large"]
+    record(
+        elapsed,
+        entries_per_s=round(entries / elapsed),
+        peak_rss_mb=round(rss / 2**20),
+        small_peak_rss_mb=round(small_rss / 2**20),
+    )
+    # Allow for allocator noise, but not for growth with the number of entries:
+    # keeping their headers would take 16 MiB for the first ~25k entries
+    assert rss < small_rss + 16 * 2**20
+    assert rss < MAX_RSS_MB * 2**20
+
+
+@pytest.mark.parametrize("layer_compression", ["tar", "gz", "zst"])
+def test_cat(layer_compression, image, record, tmp_path):
+    path = image("huge_files", layer_compression=layer_compression)
+    timings = {}
+    # The first lookup indexes the layers, later ones resume from the saved index
+    for phase in ("index", "cat"):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            image_catalog = load_catalog(open_indexed(f), path, tmp_path / "index")
+            *_, name = image_catalog.walk("", recursive=True)
+            size = sum(len(chunk) for chunk in image_catalog.read(name))
+        timings[phase] = time.perf_counter() - start
+    record(timings["cat"], index_s=round(timings["index"], 3), mb_per_s=round(size / timings["cat"] / 1e6, 1))
+
+
+@pytest.mark.parametrize("layer_compression", ["tar", "gz", *CHUNKED_COMPRESSIONS])
+@pytest.mark.parametrize("scenario", ["tiny_files", "huge_files", "whiteout_churn"])
+def test_analyze(scenario, layer_compression, image, record, tmp_path):
+    path = image(scenario, layer_compression=None if layer_compression == "tar" else layer_compression)
+    with open(path, "rb") as f:
+        blobs = open_indexed(f).layer_blobs()
+        start = time.perf_counter()
+        report = analyze_layers(blobs)
+        elapsed = time.perf_counter() - start
+
+        # Compared to a real unpack of the same image
+        start = time.perf_counter()
+        apply_layers(blobs, tmp_path / "out", readahead_bytes=READAHEAD_MB * 2**20)
+        unpack_elapsed = time.perf_counter() - start
+    record(elapsed, files=report["files"], speedup=round(unpack_elapsed / elapsed, 1))
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_phases(scenario, image, record, tmp_path):
+    path = image(scenario)
+    root = tmp_path / "indexed"
+    timings = {}
+
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        archive = open_indexed(f)
+        timings["index"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        apply_layers(archive.layer_blobs(), root, readahead_bytes=READAHEAD_MB * 2**20)
+        timings["apply"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    make_base_env(root, runscript=False)
+    generate_runscript(root, archive.config["config"])
+    generate_env(root, archive.config["config"])
+    timings["env"] = time.perf_counter() - start
+
+    root = tmp_path / "streamed"
+    root.mkdir()
+    start = time.perf_counter()
+    staged = StagedLayers(root, readahead_bytes=READAHEAD_MB * 2**20)
+    with open(path, "rb") as f:
+        archive = read_streaming(f, staged.stage)
+    timings["stage"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    staged.merge(archive.layers)
+    timings["merge"] = time.perf_counter() - start
+
+    record(sum(timings.values()), **{f"{phase}_s": round(t, 3) for phase, t in timings.items()})
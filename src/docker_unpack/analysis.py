@@ -0,0 +1,167 @@
+"""
+Dry-run analysis of an image, for `analyze`.
+
+The layers are read top-down like when unpacking, but only their tar headers are
+looked at: the contents of uncompressed layers are seeked over, and layers with a
+table of contents (eStargz, zstd:chunked) are not decompressed at all. Compressed
+layers still have to be decompressed, but nothing is written.
+"""
+
+import heapq
+import posixpath
+import tarfile
+import typing
+
+from watcloud_utils.logging import logger
+
+from .chunked import read_toc
+from .decompress import open_decompressed, peek_comptype
+from .image import Blob
+from .layers import OPAQUE_WHITEOUT, WHITEOUT_PREFIX, LayerIndex
+from .utils import MyTarFile, normalize_member_name
+
+
+# Header fields of a member: (name, type, size)
+Header = tuple[str, bytes, int]
+
+
+def _headers(members: typing.Iterable[tarfile.TarInfo]) -> typing.Iterator[Header]:
+    for member in members:
+        yield member.name, member.type, member.size
+
+
+def read_headers(fileobj, decompressors: typing.Sequence[str] = (), name: str = "") -> list[Header]:
+    """
+    Returns the member headers of a layer read as a stream.
+    """
+    with open_decompressed(fileobj, decompressors, name) as f, MyTarFile.open(fileobj=f, mode="r|") as tar:
+        return list(_headers(tar))
+
+
+def _layer_headers(blob: Blob, decompressors: typing.Sequence[str]) -> typing.Iterator[Header]:
+    """
+    Yields the member headers of a layer blob, reading as little of it as possible.
+    """
+    with blob.open() as f:
+        toc = read_toc(f)
+        if toc is not None:
+            logger.info(f"Reading {blob.name} through its {toc.format} table of contents")
+            yield from _headers(toc.members)
+            return
+        comptype, f = peek_comptype(f)
+        if comptype == "tar" and f.seekable():
+            # Random access mode seeks over the contents of the members
+            with MyTarFile.open(fileobj=f, mode="r:") as tar:
+                yield from _headers(tar)
+            return
+        with open_decompressed(f, decompressors, blob.name) as f, MyTarFile.open(fileobj=f, mode="r|") as tar:
+            yield from _headers(tar)
+
+
+def analyze_layers(
+    blobs: list[Blob],
+    decompressors: typing.Sequence[str] = (),
+    top: int = 10,
+    headers: dict[str, list[Header]] | None = None,
+) -> dict:
+    """
+    Merges the headers of the layers (ordered bottom to top) and returns the size of
+    the unpacked tree, its `top` largest files, and for each layer, the bytes of its
+    files that are replaced or deleted by upper layers. The headers of layers read
+    beforehand (e.g. from a stream) are given in `headers`, by blob name.
+    """
+    index = LayerIndex()
+    files = directories = total_bytes = 0
+    largest: list[tuple[int, str]] = []
+    layers = []
+
+    for blob in reversed(blobs):
+        layer = {
+            "name": blob.name,
+            "compressed_bytes": blob.size,
+            "files": 0,
+            "bytes": 0,
+            "overwritten_files": 0,
+            "overwritten_bytes": 0,
+            "deleted_files": 0,
+            "deleted_bytes": 0,
+        }
+        members = headers[blob.name] if headers is not None else _layer_headers(blob, decompressors)
+        for name, member_type, size in members:
+            path = normalize_member_name(name)
+            dirname, basename = posixpath.split(path)
+            if basename == OPAQUE_WHITEOUT:
+                index.opaque(dirname)
+                continue
+            if basename.startswith(WHITEOUT_PREFIX):
+                index.whiteout(posixpath.join(dirname, basename.removeprefix(WHITEOUT_PREFIX)))
+                continue
+            if not path:
+                continue
+
+            isdir = member_type == tarfile.DIRTYPE
+            if member_type not in tarfile.REGULAR_TYPES:
+                size = 0
+            if not isdir:
+                layer["files"] += 1
+                layer["bytes"] += size
+            if index.is_hidden(path):
+                if not isdir:
+                    kind = "deleted" if index.is_deleted(path) else "overwritten"
+                    layer[f"{kind}_files"] += 1
+                    layer[f"{kind}_bytes"] += size
+                    # Still replaces the directories of the lower layers
+                    index.hide_children(path)
+                continue
+
+            index.claim(path, isdir)
+            if isdir:
+                directories += 1
+                continue
+            files += 1
+            total_bytes += size
+            if len(largest) < top:
+                heapq.heappush(largest, (size, path))
+            elif top and size > largest[0][0]:
+                heapq.heapreplace(largest, (size, path))
+        index.commit()
+        layers.append(layer)
+
+    return {
+        "files": files,
+        "directories": directories,
+        "bytes": total_bytes,
+        "largest": [[path, size] for size, path in sorted(largest, key=lambda e: (-e[0], e[1]))],
+        # Bottom to top, like the layers of the image
+        "layers": layers[::-1],
+    }
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_report(report: dict) -> str:
+    """
+    Formats the result of `analyze_layers` for humans.
+    """
+    lines = [
+        f"Unpacked size: {format_bytes(report['bytes'])} in {report['files']} files "
+        f"and {report['directories']} directories",
+        "",
+        "Largest files:",
+    ]
+    lines += [f"  {format_bytes(size):>10}  /{path}" for path, size in report["largest"]]
+    lines += ["", f"{'#':>3} {'Blob':>10} {'Size':>10} {'Overwritten':>11} {'Deleted':>10}  Layer"]
+    for i, layer in enumerate(report["layers"]):
+        lines.append(
+            f"{i:>3} {format_bytes(layer['compressed_bytes']):>10} {format_bytes(layer['bytes']):>10} "
+            f"{format_bytes(layer['overwritten_bytes']):>11} {format_bytes(layer['deleted_bytes']):>10}  {layer['name']}"
+        )
+    wasted = sum(layer["overwritten_bytes"] + layer["deleted_bytes"] for layer in report["layers"])
+    lines += ["", f"Bytes of lower layers replaced or deleted by upper layers: {format_bytes(wasted)}"]
+    return "\n".join(lines)
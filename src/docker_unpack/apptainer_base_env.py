@@ -5,20 +5,36 @@ import stat
 import logging
 from pathlib import Path
 
+from .utils import write_if_changed
+
+
+# Created in order, parents first
+BASE_DIRS = (
+    ".singularity.d",
+    ".singularity.d/libs",
+    ".singularity.d/actions",
+    ".singularity.d/env",
+    "dev",
+    "proc",
+    "root",
+    "var",
+    "var/tmp",
+    "tmp",
+    "etc",
+    "sys",
+    "home",
+)
+
 
 def make_dirs(root_path):
     try:
-        (Path(root_path) / ".singularity.d/libs").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / ".singularity.d/actions").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / ".singularity.d/env").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "dev").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "proc").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "root").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "var/tmp").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "tmp").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "etc").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "sys").mkdir(parents=True, exist_ok=True)
-        (Path(root_path) / "home").mkdir(parents=True, exist_ok=True)
+        for path in BASE_DIRS:
+            path = os.path.join(root_path, path)
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                if not os.path.isdir(path):
+                    raise
     except Exception as e:
         logging.error(f"Error creating directories: {e}")
         raise
@@ -35,29 +51,24 @@ def make_symlinks(root_path):
             "environment": ".singularity.d/env/90-environment.sh",
         }
         for link, target in symlinks.items():
-            link_path = Path(root_path) / link
-            target_path = Path(root_path) / target
-            if not link_path.exists():
-                link_path.symlink_to(target_path)
+            try:
+                os.symlink(os.path.join(root_path, target), os.path.join(root_path, link))
+            except FileExistsError:
+                pass
     except Exception as e:
         logging.error(f"Error creating symlinks: {e}")
         raise
 
 
-def make_file(name, content, perm):
+def make_file(name, content, perm, sync=False):
     try:
-        file_path = Path(name)
-        if file_path.exists():
-            file_path.chmod(perm)
-        with open(file_path, "w") as f:
-            f.write(content)
-        file_path.chmod(perm)
+        write_if_changed(Path(name), content, perm, sync)
     except Exception as e:
         logging.error(f"Error creating file {name}: {e}")
         raise
 
 
-def make_files(root_path):
+def make_files(root_path, sync=False, runscript=True):
     try:
         file_contents = {
             "etc/hosts": "",
@@ -76,20 +87,32 @@ def make_files(root_path):
             ".singularity.d/startscript": startscriptFileContent,
         }
         for file, content in file_contents.items():
-            make_file(Path(root_path) / file, content, 0o755)
+            if file == ".singularity.d/runscript" and (
+                not runscript or os.path.exists(os.path.join(root_path, file))
+            ):
+                # Replaced by the image's runscript (see generate_runscript)
+                continue
+            make_file(os.path.join(root_path, file), content, 0o755, sync)
     except Exception as e:
         logging.error(f"Error creating files: {e}")
         raise
 
 
-def make_base_env(root_path):
+def make_base_env(root_path, sync=False, runscript=True):
+    """
+    Creates the fixed directories, symlinks and files of the Apptainer base
+    environment in `root_path`. In a fresh tree, each directory and symlink takes a
+    single syscall, and each file an open, a write and a chmod. Files are fsynced
+    with `sync`. Pass `runscript=False` when the image's runscript is generated
+    afterwards, so that the default one isn't written only to be replaced.
+    """
     try:
         root = Path(root_path)
         if not os.access(root, os.W_OK):
             root.chmod(root.stat().st_mode | stat.S_IWUSR)
         make_dirs(root_path)
         make_symlinks(root_path)
-        make_files(root_path)
+        make_files(root_path, sync, runscript)
     except Exception as e:
         logging.error(f"Error setting up base environment: {e}")
         raise
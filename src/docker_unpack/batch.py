@@ -0,0 +1,191 @@
+"""
+Unpacking many images in one batch (`unpack-many`).
+
+Images are unpacked by a pool of worker processes. Layers shared by several images
+of the batch are first extracted once into a layer cache (a temporary one, unless
+`--cache-dir` is given), from which the images using them are assembled.
+"""
+
+import contextlib
+import dataclasses
+import math
+import re
+import shlex
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .cache import LayerCache
+from .image import ImageArchive, open_directory, open_indexed
+from .utils import StreamProxy
+
+
+@dataclasses.dataclass
+class BatchJob:
+    """
+    An image to unpack: `image` selects it in multi-image archives (see `select_image`).
+    """
+
+    input_file: Path
+    output_dir: Path
+    image: str | None = None
+    # diff_ids of the layers, when they can be read without decompressing the image
+    keys: list[str] | None = None
+
+
+def read_job_list(path: Path) -> list[BatchJob]:
+    """
+    Reads a list of `<archive> <output_dir>` lines (shell-quoted). Empty lines and
+    lines starting with `#` are ignored.
+    """
+    jobs = []
+    for lineno, line in enumerate(path.read_text().splitlines(), 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        fields = shlex.split(line)
+        if len(fields) != 2:
+            raise Exception(f"{path}:{lineno}: expected an archive and an output directory, got {line!r}")
+        jobs.append(BatchJob(Path(fields[0]), Path(fields[1])))
+    return jobs
+
+
+def _output_name(manifest: dict, position: int) -> str:
+    tags = manifest.get("RepoTags") or []
+    if not tags:
+        return f"image-{position}"
+    # e.g. registry.example.com/team/app:1.0 -> registry.example.com_team_app_1.0
+    return re.sub(r"[^A-Za-z0-9._-]", "_", tags[0])
+
+
+@contextlib.contextmanager
+def _open_seekable(input_file: Path, platform: str | None, image: str | None):
+    """
+    Opens an image whose blobs can be read in place (an uncompressed archive or a
+    directory), or yields None.
+    """
+    if input_file.is_dir():
+        yield open_directory(str(input_file), platform, image)
+        return
+    with open(input_file, "rb") as f:
+        if f.seekable() and StreamProxy(f).getcomptype() == "tar":
+            yield open_indexed(f, platform, image)
+        else:
+            yield None
+
+
+def expand_archive(archive: Path, output_root: Path, platform: str | None = None) -> list[BatchJob]:
+    """
+    Returns a job per image of a multi-image `docker save` archive, unpacked to a
+    directory of `output_root` named after its first tag.
+    """
+    with _open_seekable(archive, platform, "0") as image:
+        if image is None:
+            raise Exception(f"{archive} must be an uncompressed archive (or a directory) to unpack all its images")
+        manifests = image.manifests
+
+    jobs = []
+    for position, manifest in enumerate(manifests):
+        jobs.append(BatchJob(archive, output_root / _output_name(manifest, position), str(position)))
+    names = [job.output_dir for job in jobs]
+    if len(set(names)) != len(names):
+        raise Exception(f"Images of {archive} map to the same output directory: {names}")
+    return jobs
+
+
+def _layer_keys(image: ImageArchive) -> list[str] | None:
+    diff_ids = image.config.get("rootfs", {}).get("diff_ids", [])
+    return diff_ids if len(diff_ids) == len(image.layers) else None
+
+
+def shared_layers(jobs: list[BatchJob], platform: str | None = None) -> dict[str, tuple[BatchJob, int]]:
+    """
+    Reads the layer diff_ids of the jobs (when their image can be read in place), and
+    returns the layers used by more than one image, with a job and layer position to
+    extract each one from.
+    """
+    sources: dict[str, tuple[BatchJob, int]] = {}
+    counts: dict[str, int] = {}
+    for job in jobs:
+        if str(job.input_file) == "-":
+            raise Exception("Images of a batch can't be read from stdin")
+        with _open_seekable(job.input_file, platform, job.image) as image:
+            job.keys = _layer_keys(image) if image is not None else None
+        for key in dict.fromkeys(job.keys or []):
+            sources.setdefault(key, (job, job.keys.index(key)))
+            counts[key] = counts.get(key, 0) + 1
+    return {key: source for key, source in sources.items() if counts[key] > 1}
+
+
+def extract_shared_layer(
+    input_file: Path, image: str | None, position: int, key: str, platform: str | None, cache_dir: Path, decompressors
+):
+    """
+    Extracts a layer of an image into the batch cache. Runs in a worker process.
+    """
+    cache = LayerCache(cache_dir, math.inf)
+    with cache.lock(), _open_seekable(input_file, platform, image) as archive:
+        cache.extract(archive.layer_blobs()[position], key, decompressors)
+
+
+def _run(executor: ProcessPoolExecutor, tasks: dict, describe) -> list[str]:
+    """
+    Waits for the futures of `tasks` (mapped to their argument), logging progress.
+    Returns the descriptions of the failed tasks.
+    """
+    failed = []
+    pending = set(tasks)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Failed to {describe(tasks[future])}: {error}")
+                failed.append(describe(tasks[future]))
+            else:
+                logger.info(f"Done: {describe(tasks[future])} ({len(tasks) - len(pending)}/{len(tasks)})")
+    return failed
+
+
+def run_batch(
+    jobs: list[BatchJob],
+    unpack,
+    processes: int,
+    cache_dir: Path,
+    shared_cache: bool,
+    platform: str | None = None,
+    decompressors=(),
+):
+    """
+    Unpacks the jobs with `processes` worker processes, calling
+    `unpack(input_file, output_dir, image_name=..., cache_dir=...)` for each one.
+
+    The layers shared by several images are extracted into the layer cache at
+    `cache_dir` first. If the cache is private to the batch (`shared_cache` is False),
+    images without shared layers are unpacked directly, without going through it.
+    """
+    shared = shared_layers(jobs, platform)
+    logger.info(f"Unpacking {len(jobs)} images, with {len(shared)} layers shared between them")
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tasks = {
+            executor.submit(
+                extract_shared_layer, job.input_file, job.image, position, key, platform, cache_dir, decompressors
+            ): key
+            for key, (job, position) in shared.items()
+        }
+        failed = _run(executor, tasks, lambda key: f"extract shared layer {key}")
+
+        tasks = {}
+        for job in jobs:
+            # The layers of images that can't be read ahead may still be found in the cache
+            uses_cache = shared_cache or job.keys is None or any(key in shared for key in job.keys)
+            tasks[
+                executor.submit(
+                    unpack, job.input_file, job.output_dir, image_name=job.image, cache_dir=cache_dir if uses_cache else None
+                )
+            ] = job
+        failed += _run(executor, tasks, lambda job: f"unpack {job.input_file} to {job.output_dir}")
+
+    if failed:
+        raise Exception(f"{len(failed)} tasks of the batch failed: {', '.join(failed)}")
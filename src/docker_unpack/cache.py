@@ -0,0 +1,223 @@
+"""
+Content-addressed cache of extracted layers, shared across unpacks.
+
+Each layer is extracted once, as-is (whiteout markers included), under the cache
+directory and keyed by its diff_id. Unpacks then assemble their output from the
+cached layers with hardlinks, reflinks or `copy_file_range`, and only decompress
+the layers that aren't cached yet. The cache is bounded in size, evicting the
+least recently used layers first.
+
+Layout:
+- `layers/<algorithm>_<hex>/tree/`: the extracted layer
+- `layers/<algorithm>_<hex>/meta.json`: size, whiteout and directory metadata.
+  Its mtime is the last time the layer was used.
+- `blobs/<algorithm>_<hex>`: maps the digest of a layer blob to its diff_id
+- `tmp/`: layers being extracted
+- `lock`: held shared while layers are in use, and exclusively during eviction
+"""
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .layers import StagedLayer, extract_layer
+from .utils import TRANSFER_MODES, directory_attrs
+
+_DIGEST_RE = re.compile(r"^[a-z0-9]+:[a-f0-9]{32,}$")
+# docker save (and OCI layouts) store blobs under their digest
+_BLOB_NAME_RE = re.compile(r"(?:^|/)blobs/([a-z0-9]+)/([a-f0-9]{32,})$")
+
+
+def blob_digest(name: str) -> str | None:
+    """
+    Returns the digest of an archive member named after its digest, if it is.
+    """
+    match = _BLOB_NAME_RE.search(name)
+    return f"{match[1]}:{match[2]}" if match else None
+
+
+def _tree_size(path: Path) -> int:
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return size
+
+
+def dump_directories(directories: dict[str, tarfile.TarInfo]) -> dict:
+    return {
+        path: [m.mode, m.uid, m.gid, m.uname, m.gname, m.mtime]
+        for path, m in directories.items()
+    }
+
+
+def load_directories(data: dict) -> dict[str, tarfile.TarInfo]:
+    return {path: directory_attrs(path, *attrs) for path, attrs in data.items()}
+
+
+class LayerCache:
+    """
+    A size-bounded, content-addressed cache of extracted layers at `path`.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, link_mode: str = "hardlink"):
+        if link_mode not in TRANSFER_MODES:
+            raise Exception(f"Unknown cache link mode {link_mode!r}, expected one of {TRANSFER_MODES}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.link_mode = link_mode
+        self.layers_dir = path / "layers"
+        self.blobs_dir = path / "blobs"
+        self.tmp_dir = path / "tmp"
+        for d in (self.layers_dir, self.blobs_dir, self.tmp_dir):
+            d.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _entry_name(key: str) -> str:
+        if not _DIGEST_RE.match(key):
+            raise Exception(f"Invalid layer digest {key!r}")
+        return key.replace(":", "_")
+
+    @contextlib.contextmanager
+    def lock(self, exclusive: bool = False):
+        """
+        Holds the cache lock. Unpacks hold it shared while they link cached layers into
+        their output, so that eviction (which holds it exclusively) can't remove them.
+        """
+        with open(self.path / "lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key: str) -> StagedLayer | None:
+        """
+        Returns the cached layer with the given diff_id, if any, and marks it as used.
+        """
+        entry = self.layers_dir / self._entry_name(key)
+        try:
+            meta = json.loads((entry / "meta.json").read_text())
+        except FileNotFoundError:
+            return None
+        os.utime(entry / "meta.json")
+        return StagedLayer(
+            entry / "tree",
+            set(meta["dirty"]),
+            load_directories(meta["directories"]),
+            shared=True,
+        )
+
+    def lookup_blob(self, name: str) -> StagedLayer | None:
+        """
+        Returns the cached layer extracted from the blob with the given member name, if
+        the name contains the blob digest.
+        """
+        digest = blob_digest(name)
+        if digest is None:
+            return None
+        try:
+            key = (self.blobs_dir / self._entry_name(digest)).read_text()
+        except FileNotFoundError:
+            return None
+        return self.get(key)
+
+    def new_tmp_dir(self) -> Path:
+        return Path(tempfile.mkdtemp(dir=self.tmp_dir))
+
+    def insert(self, key: str, layer: StagedLayer, blob_name: str | None = None) -> StagedLayer:
+        """
+        Moves an extracted layer into the cache, and returns the cached layer.
+        """
+        entry = self.layers_dir / self._entry_name(key)
+        tmp_entry = self.new_tmp_dir()
+        try:
+            os.rename(layer.path, tmp_entry / "tree")
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copytree(layer.path, tmp_entry / "tree", symlinks=True)
+            shutil.rmtree(layer.path)
+
+        meta = {
+            "key": key,
+            "size": _tree_size(tmp_entry / "tree"),
+            "dirty": sorted(layer.dirty),
+            "directories": dump_directories(layer.directories),
+        }
+        (tmp_entry / "meta.json").write_text(json.dumps(meta))
+        try:
+            os.rename(tmp_entry, entry)
+            logger.info(f"Cached layer {key} ({meta['size']} bytes)")
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Another unpack cached the same layer concurrently
+            shutil.rmtree(tmp_entry)
+
+        digest = blob_digest(blob_name or "")
+        if digest is not None:
+            alias = self.blobs_dir / self._entry_name(digest)
+            alias.with_suffix(".tmp").write_text(key)
+            os.replace(alias.with_suffix(".tmp"), alias)
+
+        return self.get(key)
+
+    def extract(self, blob, key: str, decompressors=()):
+        """
+        Extracts a layer blob into the cache under `key` (its diff_id), unless it is
+        cached already.
+        """
+        if self.get(key) is not None:
+            return
+        layer = StagedLayer(self.new_tmp_dir())
+        with blob.open() as f:
+            extract_layer(f, layer, decompressors, blob.name)
+        self.insert(key, layer, blob.name)
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        """
+        Returns the (last use, size, path) of the cached layers.
+        """
+        entries = []
+        for entry in self.layers_dir.iterdir():
+            try:
+                meta_path = entry / "meta.json"
+                size = json.loads(meta_path.read_text())["size"]
+                entries.append((meta_path.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used layers until the cache fits in `max_bytes`.
+        """
+        # Waiting for the exclusive lock would stall behind concurrent unpacks, so
+        # it is only taken when there is something to evict
+        if sum(size for _, size, _ in self._entries()) <= self.max_bytes:
+            return
+        with self.lock(exclusive=True):
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                logger.info(f"Evicting cached layer {entry.name} ({size} bytes)")
+                (entry / "meta.json").unlink()
+                shutil.rmtree(entry)
+                total -= size
+
+            for alias in self.blobs_dir.iterdir():
+                key_entry = self.layers_dir / self._entry_name(alias.read_text())
+                if not key_entry.exists():
+                    alias.unlink()
@@ -0,0 +1,467 @@
+"""
+Random access to the files of an image, for `ls` and `cat`.
+
+Each layer is read once to build its index: its tar members, with the offset of
+their contents in the decompressed layer, and checkpoints from which decompression
+can resume. Checkpoints are placed at the start of gzip members and zstd frames,
+and at the sync flush points of gzip streams (where the deflate stream is
+byte-aligned, e.g. between the blocks compressed in parallel by pigz), along with
+the 32 KiB of output preceding them. The indexes are saved next to the image, so
+later lookups only decompress the bytes between the closest checkpoint and the
+file read.
+
+References:
+- https://github.com/madler/zlib/blob/v1.3.1/examples/zran.c
+"""
+
+import base64
+import bisect
+import collections
+import io
+import json
+import os
+import posixpath
+import stat
+import tarfile
+import time
+import typing
+import zlib
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .decompress import CHUNK_SIZE, open_decompressed, peek_comptype
+from .image import Blob, ImageArchive
+from .layers import OPAQUE_WHITEOUT, WHITEOUT_PREFIX, LayerIndex, parent_paths
+from .utils import MyTarFile, normalize_member_name
+
+# Suffix of the index saved next to an image
+INDEX_SUFFIX = ".docker-unpack-index"
+INDEX_VERSION = 1
+
+# Minimum decompressed bytes between two checkpoints
+CHECKPOINT_SPACING = 4 * 1024 * 1024
+
+_WINDOW_SIZE = 32 * 1024
+# End of the empty stored block written by a deflate sync flush
+_SYNC_MARKER = b"\x00\x00\xff\xff"
+# Output compared before a sync flush point is trusted as a checkpoint
+_VERIFY_BYTES = 64 * 1024
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+# Fields of the members stored in a layer index
+_NAME, _TYPE, _MODE, _UID, _GID, _SIZE, _MTIME, _LINKNAME, _OFFSET = range(9)
+
+# Kind of the first checkpoint of a layer, by compression type
+_START_KINDS = {"gz": "gzip", "zst": "zstd"}
+
+_FILE_TYPES = {
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+    tarfile.CHRTYPE: stat.S_IFCHR,
+    tarfile.BLKTYPE: stat.S_IFBLK,
+    tarfile.FIFOTYPE: stat.S_IFIFO,
+}
+
+# Symlinks followed while resolving a path, as in Linux
+_MAX_SYMLINKS = 40
+
+
+def _decompressor(kind: str, window: bytes = b""):
+    if kind == "gzip":
+        return zlib.decompressobj(31)
+    if kind == "deflate":
+        return zlib.decompressobj(-15, zdict=window)
+    import zstandard
+
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _inflate(fileobj, start: list, checkpoints: list | None = None) -> typing.Iterator[bytes]:
+    """
+    Yields the decompressed contents of a gzip or zstd layer from the checkpoint
+    `start`, with `fileobj` positioned at its compressed offset. When `checkpoints`
+    is given, the checkpoints found along the way are appended to it.
+    """
+    pos, out, kind, window = start
+    window = zlib.decompress(base64.b64decode(window)) if window else b""
+    is_gzip = kind != "zstd"
+    last = out
+    d = _decompressor(kind, window)
+    # The gzip trailer follows a member resumed from a sync flush point
+    raw = kind == "deflate"
+    # Bytes to skip before the next member or frame
+    skip = 0
+    # A candidate sync flush point: (decompressor, checkpoint, main output, its output)
+    trial = None
+    buf = b""
+
+    while True:
+        if len(buf) < 8:
+            data = fileobj.read(CHUNK_SIZE)
+            if not data and not buf:
+                return
+            buf += data
+        if d is None:
+            if skip:
+                n = min(skip, len(buf))
+                buf, pos, skip = buf[n:], pos + n, skip - n
+                continue
+            if not is_gzip and int.from_bytes(buf[:4], "little") & ~0xF == _ZSTD_SKIPPABLE_MAGIC:
+                skip = 8 + int.from_bytes(buf[4:8], "little")
+                continue
+            if not buf.startswith(b"\x1f\x8b" if is_gzip else b"\x28\xb5\x2f\xfd"):
+                # Padding after the last member
+                return
+            if checkpoints is not None and out - last >= CHECKPOINT_SPACING:
+                checkpoints.append([pos, out, kind, None])
+                last = out
+            d = _decompressor(kind)
+
+        # While indexing, gzip streams are fed up to each possible sync flush point
+        segment, marker = buf, False
+        if checkpoints is not None and is_gzip:
+            i = buf.find(_SYNC_MARKER)
+            if i >= 0:
+                segment, marker = buf[: i + len(_SYNC_MARKER)], True
+        data = d.decompress(segment)
+        used = len(segment) - len(d.unused_data) if d.eof else len(segment)
+        buf = buf[used:]
+        pos += used
+        out += len(data)
+
+        if checkpoints is not None and is_gzip:
+            if trial is not None:
+                trial_d, checkpoint, expected, got = trial
+                expected += data
+                try:
+                    got += trial_d.decompress(segment[:used])
+                except zlib.error:
+                    trial = None
+                else:
+                    n = min(len(expected), len(got))
+                    if expected[:n] != got[:n]:
+                        trial = None
+                    elif n >= _VERIFY_BYTES or d.eof:
+                        checkpoints.append(checkpoint)
+                        last = checkpoint[1]
+                        trial = None
+            window = (window + data)[-_WINDOW_SIZE:]
+            if trial is None and marker and used == len(segment) and not d.eof and out - last >= CHECKPOINT_SPACING:
+                checkpoint = [pos, out, "deflate", base64.b64encode(zlib.compress(window)).decode()]
+                trial = (zlib.decompressobj(-15, zdict=window), checkpoint, bytearray(), bytearray())
+
+        if data:
+            yield data
+        if d.eof:
+            d = None
+            trial = None
+            if raw:
+                skip, raw = 8, False
+            kind = "gzip" if is_gzip else "zstd"
+
+
+class _IteratorReader(io.RawIOBase):
+    """
+    Reads the chunks yielded by an iterator.
+    """
+
+    def __init__(self, chunks: typing.Iterator[bytes]):
+        self.chunks = chunks
+        self.chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+
+def index_layer(blob: Blob, decompressors: typing.Sequence[str] = ()) -> dict:
+    """
+    Reads a layer blob once, and returns its index: its members, with the offset of
+    their contents in the decompressed layer, and the checkpoints found in it.
+    """
+    with blob.open() as f:
+        comptype, f = peek_comptype(f)
+        checkpoints = [[0, 0, _START_KINDS.get(comptype, comptype), None]]
+        if comptype in _START_KINDS:
+            stream = io.BufferedReader(_IteratorReader(_inflate(f, checkpoints[0], checkpoints)), CHUNK_SIZE)
+            mode = "r|"
+        elif comptype == "tar":
+            stream, mode = f, "r:"
+        else:
+            # xz and bzip2 layers are always decompressed from the start
+            stream, mode = open_decompressed(f, decompressors, blob.name), "r|"
+
+        members = []
+        with stream, MyTarFile.open(fileobj=stream, mode=mode) as tar:
+            for m in tar:
+                members.append(
+                    [m.name, m.type.decode(), m.mode, m.uid, m.gid, m.size, m.mtime, m.linkname, m.offset_data]
+                )
+    return {"size": blob.size, "checkpoints": checkpoints, "members": members}
+
+
+def read_member(
+    blob: Blob, layer: dict, offset: int, size: int, decompressors: typing.Sequence[str] = ()
+) -> typing.Iterator[bytes]:
+    """
+    Yields `size` bytes of a layer from `offset` in its decompressed contents,
+    resuming decompression from the closest checkpoint.
+    """
+    checkpoints = layer["checkpoints"]
+    start = checkpoints[bisect.bisect_right([c[1] for c in checkpoints], offset) - 1]
+    with blob.open() as f:
+        if start[2] == "tar":
+            f.seek(offset)
+            chunks, skip = iter(lambda: f.read(min(CHUNK_SIZE, size)), b""), 0
+        elif start[2] in ("gzip", "deflate", "zstd"):
+            f.seek(start[0])
+            chunks, skip = _inflate(f, start), offset - start[1]
+        else:
+            f = open_decompressed(f, decompressors, blob.name)
+            chunks, skip = iter(lambda: f.read(CHUNK_SIZE), b""), offset
+
+        for chunk in chunks:
+            if size <= 0:
+                break
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            chunk = chunk[skip : skip + size]
+            skip = 0
+            size -= len(chunk)
+            yield chunk
+    if size > 0:
+        raise Exception(f"Unexpected end of {blob.name}, the index may be out of date")
+
+
+def _info(path: str, member: list) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(path)
+    info.type = member[_TYPE].encode()
+    info.mode, info.uid, info.gid, info.size, info.mtime = member[_MODE : _MTIME + 1]
+    info.linkname = member[_LINKNAME]
+    return info
+
+
+# Parents of the members that have no entry of their own
+_IMPLIED_DIR = [None, tarfile.DIRTYPE.decode(), 0o755, 0, 0, 0, 0, "", 0]
+
+
+class ImageCatalog:
+    """
+    The merged tree of an image, as it appears once unpacked, built from the indexes
+    of its layers (ordered bottom to top). Paths are relative to the root of the image.
+    """
+
+    def __init__(self, blobs: list[Blob], layers: list[dict], decompressors: typing.Sequence[str] = ()):
+        self.blobs = blobs
+        self.layers = layers
+        self.decompressors = decompressors
+        # Visible paths, and the layer and member they come from
+        self.entries: dict[str, tuple[int | None, list]] = {}
+        self._children: dict[str, list[str]] | None = None
+        self._layer_members: dict[int, dict[str, list]] = {}
+
+        # Resolve whiteouts top-down, as when unpacking
+        index = LayerIndex()
+        for i in reversed(range(len(layers))):
+            for member in layers[i]["members"]:
+                path = normalize_member_name(member[_NAME])
+                dirname, basename = posixpath.split(path)
+                if basename == OPAQUE_WHITEOUT:
+                    index.opaque(dirname)
+                elif basename.startswith(WHITEOUT_PREFIX):
+                    index.whiteout(posixpath.join(dirname, basename.removeprefix(WHITEOUT_PREFIX)))
+                elif path:
+                    isdir = member[_TYPE] == tarfile.DIRTYPE.decode()
+                    if not index.is_hidden(path):
+                        index.claim(path, isdir)
+                        self.entries[path] = (i, member)
+                    elif not isdir:
+                        # Still replaces the directories of the lower layers
+                        index.hide_children(path)
+            index.commit()
+
+        for path in list(self.entries):
+            for parent in parent_paths(path):
+                if not parent or parent in self.entries:
+                    break
+                self.entries[parent] = (None, _IMPLIED_DIR)
+
+    def resolve(self, path: str, follow: bool = True) -> str:
+        """
+        Returns the path of the entry at `path`, following symlinks within the image
+        (including the last component if `follow` is set).
+        """
+        parts = collections.deque(part for part in path.split("/") if part and part != ".")
+        resolved: list[str] = []
+        links = 0
+        while parts:
+            part = parts.popleft()
+            if part == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+            resolved.append(part)
+            entry = self.entries.get("/".join(resolved))
+            if entry is None:
+                raise Exception(f"{path}: no such file or directory in the image")
+            member = entry[1]
+            if member[_TYPE] == tarfile.SYMTYPE.decode() and (parts or follow):
+                links += 1
+                if links > _MAX_SYMLINKS:
+                    raise Exception(f"{path}: too many levels of symbolic links")
+                resolved.pop()
+                target = member[_LINKNAME]
+                if target.startswith("/"):
+                    resolved.clear()
+                parts.extendleft(reversed([p for p in target.split("/") if p and p != "."]))
+        return "/".join(resolved)
+
+    def stat(self, path: str) -> tarfile.TarInfo:
+        """
+        Returns the member at a resolved path.
+        """
+        return _info(path, self.entries[path][1])
+
+    def listdir(self, path: str) -> list[str]:
+        """
+        Returns the sorted names of the children of a resolved directory path.
+        """
+        if self._children is None:
+            self._children = {}
+            for entry in self.entries:
+                dirname, basename = posixpath.split(entry)
+                self._children.setdefault(dirname, []).append(basename)
+            for names in self._children.values():
+                names.sort()
+        if path and not self.stat(path).isdir():
+            raise Exception(f"/{path}: not a directory")
+        return self._children.get(path, [])
+
+    def walk(self, path: str, recursive: bool = False) -> typing.Iterator[str]:
+        """
+        Yields the paths of the children of a resolved path (or the path itself if it
+        isn't a directory), and of their descendants if `recursive` is set.
+        """
+        if path and not self.stat(path).isdir():
+            yield path
+            return
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            subdirs = []
+            for name in self.listdir(directory):
+                child = posixpath.join(directory, name)
+                yield child
+                if recursive and self.stat(child).isdir():
+                    subdirs.append(child)
+            pending += reversed(subdirs)
+
+    def _member_in_layer(self, i: int, name: str) -> list | None:
+        if i not in self._layer_members:
+            self._layer_members[i] = {normalize_member_name(m[_NAME]): m for m in self.layers[i]["members"]}
+        return self._layer_members[i].get(name)
+
+    def read(self, path: str) -> typing.Iterator[bytes]:
+        """
+        Yields the contents of the regular file at `path`, following symlinks.
+        """
+        path = self.resolve(path)
+        i, member = self.entries[path]
+        if member[_TYPE] == tarfile.LNKTYPE.decode():
+            # The target's data is in the same layer, even if an upper layer hides it
+            member = self._member_in_layer(i, normalize_member_name(member[_LINKNAME]))
+            if member is None:
+                raise Exception(f"/{path}: hardlink target not found in its layer")
+        if member[_TYPE].encode() not in tarfile.REGULAR_TYPES:
+            raise Exception(f"/{path}: not a regular file")
+        yield from read_member(self.blobs[i], self.layers[i], member[_OFFSET], member[_SIZE], self.decompressors)
+
+
+def format_entry(path: str, info: tarfile.TarInfo) -> str:
+    """
+    Formats an entry of the catalog as in `tar -tv`.
+    """
+    mode = stat.filemode(_FILE_TYPES.get(info.type, stat.S_IFREG) | info.mode)
+    mtime = time.strftime("%Y-%m-%d %H:%M", time.gmtime(info.mtime))
+    line = f"{mode} {info.uid}/{info.gid} {info.size:>10} {mtime} /{path}"
+    if info.issym():
+        line += f" -> {info.linkname}"
+    elif info.islnk():
+        line += f" link to /{normalize_member_name(info.linkname)}"
+    return line
+
+
+def index_path(input_path: Path) -> Path:
+    """
+    Returns the path of the index saved next to an image archive or layout.
+    """
+    input_path = Path(os.path.abspath(input_path))
+    return input_path.with_name(input_path.name + INDEX_SUFFIX)
+
+
+def _source(input_path: Path) -> dict | None:
+    """
+    Identifies the version of an image archive the index was built from. Blobs of
+    image layouts are named after their digest, so they never change.
+    """
+    if input_path.is_dir():
+        return None
+    st = input_path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def load_catalog(
+    image: ImageArchive,
+    input_path: Path,
+    path: Path | None = None,
+    decompressors: typing.Sequence[str] = (),
+) -> ImageCatalog:
+    """
+    Returns the catalog of an image. The layer indexes are read from `path` (by
+    default, next to the image), and the layers missing from it are indexed and
+    saved back to it.
+    """
+    path = path or index_path(input_path)
+    source = _source(input_path)
+    layers = {}
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get("version") == INDEX_VERSION and saved.get("source") == source:
+            layers = saved["layers"]
+        else:
+            logger.info(f"Index {path} is out of date, rebuilding it")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring unreadable index {path}: {e}")
+
+    blobs = image.layer_blobs()
+    missing = [blob for blob in blobs if layers.get(blob.name, {}).get("size") != blob.size]
+    for blob in missing:
+        logger.info(f"Indexing layer {blob.name}")
+        layers[blob.name] = index_layer(blob, decompressors)
+    if missing:
+        tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": INDEX_VERSION, "source": source, "layers": layers}, f)
+            os.replace(tmp_path, path)
+            logger.info(f"Saved the index of {len(layers)} layers to {path}")
+        except OSError as e:
+            logger.warning(f"Could not save the index to {path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    return ImageCatalog(blobs, [layers[blob.name] for blob in blobs], decompressors)
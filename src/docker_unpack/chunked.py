@@ -0,0 +1,502 @@
+"""
+Layers with a table of contents: eStargz and zstd:chunked.
+
+Both formats are valid gzip (eStargz) or zstd (zstd:chunked) compressed tarballs, in
+which the contents of regular files are compressed in separate chunks, and which
+end with a table of contents (TOC) listing the members and the offsets of their
+compressed chunks. When a seekable layer blob has one, its members are read from
+the TOC instead of the tar headers, and the chunks are decompressed by a thread
+pool ahead of the member being written. The chunks of files hidden by upper layers
+are never decompressed.
+
+References:
+- https://github.com/containerd/stargz-snapshotter/blob/v0.15.1/docs/estargz.md
+- https://github.com/containers/storage/blob/v1.55.0/pkg/chunked/internal/compression.go
+"""
+
+import base64
+import bisect
+import collections
+import dataclasses
+import datetime
+import io
+import json
+import os
+import re
+import struct
+import tarfile
+import time
+import typing
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .utils import MyTarFile, normalize_member_name
+
+if typing.TYPE_CHECKING:
+    from .stats import LayerStats
+
+# Name of the tar member holding the TOC of eStargz layers (the last member of the layer)
+ESTARGZ_TOC_NAME = "stargz.index.json"
+
+# The eStargz footer is an empty gzip member whose extra field holds "%016xSTARGZ" (the
+# offset of the TOC), in an "SG" subfield. Legacy stargz layers store it as the whole field.
+_ESTARGZ_FOOTER_SIZE = 51
+_LEGACY_STARGZ_FOOTER_SIZE = 47
+
+# The zstd:chunked footer is a skippable frame holding the offset, compressed and
+# uncompressed size and type of the manifest (the TOC), followed by a magic number.
+_ZSTD_SKIPPABLE_MAGIC = b"\x50\x2a\x4d\x18"
+_ZSTD_CHUNKED_MAGIC = b"GNUlInUx"
+_ZSTD_CHUNKED_FOOTER_SIZES = (64, 40)
+_ZSTD_CHUNKED_MANIFEST_TYPE = 1
+
+_TAIL_SIZE = 8 + max(_ZSTD_CHUNKED_FOOTER_SIZES)
+
+_TYPES = {
+    "reg": tarfile.REGTYPE,
+    "dir": tarfile.DIRTYPE,
+    "symlink": tarfile.SYMTYPE,
+    "hardlink": tarfile.LNKTYPE,
+    "char": tarfile.CHRTYPE,
+    "block": tarfile.BLKTYPE,
+    "fifo": tarfile.FIFOTYPE,
+}
+
+_RFC3339 = re.compile(r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)")
+
+# Chunks are decompressed in tasks of about this many (decompressed) bytes, so that
+# layers of small files don't pay the overhead of the thread pool for each one
+_TASK_BYTES = 1024 * 1024
+
+
+class _Chunk:
+    """
+    A chunk of the contents of a regular file. `start` is its position in the
+    contents of all the files of the layer, and its data is found `inner` bytes into
+    the decompressed stream at `offset` of the blob (which ends at `end`). Chunks
+    that don't need to be read from the blob hold their `data` instead, or are
+    `zeros`.
+    """
+
+    __slots__ = ("member", "start", "size", "offset", "end", "inner", "data", "zeros")
+
+    def __init__(self, member, start, size, offset=0, end=0, inner=0, data=None):
+        self.member = member
+        self.start = start
+        self.size = size
+        self.offset = offset
+        self.end = end
+        self.inner = inner
+        self.data = data
+        self.zeros = False
+
+
+@dataclasses.dataclass
+class TableOfContents:
+    """
+    The members of a layer, in order, and the chunks holding the contents of its
+    regular files. The `offset_data` of a regular file is its position in the
+    concatenated contents of all files (see `ChunkedLayer.fileobj`).
+    """
+
+    format: str
+    members: list[tarfile.TarInfo]
+    chunks: list[_Chunk]
+    decompress: typing.Callable[[bytes, int], bytes]
+
+
+def _inflate_gzip(data, size: int) -> bytes:
+    # A gzip member may hold several chunks, so it is only inflated as far as needed
+    return zlib.decompressobj(31).decompress(data, size)
+
+
+def _inflate_zstd(data, size: int) -> bytes:
+    import zstandard
+
+    parts, n = [], 0
+    while data and n < size:
+        dobj = zstandard.ZstdDecompressor().decompressobj()
+        parts.append(dobj.decompress(data))
+        n += len(parts[-1])
+        data = dobj.unused_data
+    return b"".join(parts)
+
+
+def _parse_mtime(value: str | None) -> int | float:
+    if not value:
+        return 0
+    match = _RFC3339.fullmatch(value)
+    if match is None:
+        raise Exception(f"Invalid modification time {value!r} in table of contents")
+    date, fraction, zone = match.groups()
+    seconds = int(datetime.datetime.fromisoformat(date + ("+00:00" if zone == "Z" else zone)).timestamp())
+    return seconds + float(f"0.{fraction}") if fraction and int(fraction) else seconds
+
+
+def _member(entry: dict) -> tarfile.TarInfo:
+    if entry.get("type") not in _TYPES:
+        raise Exception(f"Unsupported entry type {entry.get('type')!r} of {entry.get('name')!r} in table of contents")
+    info = tarfile.TarInfo(entry["name"])
+    info.type = _TYPES[entry["type"]]
+    if info.isdir():
+        info.name = info.name.rstrip("/")
+    info.size = entry.get("size", 0) if info.isreg() else 0
+    info.mode = entry.get("mode", 0)
+    info.mtime = _parse_mtime(entry.get("modtime"))
+    info.linkname = entry.get("linkName", "")
+    info.uid, info.gid = entry.get("uid", 0), entry.get("gid", 0)
+    info.uname, info.gname = entry.get("userName", ""), entry.get("groupName", "")
+    info.devmajor, info.devminor = entry.get("devMajor", 0), entry.get("devMinor", 0)
+    for key, value in (entry.get("xattrs") or {}).items():
+        info.pax_headers[f"SCHILY.xattr.{key}"] = base64.b64decode(value).decode("utf-8", "surrogateescape")
+    return info
+
+
+def _layout(entries: list[dict], chunk_end, extra=()) -> tuple[list[tarfile.TarInfo], list[_Chunk]]:
+    """
+    Returns the members of the TOC entries, and the chunks of their contents.
+    `chunk_end(entry)` returns the end of the compressed data of a chunk. `extra`
+    members (with their contents) are added at the end.
+    """
+    members, chunks = [], []
+    pos = 0
+    current = None
+    for entry in entries:
+        if entry.get("type") != "chunk":
+            current = _member(entry)
+            members.append(current)
+            if not current.isreg():
+                continue
+            current.offset_data = pos
+            pos += current.size
+            if not current.size:
+                continue
+        elif current is None or not current.isreg():
+            raise Exception(f"Chunk of {entry.get('name')!r} without a regular file in table of contents")
+
+        chunk_offset = entry.get("chunkOffset", 0)
+        start = current.offset_data + chunk_offset
+        if start != (chunks[-1].start + chunks[-1].size if chunks else 0):
+            raise Exception(f"Chunks of {current.name!r} are not contiguous in table of contents")
+        size = entry.get("chunkSize") or current.size - chunk_offset
+        chunk = _Chunk(current, start, size)
+        if entry.get("chunkType") == "zeros":
+            # Holes are still compressed in the blob, but there is no need to read them
+            chunk.zeros = True
+        else:
+            chunk.offset, chunk.end, chunk.inner = entry["offset"], chunk_end(entry), entry.get("innerOffset", 0)
+        chunks.append(chunk)
+    if chunks and chunks[-1].start + chunks[-1].size != pos:
+        raise Exception(f"Chunks of {current.name!r} don't cover its contents in table of contents")
+
+    for member, data in extra:
+        member.offset_data = pos
+        members.append(member)
+        if data:
+            chunks.append(_Chunk(member, pos, len(data), data=data))
+            pos += len(data)
+    return members, chunks
+
+
+def _read_at(fileobj, offset: int, size: int) -> bytes:
+    fileobj.seek(offset)
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise tarfile.ReadError("unexpected end of data")
+    return data
+
+
+def _estargz_toc_offset(tail: bytes) -> tuple[int, int] | None:
+    """
+    Returns the offset of the TOC and the size of the footer of an eStargz (or
+    legacy stargz) layer, or None if `tail` doesn't end with such a footer.
+    """
+    for footer_size, subfield in ((_ESTARGZ_FOOTER_SIZE, True), (_LEGACY_STARGZ_FOOTER_SIZE, False)):
+        footer = tail[-footer_size:]
+        if len(footer) != footer_size or not footer.startswith(b"\x1f\x8b\x08\x04"):
+            continue
+        (xlen,) = struct.unpack_from("<H", footer, 10)
+        extra = footer[12 : 12 + xlen]
+        if subfield:
+            if extra[:2] != b"SG" or extra[2:4] != struct.pack("<H", 22):
+                continue
+            extra = extra[4:]
+        if len(extra) == 22 and extra.endswith(b"STARGZ"):
+            return int(extra[:16], 16), footer_size
+    return None
+
+
+def _zstd_chunked_manifest(tail: bytes) -> tuple[int, int, int] | None:
+    """
+    Returns the offset, compressed and uncompressed size of the manifest of a
+    zstd:chunked layer, or None if `tail` doesn't end with its footer.
+    """
+    if not tail.endswith(_ZSTD_CHUNKED_MAGIC):
+        return None
+    for footer_size in _ZSTD_CHUNKED_FOOTER_SIZES:
+        if tail[-footer_size - 8 : -footer_size] == _ZSTD_SKIPPABLE_MAGIC + struct.pack("<I", footer_size):
+            offset, length, uncompressed, manifest_type = struct.unpack_from("<4Q", tail, len(tail) - footer_size)
+            if manifest_type != _ZSTD_CHUNKED_MANIFEST_TYPE:
+                raise Exception(f"Unsupported zstd:chunked manifest type {manifest_type}")
+            return offset, length, uncompressed
+    return None
+
+
+def _read_tail(fileobj) -> tuple[bytes, int]:
+    size = fileobj.seek(0, os.SEEK_END)
+    tail = _read_at(fileobj, max(0, size - _TAIL_SIZE), min(size, _TAIL_SIZE))
+    fileobj.seek(0)
+    return tail, size
+
+
+def has_toc(fileobj) -> bool:
+    """
+    Returns whether a layer blob ends with the footer of a TOC. Non-seekable
+    streams are never read through their TOC.
+    """
+    if not fileobj.seekable():
+        return False
+    tail, _ = _read_tail(fileobj)
+    return _estargz_toc_offset(tail) is not None or _zstd_chunked_manifest(tail) is not None
+
+
+def read_toc(fileobj) -> TableOfContents | None:
+    """
+    Reads the TOC of a seekable eStargz or zstd:chunked layer blob. Returns None for
+    other layers.
+    """
+    if not fileobj.seekable():
+        return None
+    tail, size = _read_tail(fileobj)
+
+    if (found := _estargz_toc_offset(tail)) is not None:
+        toc_offset, footer_size = found
+        data = zlib.decompress(_read_at(fileobj, toc_offset, size - footer_size - toc_offset), 31)
+        with MyTarFile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+            toc_member = tar.next()
+            if toc_member is None or toc_member.name != ESTARGZ_TOC_NAME:
+                raise Exception(f"Expected {ESTARGZ_TOC_NAME} at the offset in the eStargz footer")
+            toc_data = tar.extractfile(toc_member).read()
+        entries = json.loads(toc_data)["entries"]
+
+        # The compressed data of a chunk ends where the next one (or the TOC) begins
+        offsets = sorted({entry["offset"] for entry in entries if entry.get("offset")} | {toc_offset})
+
+        def chunk_end(entry):
+            return offsets[bisect.bisect_right(offsets, entry["offset"])]
+
+        # The TOC is also the last member of the layer, and ends up in the output when
+        # the layer is extracted as a plain tarball
+        members, chunks = _layout(entries, chunk_end, [(toc_member, toc_data)])
+        return TableOfContents("estargz", members, chunks, _inflate_gzip)
+
+    if (found := _zstd_chunked_manifest(tail)) is not None:
+        import zstandard
+
+        offset, length, uncompressed = found
+        manifest = zstandard.ZstdDecompressor().decompress(
+            _read_at(fileobj, offset, length), max_output_size=uncompressed
+        )
+        members, chunks = _layout(json.loads(manifest)["entries"], lambda entry: entry["endOffset"])
+        return TableOfContents("zstd:chunked", members, chunks, _inflate_zstd)
+
+    return None
+
+
+class _ContentReader:
+    """
+    Reads the concatenated contents of the regular files of a layer, decompressing
+    its chunks with up to `jobs` threads. The `wanted` chunks (indices, ascending) are
+    decompressed ahead of the read position, with at most `max_bytes` buffered; the
+    others are decompressed on demand.
+    """
+
+    def __init__(self, fileobj, toc: TableOfContents, jobs: int, max_bytes: int, wanted: list[int], stats):
+        self.raw = fileobj
+        self.toc = toc
+        self.chunks = toc.chunks
+        self.starts = [chunk.start for chunk in self.chunks]
+        self.size = self.chunks[-1].start + self.chunks[-1].size if self.chunks else 0
+        self.wanted = wanted
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="chunk") if jobs > 1 else None
+        # Tasks submitted to the executor: (first chunk, last chunk, bytes, future)
+        self.tasks: collections.deque[tuple[int, int, int, Future]] = collections.deque()
+        self.buffered = 0
+        # Position in `wanted` of the next chunk to submit
+        self.next = 0
+        self.pos = 0
+        self.current: tuple[int, bytes] = (-1, b"")
+        self._submit(0)
+
+    def close(self):
+        if self.executor is not None:
+            for task in self.tasks:
+                task[3].cancel()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.tasks.clear()
+
+    def _read_compressed(self, indices: list[int]) -> list[tuple[int, bytes]]:
+        """
+        Reads the compressed data of chunks, merging adjacent ranges. Returns the
+        ranges read, as (offset, data).
+        """
+        spans = []
+        for i in indices:
+            chunk = self.chunks[i]
+            if chunk.data is not None or chunk.zeros:
+                continue
+            if spans and chunk.offset <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], chunk.end)
+            else:
+                spans.append([chunk.offset, chunk.end])
+        return [(start, _read_at(self.raw, start, end - start)) for start, end in spans]
+
+    def _decompress(self, indices: list[int], spans: list[tuple[int, bytes]]) -> dict[int, bytes]:
+        # Chunks sharing a compressed stream (see `innerOffset`) decompress it once
+        limits: dict[int, int] = {}
+        for i in indices:
+            chunk = self.chunks[i]
+            limits[chunk.offset] = max(limits.get(chunk.offset, 0), chunk.inner + chunk.size)
+        span_starts = [start for start, _ in spans]
+
+        results = {}
+        stream_offset, stream = None, b""
+        for i in indices:
+            chunk = self.chunks[i]
+            if chunk.data is not None:
+                results[i] = chunk.data
+                continue
+            if chunk.zeros:
+                results[i] = bytes(chunk.size)
+                continue
+            if chunk.offset != stream_offset:
+                start, data = spans[bisect.bisect_right(span_starts, chunk.offset) - 1]
+                compressed = memoryview(data)[chunk.offset - start : chunk.end - start]
+                stream_offset, stream = chunk.offset, self.toc.decompress(compressed, limits[chunk.offset])
+            if len(stream) < chunk.inner + chunk.size:
+                raise tarfile.ReadError(f"unexpected end of data in {chunk.member.name}")
+            if chunk.inner == 0 and len(stream) == chunk.size:
+                results[i] = stream
+            else:
+                results[i] = stream[chunk.inner : chunk.inner + chunk.size]
+        return results
+
+    def _submit(self, index: int):
+        """
+        Submits the wanted chunks from `index` on, within the buffer budget.
+        """
+        if self.executor is None:
+            return
+        while self.next < len(self.wanted) and self.wanted[self.next] < index:
+            self.next += 1
+        while self.next < len(self.wanted):
+            end, size = self.next, 0
+            while end < len(self.wanted) and size < _TASK_BYTES:
+                size += self.chunks[self.wanted[end]].size
+                end += 1
+            if self.tasks and self.buffered + size > self.max_bytes:
+                return
+            indices = self.wanted[self.next : end]
+            future = self.executor.submit(self._decompress, indices, self._read_compressed(indices))
+            self.tasks.append((indices[0], indices[-1], size, future))
+            self.buffered += size
+            self.next = end
+
+    def _chunk_data(self, index: int) -> bytes:
+        # Chunks before `index` won't be read anymore (except by seeking back)
+        while self.tasks and self.tasks[0][1] < index:
+            self.buffered -= self.tasks.popleft()[2]
+        self._submit(index)
+        if self.tasks and self.tasks[0][0] <= index:
+            data = self.tasks[0][3].result().get(index)
+            if data is not None:
+                return data
+        return self._decompress([index], self._read_compressed([index]))[index]
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def read(self, size=-1) -> bytes:
+        if size < 0:
+            size = self.size - self.pos
+        parts = []
+        while size > 0 and self.pos < self.size:
+            index, data = self.current
+            if index < 0 or not self.starts[index] <= self.pos < self.starts[index] + len(data):
+                index = bisect.bisect_right(self.starts, self.pos) - 1
+                start = time.perf_counter()
+                data = self._chunk_data(index)
+                if self.stats is not None:
+                    self.stats.read_seconds += time.perf_counter() - start
+                self.current = (index, data)
+            offset = self.pos - self.starts[index]
+            part = data if offset == 0 and size >= len(data) else data[offset : offset + size]
+            parts.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        if self.stats is not None:
+            self.stats.bytes += sum(map(len, parts))
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+class ChunkedLayer:
+    """
+    The members of a layer read through its TOC, with the interface of a
+    `tarfile.TarFile` read as a stream (as used by `MemberWriter`): members are
+    iterated in order, and the contents of a regular file are read from `fileobj` at
+    its `offset_data`. The contents of members for which `skip(path)` is true are
+    only decompressed if they are read anyway.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        toc: TableOfContents,
+        jobs: int = 1,
+        max_bytes: int = 512 * 1024 * 1024,
+        stats: "LayerStats | None" = None,
+        skip: typing.Callable[[str], bool] | None = None,
+    ):
+        self.members = toc.members
+        hidden = set()
+        if skip is not None:
+            hidden = {m for m in self.members if m.isreg() and skip(normalize_member_name(m.name))}
+        wanted = [i for i, chunk in enumerate(toc.chunks) if chunk.member not in hidden]
+        self.fileobj = _ContentReader(fileobj, toc, jobs, max_bytes, wanted, stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __iter__(self) -> typing.Iterator[tarfile.TarInfo]:
+        return iter(self.members)
+
+    def extractfile(self, member: tarfile.TarInfo):
+        # Callers read exactly `member.size` bytes (as `TarFile.addfile` does)
+        self.fileobj.seek(member.offset_data)
+        return self.fileobj
+
+    def extract(self, member: tarfile.TarInfo, path):
+        # Only members without contents (devices, fifos) are extracted by tarfile, from
+        # an archive of their header alone
+        with MyTarFile.open(fileobj=io.BytesIO(member.tobuf(tarfile.PAX_FORMAT)), mode="r:") as tar:
+            tar.extract(tar.next(), path)
@@ -1,6 +1,9 @@
+import contextlib
+import functools
 import json
 import os
-import tarfile
+import shutil
+import sys
 import tempfile
 from pathlib import Path
 
@@ -11,8 +14,23 @@ set_up_logging()
 from watcloud_utils.typer import app, typer
 
 from ._version import __version__
-from .utils import generate_env, generate_runscript, MyTarFile, StreamProxy
+from .analysis import analyze_layers, format_report, read_headers
+from .utils import generate_env, generate_runscript, StreamProxy, TRANSFER_MODES
 from .apptainer_base_env import make_base_env
+from .batch import expand_archive, read_job_list, run_batch
+from .cache import LayerCache
+from .catalog import INDEX_SUFFIX, format_entry, load_catalog
+from .decompress import BACKENDS
+from .durability import DURABILITY_MODES, check_durability, syncfs
+from .filters import PathFilter, read_patterns
+from .flatten import read_spooled, write_flat_tar
+from .image import open_directory, open_indexed, read_streaming
+from .journal import Journal
+from .layers import JOURNAL_NAME, StagedLayers, apply_layers
+from .manifest import HASHES, Manifest
+from .stats import STATS, collect_stats
+from .state import STATE_PATH, common_prefix, layer_chain, read_state, write_state
+from .verify import expected_digests
 
 
 @app.command()
@@ -22,66 +40,570 @@ def version():
     """
     print(__version__)
 
-@app.command()
-def unpack(input_file: typer.FileBinaryRead, output_dir: Path):
-    if output_dir.exists() and any(output_dir.iterdir()):
-        raise Exception(
-            f"Output directory {output_dir} already exists and is not empty!"
-        )
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        logger.info(f"Extracting tar file to {temp_dir=}")
-        input_file_proxy = StreamProxy(input_file)
-        with MyTarFile.open(fileobj=input_file_proxy, mode=f"r{'|' if input_file_proxy.supports_streaming() else ':'}{input_file_proxy.getcomptype()}") as tar:
-            tar.extractall(temp_dir)
+def _layer_keys(image) -> list[str] | None:
+    """
+    Returns the diff_ids of the image layers, which key the layer cache.
+    """
+    diff_ids = image.config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(image.layers):
+        logger.warning(f"Expected {len(image.layers)} diff_ids in the image config, got {len(diff_ids)}. Not caching layers.")
+        return None
+    return diff_ids
+
+
+def _rebuild_dir(output_dir: Path) -> Path:
+    """
+    Creates an empty directory next to `output_dir`, to rebuild it from scratch.
+    """
+    rebuild_root = output_dir.with_name(f".{output_dir.name}.rebuild-{os.getpid()}")
+    rebuild_root.mkdir()
+    return rebuild_root
+
+
+def _open_input(input_file: Path, platform: str | None, image_name: str | None, stack: contextlib.ExitStack):
+    """
+    Opens the input of `unpack`. Returns the image, if its layer blobs can be read in
+    place (image layouts and uncompressed archives), and the input stream otherwise.
+    """
+    if input_file.is_dir():
+        # Layer blobs are read in place from the image layout
+        logger.info(f"Reading image layout {input_file}")
+        with STATS.phase("index"):
+            return open_directory(str(input_file), platform, image_name), None
+
+    input_stream = sys.stdin.buffer if str(input_file) == "-" else stack.enter_context(open(input_file, "rb"))
+    if input_stream.seekable() and StreamProxy(input_stream).getcomptype() == "tar":
+        # Layer blobs are read in place from the archive
+        logger.info(f"Indexing image archive {input_file}")
+        with STATS.phase("index"):
+            return open_indexed(input_stream, platform, image_name), input_stream
+    if input_stream.seekable():
+        input_stream.seek(0)
+    return None, input_stream
+
 
-        manifest_path = Path(temp_dir) / "manifest.json"
-        logger.info(f"Reading manifest from {manifest_path=}")
+def _path_filter(include: list[str], exclude: list[str], include_from: Path | None, exclude_from: Path | None):
+    include = include + (read_patterns(include_from) if include_from else [])
+    exclude = exclude + (read_patterns(exclude_from) if exclude_from else [])
+    return PathFilter(include, exclude) if include or exclude else None
 
-        manifests = json.loads(manifest_path.read_text())
-        if len(manifests) != 1:
-            raise Exception(f"Expected exactly one manifest, got {len(manifests)}")
 
-        manifest = manifests[0]
-        logger.debug(json.dumps(manifest, indent=2))
+def _unpack_to_tar(
+    input_file: Path, platform, image_name, jobs: int, readahead_bytes: int, decompressor, path_filter, manifest, verify
+):
+    """
+    Writes the unpacked image to stdout as a single tar stream.
+    """
+    with contextlib.ExitStack() as stack:
+        image, input_stream = _open_input(input_file, platform, image_name, stack)
+        if image is not None:
+            blobs = image.layer_blobs()
+        else:
+            logger.info(f"Streaming image archive {input_file}, spooling its layers")
+            spool_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="docker-unpack-"))
+            with STATS.phase("stream"):
+                image, blobs = read_spooled(input_stream, spool_dir, platform, image_name, decompressor)
+        with STATS.phase("apply"):
+            write_flat_tar(
+                blobs,
+                image.config["config"],
+                sys.stdout.buffer,
+                jobs,
+                readahead_bytes,
+                decompressor,
+                path_filter,
+                manifest,
+                expected_digests(image) if verify else None,
+            )
+
+
+def _replace_dir(output_dir: Path, new_dir: Path):
+    old_dir = output_dir.with_name(f".{output_dir.name}.old-{os.getpid()}")
+    os.rename(output_dir, old_dir)
+    os.rename(new_dir, output_dir)
+    shutil.rmtree(old_dir)
+
+
+@app.command()
+def unpack(
+    input_file: Path = typer.Argument(
+        ...,
+        help="Image to unpack: a `docker save` or OCI archive (optionally compressed), an OCI image "
+        "layout directory, or - for stdin.",
+    ),
+    output_dir: Path = typer.Argument(
+        ..., help="Directory to unpack the image to, or - to write it to stdout as a single tar stream."
+    ),
+    platform: str = typer.Option(
+        None,
+        help="Platform (os/arch[/variant]) of the image to unpack from a multi-platform OCI index. "
+        "Defaults to the host platform.",
+    ),
+    image_name: str = typer.Option(
+        None,
+        "--image",
+        help="Image to unpack from an archive holding several images, by tag or position (from 0).",
+    ),
+    jobs: int = typer.Option(
+        min(8, os.cpu_count() or 1), help="Number of layers to decompress concurrently."
+    ),
+    readahead_mb: int = typer.Option(
+        512, help="Maximum memory (in MiB) used to buffer layers decompressed ahead."
+    ),
+    write_jobs: int = typer.Option(
+        1,
+        help="Number of threads writing files. Helps on filesystems with high per-file latency "
+        "(e.g. network or overlay filesystems).",
+    ),
+    decompressor: list[str] = typer.Option(
+        [],
+        help=f"Preferred decompression backend (repeatable). Available: {', '.join(BACKENDS)}. "
+        "By default, the fastest installed backend is used.",
+    ),
+    cache_dir: Path = typer.Option(
+        None, help="Directory of a layer cache shared across unpacks. Disabled by default."
+    ),
+    cache_max_gb: float = typer.Option(50, help="Maximum size of the layer cache, in GiB."),
+    cache_link: str = typer.Option(
+        "hardlink",
+        help=f"How files are transferred from the layer cache ({', '.join(TRANSFER_MODES)}). "
+        "Hardlinked files share their inode with the cache, so they must not be modified in place.",
+    ),
+    update: bool = typer.Option(
+        False,
+        help="Update an output directory previously unpacked by this tool, applying only the layers "
+        "added on top of the ones it was unpacked from. If lower layers changed, it is rebuilt.",
+    ),
+    include: list[str] = typer.Option(
+        [],
+        help="Only unpack the paths matching this glob (repeatable), e.g. `usr/lib/**`. A `**` component "
+        "matches any number of directories, and patterns without a slash match names at any depth.",
+    ),
+    exclude: list[str] = typer.Option(
+        [], help="Don't unpack the paths matching this glob (repeatable), e.g. `usr/share/doc` or `*.pyc`."
+    ),
+    include_from: Path = typer.Option(None, help="File of --include patterns, one per line."),
+    exclude_from: Path = typer.Option(None, help="File of --exclude patterns, one per line."),
+    manifest_path: Path = typer.Option(
+        None,
+        "--manifest",
+        help="Write a manifest of the unpacked tree (path, mode, size and digest of each entry, one JSON array "
+        "per line) to this file. File contents are hashed as they are extracted.",
+    ),
+    manifest_hash: str = typer.Option("sha256", help=f"Hash of the --manifest digests ({', '.join(HASHES)})."),
+    verify: bool = typer.Option(
+        True,
+        help="Check the digest and diff_id of each layer against the image while it is decompressed. "
+        "Layers read through their table of contents and layers from the cache are not checked.",
+    ),
+    durability: str = typer.Option(
+        "end",
+        help=f"When the unpacked files are flushed to disk ({', '.join(DURABILITY_MODES)}): never, with one "
+        "syncfs once the tree is complete (before the state record is written), or also with an fsync per file.",
+    ),
+    sparse: bool = typer.Option(
+        False,
+        help="Leave the all-zero blocks of extracted files as holes, to save disk writes and space on "
+        "images with large zero-filled files. Sparse tar members are always extracted as sparse files.",
+    ),
+    resume: bool = typer.Option(
+        False,
+        help="Resume an interrupted unpack of the same image into the output directory from its last "
+        "completed layer. Starts from scratch if the output directory is empty.",
+    ),
+    stats_json: Path = typer.Option(
+        None, help="Write timings, per-layer counters and peak memory of the unpack to this JSON file."
+    ),
+    profile: Path = typer.Option(None, help="Profile the unpack with cProfile and dump the stats to this file."),
+    trace_memory: Path = typer.Option(
+        None, help="Trace allocations with tracemalloc and dump a snapshot to this file."
+    ),
+):
+    path_filter = _path_filter(include, exclude, include_from, exclude_from)
+    filters = path_filter.to_dict() if path_filter else None
+    manifest = Manifest(manifest_hash) if manifest_path is not None else None
+    check_durability(durability)
+    sync = durability == "strict"
+
+    if str(output_dir) == "-":
+        if update or resume or cache_dir is not None:
+            raise Exception("--update, --resume and --cache-dir can't be used when writing the image to stdout")
+        with collect_stats(stats_json, profile, trace_memory):
+            _unpack_to_tar(
+                input_file,
+                platform,
+                image_name,
+                jobs,
+                readahead_mb * 1024 * 1024,
+                decompressor,
+                path_filter,
+                manifest,
+                verify,
+            )
+            if manifest is not None:
+                with STATS.phase("manifest"):
+                    manifest.write(manifest_path, sync=durability != "none")
+        return
 
-        config_path = Path(temp_dir) / manifest["Config"]
-        logger.info(f"Reading config from {config_path=}")
+    if update and resume:
+        raise Exception("--update and --resume can't be used together")
 
-        config = json.loads(config_path.read_text())
-        logger.debug(json.dumps(config, indent=2))
+    old_chain = None
+    filters_changed = False
+    journal = None
+    if resume and (journal := Journal.open(output_dir, sync)) is not None:
+        logger.info(f"Resuming the interrupted unpack to {output_dir}")
+        # The unpack may have been interrupted after marking the output complete
+        (output_dir / STATE_PATH).unlink(missing_ok=True)
+    elif output_dir.exists() and any(output_dir.iterdir()):
+        if resume:
+            raise Exception(f"Output directory {output_dir} is not empty and has no journal to resume from!")
+        if not update:
+            raise Exception(
+                f"Output directory {output_dir} already exists and is not empty!"
+            )
+        state = read_state(output_dir)
+        if state is None:
+            raise Exception(
+                f"Output directory {output_dir} is not empty and has no {STATE_PATH} to update from!"
+            )
+        old_chain = state["layers"]
+        old_filters = state.get("filters")
+        filters_changed = old_filters != filters
+        # The state record is only valid once the update completes
+        (output_dir / STATE_PATH).unlink()
 
+    with collect_stats(stats_json, profile, trace_memory), contextlib.ExitStack() as stack:
         extracted_root = output_dir
+        extracted_root.mkdir(parents=True, exist_ok=True)
+        readahead_bytes = readahead_mb * 1024 * 1024
 
-        for layer in manifest["Layers"]:
-            layer_path = Path(temp_dir) / layer
-            logger.info(f"Extracting {layer_path=}")
+        cache = None
+        if cache_dir is not None:
+            cache = LayerCache(cache_dir, cache_max_gb * 1024**3, cache_link)
 
-            with open(layer_path, "rb") as f:
-                comptype = StreamProxy(f).getcomptype()
+        image, input_stream = _open_input(input_file, platform, image_name, stack)
 
-            with MyTarFile.open(layer_path, f"r:{comptype}") as tar:
-                for member in tar:
-                    basename = os.path.basename(member.name)
+        def start_journal(mode: str, layers: list[dict] | None) -> Journal | None:
+            # Updates aren't journaled: the layers they keep were applied by an earlier unpack
+            if old_chain is not None:
+                return None
+            if journal is not None:
+                journal.check(mode, layers, filters)
+                return stack.enter_context(contextlib.closing(journal))
+            return stack.enter_context(
+                contextlib.closing(
+                    Journal.create(extracted_root, {"mode": mode, "layers": layers, "filters": filters}, sync)
+                )
+            )
 
-                    if basename.startswith(".wh."):
-                        # This is a whiteout file, used to indicate that a file is removed
-                        orig_file_path = Path(member.name).with_name(
-                            basename.removeprefix(".wh.")
+        # Layers below `base` are already applied to the output directory
+        base = 0
+        rebuild_root = None
+        with cache.lock() if cache is not None else contextlib.nullcontext():
+            if image is not None:
+                keys = _layer_keys(image) if cache is not None else None
+                if old_chain is not None:
+                    base = common_prefix(old_chain, layer_chain(image))
+                    if base < len(old_chain) or filters_changed:
+                        logger.info(f"Lower layers or path filters of {output_dir} changed, rebuilding it")
+                        rebuild_root = _rebuild_dir(output_dir)
+                        base = 0
+                    else:
+                        logger.info(f"Reusing {base} layers already applied to {output_dir}")
+                if keys is None and (old_chain is None or rebuild_root is not None):
+                    with STATS.phase("apply"):
+                        apply_layers(
+                            image.layer_blobs(),
+                            rebuild_root or extracted_root,
+                            jobs,
+                            readahead_bytes,
+                            decompressor,
+                            write_jobs,
+                            path_filter,
+                            manifest,
+                            expected_digests(image) if verify else None,
+                            sync,
+                            start_journal("apply", layer_chain(image)),
+                            sparse,
                         )
-                        logger.debug(f"Removing {orig_file_path} from {extracted_root}")
-                        if (extracted_root / orig_file_path).is_dir():
-                            (extracted_root / orig_file_path).rmdir()
-                        else:
-                            (extracted_root / orig_file_path).unlink()
+                else:
+                    staged = StagedLayers(
+                        extracted_root,
+                        jobs,
+                        readahead_bytes,
+                        decompressor,
+                        cache,
+                        write_jobs=write_jobs,
+                        path_filter=path_filter,
+                        manifest=manifest,
+                        verify=verify,
+                        expected=expected_digests(image) if verify else None,
+                        sync=sync,
+                        journal=start_journal("staged", layer_chain(image)),
+                        sparse=sparse,
+                    )
+                    with STATS.phase("stage"):
+                        for blob, key in zip(image.layer_blobs()[base:], (keys or [None] * len(image.layers))[base:]):
+                            staged.stage_blob(blob, key)
+                        staged.wait()
+                    with STATS.phase("merge"):
+                        staged.merge(image.layers[base:], root=rebuild_root)
+            else:
+                # Layer blobs are extracted as they arrive, and merged once the manifest is read
+                logger.info(f"Streaming image archive {input_file}")
+                skip = {layer["name"] for layer in old_chain or []} if not filters_changed else set()
+                staged = StagedLayers(
+                    extracted_root,
+                    jobs,
+                    readahead_bytes,
+                    decompressor,
+                    cache,
+                    skip,
+                    write_jobs,
+                    path_filter,
+                    manifest,
+                    verify,
+                    sync=sync,
+                    journal=start_journal("staged", None),
+                    sparse=sparse,
+                )
+                with STATS.phase("stream"):
+                    image = read_streaming(input_stream, staged.stage, platform, image_name, decompressor)
+                    staged.wait()
+                    if verify:
+                        staged.check(expected_digests(image))
+                keys = _layer_keys(image) if cache is not None else None
+                if old_chain is not None:
+                    base = common_prefix(old_chain, layer_chain(image))
+                    if base < len(old_chain) or filters_changed:
+                        logger.info(f"Lower layers or path filters of {output_dir} changed, rebuilding it")
+                        rebuild_root = _rebuild_dir(output_dir)
+                        base = 0
                     else:
-                        logger.debug(f"Extracting {member.name} to {extracted_root}")
-                        tar.extract(member, extracted_root)
+                        logger.info(f"Reusing {base} layers already applied to {output_dir}")
+                    missing = [name for name in image.layers[base:] if name not in staged.layers]
+                    if missing:
+                        staged.wait()
+                        shutil.rmtree(staged.staging, ignore_errors=True)
+                        if rebuild_root is not None:
+                            shutil.rmtree(rebuild_root)
+                        # Nothing was applied, so the output directory is still valid
+                        write_state(output_dir, old_chain, **({"filters": old_filters} if old_filters else {}))
+                        raise Exception(
+                            f"Layers {missing} were skipped while streaming the image, but are needed to "
+                            f"update {output_dir}. Unpack from a seekable archive, or without --update."
+                        )
+                with STATS.phase("merge"):
+                    staged.merge(image.layers[base:], keys[base:] if keys else None, rebuild_root)
+
+        if rebuild_root is not None:
+            _replace_dir(output_dir, rebuild_root)
+
+        if cache is not None:
+            with STATS.phase("cache_evict"):
+                cache.evict()
 
         logger.info(f"Done extracting layers to {extracted_root}")
 
-        make_base_env(extracted_root)
-        generate_runscript(extracted_root, config["config"])
-        generate_env(extracted_root, config["config"])
+        with STATS.phase("base_env"):
+            make_base_env(extracted_root, sync, runscript=False)
+            generate_runscript(extracted_root, image.config["config"], sync)
+            generate_env(extracted_root, image.config["config"], sync)
+
+        if durability != "none":
+            with STATS.phase("sync"):
+                # The tree reaches the disk before the state record marks it complete
+                syncfs(extracted_root)
+        write_state(
+            extracted_root, layer_chain(image), durability != "none", **({"filters": filters} if filters else {})
+        )
+        # The journal of the unpack is not needed anymore
+        (extracted_root / JOURNAL_NAME).unlink(missing_ok=True)
+
+        if manifest is not None:
+            with STATS.phase("manifest"):
+                manifest.write(manifest_path, extracted_root, durability != "none")
 
         logger.info(f"Succesfully unpacked image to {extracted_root}")
+
+
+def _open_catalog(input_file: Path, platform, image_name, index: Path | None, stack: contextlib.ExitStack):
+    if str(input_file) == "-":
+        raise Exception("ls and cat can't read the image from stdin")
+    image, _ = _open_input(input_file, platform, image_name, stack)
+    if image is None:
+        raise Exception(
+            f"{input_file} can't be read in place. ls and cat need an uncompressed archive or an image layout."
+        )
+    return load_catalog(image, input_file, index)
+
+
+@app.command()
+def ls(
+    input_file: Path = typer.Argument(..., help="Image: an uncompressed archive or an OCI image layout directory."),
+    path: str = typer.Argument("/", help="Directory (or file) of the image to list."),
+    long: bool = typer.Option(False, "--long", "-l", help="List modes, owners, sizes and modification times."),
+    recursive: bool = typer.Option(False, "--recursive", "-R", help="List subdirectories recursively."),
+    platform: str = typer.Option(None, help="Platform of the image to list from a multi-platform OCI index."),
+    image_name: str = typer.Option(None, "--image", help="Image to list from an archive holding several images."),
+    index: Path = typer.Option(
+        None, help=f"Index of the image layers. Defaults to the image path followed by {INDEX_SUFFIX}."
+    ),
+):
+    """
+    List the files of an image as they appear once unpacked, without unpacking it.
+    """
+    with contextlib.ExitStack() as stack:
+        catalog = _open_catalog(input_file, platform, image_name, index, stack)
+        for entry in catalog.walk(catalog.resolve(path), recursive):
+            print(format_entry(entry, catalog.stat(entry)) if long else f"/{entry}")
+
+
+@app.command()
+def cat(
+    input_file: Path = typer.Argument(..., help="Image: an uncompressed archive or an OCI image layout directory."),
+    path: str = typer.Argument(..., help="File of the image to write to stdout (symlinks are followed)."),
+    platform: str = typer.Option(None, help="Platform of the image to read from a multi-platform OCI index."),
+    image_name: str = typer.Option(None, "--image", help="Image to read from an archive holding several images."),
+    index: Path = typer.Option(
+        None, help=f"Index of the image layers. Defaults to the image path followed by {INDEX_SUFFIX}."
+    ),
+):
+    """
+    Write a file of an image to stdout, decompressing only the part of the layer holding it.
+    """
+    with contextlib.ExitStack() as stack:
+        catalog = _open_catalog(input_file, platform, image_name, index, stack)
+        for chunk in catalog.read(path):
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+
+
+@app.command()
+def analyze(
+    input_file: Path = typer.Argument(
+        ...,
+        help="Image to analyze: a `docker save` or OCI archive (optionally compressed), an OCI image "
+        "layout directory, or - for stdin.",
+    ),
+    platform: str = typer.Option(None, help="Platform of the image to analyze from a multi-platform OCI index."),
+    image_name: str = typer.Option(None, "--image", help="Image to analyze from an archive holding several images."),
+    decompressor: list[str] = typer.Option([], help="Preferred decompression backend (repeatable)."),
+    top: int = typer.Option(10, help="Number of largest files to report."),
+    as_json: bool = typer.Option(False, "--json", help="Print the report as JSON."),
+):
+    """
+    Report the size of an image once unpacked, its largest files, and the bytes of each
+    layer replaced or deleted by upper layers, without unpacking it.
+    """
+    with contextlib.ExitStack() as stack:
+        image, input_stream = _open_input(input_file, platform, image_name, stack)
+        headers = None
+        if image is None:
+            # The order of the layers is only known at the end of the stream, so their headers are kept
+            logger.info(f"Streaming image archive {input_file}")
+            headers = {}
+
+            def read_layer(name: str, f, size: int):
+                headers[name] = read_headers(f, decompressor, name)
+
+            image = read_streaming(input_stream, read_layer, platform, image_name, decompressor)
+        report = analyze_layers(image.layer_blobs(), decompressor, top, headers)
+    print(json.dumps(report, indent=2) if as_json else format_report(report))
+
+
+@app.command()
+def unpack_many(
+    job_list: Path = typer.Option(
+        None,
+        "--list",
+        help="File listing the images to unpack, one `<archive> <output_dir>` pair per line.",
+    ),
+    archive: Path = typer.Option(
+        None, help="Uncompressed `docker save` archive of several images, all of which are unpacked."
+    ),
+    output_root: Path = typer.Option(
+        None, help="Directory in which the images of --archive are unpacked, each named after its first tag."
+    ),
+    processes: int = typer.Option(os.cpu_count() or 1, help="Number of images unpacked concurrently."),
+    platform: str = typer.Option(None, help="Platform of the images to unpack from multi-platform OCI indexes."),
+    jobs: int = typer.Option(1, help="Number of layers to decompress concurrently, per image."),
+    readahead_mb: int = typer.Option(
+        128, help="Maximum memory (in MiB) used to buffer layers decompressed ahead, per image."
+    ),
+    write_jobs: int = typer.Option(1, help="Number of threads writing files, per image."),
+    decompressor: list[str] = typer.Option([], help="Preferred decompression backend (repeatable)."),
+    cache_dir: Path = typer.Option(
+        None,
+        help="Layer cache shared across batches. By default, a temporary cache next to the first output "
+        "directory holds the layers shared by several images of the batch.",
+    ),
+    cache_max_gb: float = typer.Option(50, help="Maximum size of the layer cache given with --cache-dir, in GiB."),
+    cache_link: str = typer.Option(
+        "hardlink", help=f"How files are transferred from the layer cache ({', '.join(TRANSFER_MODES)})."
+    ),
+    update: bool = typer.Option(False, help="Update output directories previously unpacked by this tool."),
+    include: list[str] = typer.Option([], help="Only unpack the paths matching this glob (repeatable)."),
+    exclude: list[str] = typer.Option([], help="Don't unpack the paths matching this glob (repeatable)."),
+    include_from: Path = typer.Option(None, help="File of --include patterns, one per line."),
+    exclude_from: Path = typer.Option(None, help="File of --exclude patterns, one per line."),
+    verify: bool = typer.Option(True, help="Check the digest and diff_id of each layer while it is decompressed."),
+    durability: str = typer.Option(
+        "end", help=f"When the unpacked files are flushed to disk ({', '.join(DURABILITY_MODES)})."
+    ),
+    sparse: bool = typer.Option(False, help="Leave the all-zero blocks of extracted files as holes."),
+    resume: bool = typer.Option(False, help="Resume interrupted unpacks into the output directories."),
+):
+    """
+    Unpack many images with a pool of processes, extracting the layers they share only once.
+    """
+    batch = []
+    if job_list is not None:
+        batch += read_job_list(job_list)
+    if archive is not None:
+        if output_root is None:
+            raise Exception("--archive requires --output-root")
+        batch += expand_archive(archive, output_root, platform)
+    if not batch:
+        raise Exception("Nothing to unpack, pass --list and/or --archive")
+
+    shared_cache = cache_dir is not None
+    if not shared_cache:
+        # Next to the outputs, so that layers can be hardlinked into them
+        batch[0].output_dir.parent.mkdir(parents=True, exist_ok=True)
+        cache_dir = batch[0].output_dir.parent / f".docker-unpack-batch-{os.getpid()}"
+        cache_max_gb = float("inf")
+
+    unpack_image = functools.partial(
+        unpack,
+        platform=platform,
+        jobs=jobs,
+        readahead_mb=readahead_mb,
+        write_jobs=write_jobs,
+        decompressor=decompressor,
+        cache_max_gb=cache_max_gb,
+        cache_link=cache_link,
+        update=update,
+        include=include,
+        exclude=exclude,
+        include_from=include_from,
+        exclude_from=exclude_from,
+        manifest_path=None,
+        manifest_hash="sha256",
+        verify=verify,
+        durability=durability,
+        sparse=sparse,
+        resume=resume,
+        stats_json=None,
+        profile=None,
+        trace_memory=None,
+    )
+    try:
+        run_batch(batch, unpack_image, processes, cache_dir, shared_cache, platform, decompressor)
+    finally:
+        if not shared_cache:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    logger.info(f"Succesfully unpacked {len(batch)} images")
@@ -0,0 +1,256 @@
+"""
+Decompression of layer blobs.
+
+Decompressors are looked up in a registry of backends. Faster backends (ISA-L,
+rapidgzip, or external `pigz`/`zstd`/`xz` processes) are used when they are
+installed, and the standard library (or `zstandard`) is always available as a
+fallback.
+"""
+
+import bz2
+import gzip
+import importlib.util
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import typing
+
+from watcloud_utils.logging import logger
+
+from .utils import StreamProxy
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PrefixedReader(io.RawIOBase):
+    """
+    A reader that returns `prefix` followed by the rest of `fileobj`. Used to put back
+    bytes consumed while detecting the compression type of a stream.
+    """
+
+    def __init__(self, prefix: bytes, fileobj):
+        self.prefix = memoryview(prefix)
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.fileobj.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+def peek_comptype(fileobj) -> tuple[str, typing.BinaryIO]:
+    """
+    Detects the compression type of a stream. Returns the type and a reader that
+    yields the whole stream, including the bytes read for detection. Seekable
+    streams are rewound and returned as-is.
+    """
+    if fileobj.seekable():
+        start = fileobj.tell()
+        head = fileobj.read(tarfile.BLOCKSIZE)
+        fileobj.seek(start)
+        return StreamProxy.detect_comptype(head), fileobj
+
+    head = b""
+    while len(head) < tarfile.BLOCKSIZE:
+        data = fileobj.read(tarfile.BLOCKSIZE - len(head))
+        if not data:
+            break
+        head += data
+    return StreamProxy.detect_comptype(head), io.BufferedReader(
+        PrefixedReader(head, fileobj), buffer_size=CHUNK_SIZE
+    )
+
+
+class SubprocessReader(io.RawIOBase):
+    """
+    Reads the output of a filter process (e.g. `pigz -dc`), fed from `fileobj` by a
+    helper thread. `fileobj` is closed with the reader, rather than when the thread
+    exits, so that callers can still read what follows the compressed stream.
+    """
+
+    def __init__(self, args: list[str], fileobj):
+        self.args = args
+        self.fileobj = fileobj
+        self.proc = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self.feed_error = None
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _feed(self):
+        try:
+            while chunk := self.fileobj.read(CHUNK_SIZE):
+                self.proc.stdin.write(chunk)
+        except BrokenPipeError:
+            # The process exited early; its exit status is checked by the reader
+            pass
+        except BaseException as e:
+            self.feed_error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if n == 0:
+            self._finish()
+        return n
+
+    def _finish(self):
+        self.feeder.join()
+        returncode = self.proc.wait()
+        if self.feed_error is not None:
+            raise self.feed_error
+        if returncode != 0:
+            stderr = self.proc.stderr.read().decode(errors="replace").strip()
+            raise tarfile.ReadError(f"{self.args[0]} exited with status {returncode}: {stderr}")
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.fileobj.close()
+        super().close()
+
+
+class Backend:
+    """
+    A decompressor for one or more compression types.
+    """
+
+    def __init__(self, name: str, comptypes: tuple[str, ...], needs_seekable: bool = False):
+        self.name = name
+        self.comptypes = comptypes
+        self.needs_seekable = needs_seekable
+
+    def available(self) -> bool:
+        return True
+
+    def open(self, fileobj) -> typing.BinaryIO:
+        raise NotImplementedError
+
+
+class ModuleBackend(Backend):
+    """
+    A backend implemented by a Python module, available if the module can be imported.
+    """
+
+    def __init__(self, name, comptypes, module, opener, needs_seekable=False):
+        super().__init__(name, comptypes, needs_seekable)
+        self.module = module
+        self.opener = opener
+
+    def available(self):
+        return importlib.util.find_spec(self.module) is not None
+
+    def open(self, fileobj):
+        return self.opener(fileobj)
+
+
+class CommandBackend(Backend):
+    """
+    A backend implemented by an external command, available if it is on the PATH.
+    """
+
+    def __init__(self, name, comptypes, args):
+        super().__init__(name, comptypes)
+        self.args = args
+
+    def available(self):
+        return shutil.which(self.args[0]) is not None
+
+    def open(self, fileobj):
+        return io.BufferedReader(SubprocessReader(self.args, fileobj), buffer_size=CHUNK_SIZE)
+
+
+def _open_zstandard(fileobj):
+    import zstandard
+
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_size=CHUNK_SIZE, read_across_frames=True)
+
+
+def _open_isal(fileobj):
+    from isal import igzip
+
+    return igzip.IGzipFile(fileobj=fileobj, mode="rb")
+
+
+def _open_rapidgzip(fileobj):
+    import rapidgzip
+
+    return rapidgzip.open(fileobj, parallelization=os.cpu_count() or 1)
+
+
+# Registered backends, in order of preference
+BACKENDS: dict[str, Backend] = {}
+
+
+def register_backend(backend: Backend):
+    BACKENDS[backend.name] = backend
+
+
+register_backend(ModuleBackend("rapidgzip", ("gz",), "rapidgzip", _open_rapidgzip, needs_seekable=True))
+register_backend(ModuleBackend("isal", ("gz",), "isal", _open_isal))
+register_backend(CommandBackend("pigz", ("gz",), ["pigz", "-dc"]))
+register_backend(ModuleBackend("zlib", ("gz",), "zlib", lambda f: gzip.GzipFile(fileobj=f, mode="rb")))
+register_backend(ModuleBackend("zstandard", ("zst",), "zstandard", _open_zstandard))
+register_backend(CommandBackend("zstd", ("zst",), ["zstd", "-dc", "-T0"]))
+register_backend(CommandBackend("xz", ("xz",), ["xz", "-dc", "-T0"]))
+register_backend(ModuleBackend("lzma", ("xz",), "lzma", lzma.LZMAFile))
+register_backend(CommandBackend("lbzip2", ("bz2",), ["lbzip2", "-dc"]))
+register_backend(ModuleBackend("bz2", ("bz2",), "bz2", bz2.BZ2File))
+
+
+def select_backend(comptype: str, seekable: bool, preferred: typing.Sequence[str] = ()) -> Backend:
+    """
+    Returns the first usable backend for `comptype`, trying the `preferred` backends first.
+    """
+    for name in preferred:
+        if name not in BACKENDS:
+            raise Exception(f"Unknown decompressor {name!r}, expected one of {list(BACKENDS)}")
+        if comptype in BACKENDS[name].comptypes and not BACKENDS[name].available():
+            logger.warning(f"Decompressor {name} is not installed, falling back to the next available one")
+
+    candidates = [BACKENDS[name] for name in preferred] + list(BACKENDS.values())
+    for backend in candidates:
+        if comptype not in backend.comptypes or (backend.needs_seekable and not seekable):
+            continue
+        if backend.available():
+            return backend
+    raise tarfile.CompressionError(f"No decompressor available for {comptype}")
+
+
+def open_decompressed(fileobj, preferred: typing.Sequence[str] = (), name: str = "") -> typing.BinaryIO:
+    """
+    Returns a reader yielding the decompressed contents of a (possibly compressed) stream.
+    """
+    comptype, f = peek_comptype(fileobj)
+    if comptype == "tar":
+        return f
+    backend = select_backend(comptype, f.seekable(), preferred)
+    logger.info(f"Decompressing {name or 'stream'} ({comptype}) with {backend.name}")
+    return backend.open(f)
@@ -0,0 +1,63 @@
+"""
+Durability of unpacked trees.
+
+An unpack only counts as complete once its state record is written, so the tree
+must reach the disk before the record does. How much is flushed is set by one
+policy, shared by every writer:
+
+- `none`: nothing is flushed, the page cache writes the tree back whenever it wants.
+- `end`: the filesystem holding the output is flushed once with `syncfs(2)` when
+  the tree is complete, then the state record is written and fsynced. A crash
+  leaves either a complete tree or one without a state record.
+- `strict`: like `end`, and every file is also fsynced before it is closed.
+
+Per-file fsyncs are slow on the disks we stage CVMFS publications on, and `end`
+gives the same guarantee for the unpack as a whole, so it is the default.
+"""
+
+import ctypes
+import os
+from pathlib import Path
+
+DURABILITY_MODES = ("none", "end", "strict")
+
+
+def check_durability(mode: str):
+    if mode not in DURABILITY_MODES:
+        raise Exception(f"Unknown durability {mode!r}, expected one of {DURABILITY_MODES}")
+
+
+def _libc_syncfs():
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (AttributeError, OSError):
+        return None
+
+
+def syncfs(path: Path):
+    """
+    Flushes the filesystem holding `path`, or all filesystems where `syncfs` isn't
+    available.
+    """
+    libc_syncfs = _libc_syncfs()
+    if libc_syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        if libc_syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path: Path):
+    """
+    Flushes the entries of directory `path` (e.g. a file renamed into it).
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,121 @@
+"""
+Include/exclude rules for the paths of an unpacked image.
+
+Patterns are globs matched against paths relative to the image root: `*`, `?` and
+`[...]` match within a path component, and a `**` component matches any number of
+components. Patterns without a slash (e.g. `*.pyc`) match the name of an entry at
+any depth. A pattern matching a directory matches its whole subtree.
+
+Excluded paths are never written. When include patterns are given, only the paths
+they match are written, along with the directories leading to them. Exclude
+patterns take precedence over include patterns. Filtered entries still shadow and
+replace the entries of lower layers, so the result is the same as unpacking the
+whole image and deleting the filtered paths afterwards.
+"""
+
+import re
+import typing
+from pathlib import Path
+
+
+def _translate_component(part: str) -> str:
+    regex, i = "", 0
+    while i < len(part):
+        c = part[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[" and (end := part.find("]", i + 1 if part[i : i + 1] in ("!", "]") else i)) >= 0:
+            body = part[i:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex += f"[{body}]"
+            i = end + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def _translate(parts: list[str]) -> str:
+    regex = ""
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == "**":
+            regex += ".*" if last else "(?:[^/]+/)*"
+        else:
+            regex += _translate_component(part) + ("" if last else "/")
+    return regex
+
+
+def _split(pattern: str) -> tuple[list[str], bool]:
+    """
+    Returns the components of a pattern, and whether it is anchored at the root.
+    """
+    parts = [part for part in pattern.strip().split("/") if part and part != "."]
+    if not parts:
+        raise Exception(f"Invalid path pattern {pattern!r}")
+    return parts, "/" in pattern.strip().strip("/") or pattern.strip().startswith("/")
+
+
+def _compile(alternatives: list[str], subtree: bool) -> re.Pattern:
+    suffix = "(?:/.*)?" if subtree else ""
+    return re.compile(f"(?:{'|'.join(alternatives)}){suffix}", re.DOTALL)
+
+
+def read_patterns(path: Path) -> list[str]:
+    """
+    Reads patterns from a file, one per line. Empty lines and lines starting with `#` are ignored.
+    """
+    lines = (line.strip() for line in path.read_text().splitlines())
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+class PathFilter:
+    """
+    Decides which paths of an image are written. All patterns are compiled into a
+    single regular expression per kind, so each member costs one or two regex matches.
+    """
+
+    def __init__(self, include: typing.Sequence[str] = (), exclude: typing.Sequence[str] = ()):
+        self.include_patterns = list(include)
+        self.exclude_patterns = list(exclude)
+
+        self.exclude = None
+        if exclude:
+            self.exclude = _compile([self._pattern_regex(p) for p in exclude], subtree=True)
+
+        self.include = self.ancestors = None
+        if include:
+            self.include = _compile([self._pattern_regex(p) for p in include], subtree=True)
+            # Directories that may contain paths matched by an include pattern
+            prefixes = []
+            for pattern in include:
+                parts, anchored = _split(pattern)
+                if not anchored or parts[0] == "**":
+                    prefixes = [".*"]
+                    break
+                prefixes += [_translate(parts[:n]) for n in range(1, len(parts))]
+            self.ancestors = _compile(prefixes, subtree=False) if prefixes else None
+
+    @staticmethod
+    def _pattern_regex(pattern: str) -> str:
+        parts, anchored = _split(pattern)
+        return _translate(parts) if anchored else "(?:.*/)?" + _translate(parts)
+
+    def __bool__(self):
+        return self.include is not None or self.exclude is not None
+
+    def keep(self, path: str, isdir: bool) -> bool:
+        """
+        Returns whether the entry at a normalized `path` is written.
+        """
+        if self.exclude is not None and self.exclude.fullmatch(path):
+            return False
+        if self.include is None or self.include.fullmatch(path):
+            return True
+        return isdir and self.ancestors is not None and self.ancestors.fullmatch(path) is not None
+
+    def to_dict(self) -> dict:
+        return {"include": self.include_patterns, "exclude": self.exclude_patterns}
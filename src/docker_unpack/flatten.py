@@ -0,0 +1,261 @@
+"""
+Output of the unpacked image as a single tar stream (`unpack <input> -`), e.g. to
+pipe into `mksquashfs - image.sqfs -tar` or `cvmfs_server ingest`.
+
+Layers are applied top-down as in a directory unpack, but the members that make up
+the merged tree are written to the output tar instead of the filesystem, so the tree
+is never materialized. The Apptainer base environment is generated in a small
+temporary directory, and added as two extra layers: its files on top of the image
+(they replace the image's files, as in a directory unpack), and its directories and
+symlinks below it (they are only created where the image has none).
+"""
+
+import copy
+import functools
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .apptainer_base_env import make_base_env
+from .filters import PathFilter
+from .image import Blob, ImageArchive, read_streaming
+from .layers import write_layers
+from .manifest import Manifest
+from .utils import generate_env, generate_runscript, normalize_member_name
+from .verify import LayerDigests
+
+
+class _TellingWriter(io.RawIOBase):
+    """
+    A write-only stream counting its position, so that `TarFile` can write to pipes
+    without the small records of its stream mode.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = self.fileobj.write(b)
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _HashingReader:
+    """
+    Passes reads through to `fileobj`, hashing the data read with `h`.
+    """
+
+    def __init__(self, fileobj, h):
+        self.fileobj = fileobj
+        self.h = h
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.h.update(data)
+        return data
+
+
+class TarWriter:
+    """
+    Writes tar members to an output tar, with the interface of `MemberWriter`.
+    Members are recorded in `manifest`, if given. Layers may omit the entries of
+    parent directories, which `MemberWriter` creates as needed: the parents that
+    no member was written for are added as directories when the writer is closed.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj, manifest: Manifest | None = None):
+        self.out = tarfile.TarFile(fileobj=_TellingWriter(fileobj), mode="w", format=tarfile.PAX_FORMAT)
+        self.out.copybufsize = self.BUFFER_SIZE
+        self.manifest = manifest
+        # Parents of the entries written, and the directories written (or entries
+        # written over a parent)
+        self.parents: set[str] = set()
+        self.written: set[str] = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        mtime = int(time.time())
+        for path in sorted(self.parents - self.written):
+            info = tarfile.TarInfo(path)
+            info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, mtime
+            info.uid, info.gid, info.uname, info.gname = 0, 0, "root", "root"
+            self.out.addfile(info)
+            if self.manifest is not None:
+                self.manifest.record_member(info, path)
+        self.out.close()
+
+    def _add(self, path: str, isdir: bool):
+        if isdir or path in self.parents:
+            self.written.add(path)
+        parent = posixpath.dirname(path)
+        while parent and parent not in self.parents:
+            self.parents.add(parent)
+            parent = posixpath.dirname(parent)
+
+    def wait(self, path: str):
+        pass
+
+    def write(self, tar: tarfile.TarFile, member: tarfile.TarInfo, path: str):
+        self._add(path, member.isdir())
+        info = copy.copy(member)
+        info.name = path
+        # Drop the headers describing the original name and sparse layout
+        info.pax_headers = {
+            key: value
+            for key, value in member.pax_headers.items()
+            if key not in ("path", "linkpath") and not key.startswith("GNU.sparse.")
+        }
+        if member.isreg():
+            # Sparse files are written out in full
+            info.type = tarfile.REGTYPE
+            info.sparse = None
+            if self.manifest is None:
+                self.out.addfile(info, tar.extractfile(member))
+                return
+            h = self.manifest.new()
+            self.out.addfile(info, _HashingReader(tar.extractfile(member), h))
+            self.manifest.record_member(info, path, h)
+            return
+        if member.islnk():
+            info.linkname = normalize_member_name(member.linkname)
+        self.out.addfile(info)
+        if self.manifest is not None:
+            self.manifest.record_member(info, path)
+
+    def link(self, target: str, path: str):
+        self._add(path, False)
+        info = tarfile.TarInfo(path)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target
+        self.out.addfile(info)
+        if self.manifest is not None:
+            self.manifest.record_member(info, path)
+
+
+def _tar_blob(name: str, members: list[tuple[tarfile.TarInfo, bytes | None]]) -> Blob:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for info, data in members:
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+    data = buf.getvalue()
+    return Blob(name, len(data), lambda: io.BytesIO(data))
+
+
+def base_env_layers(img_config: dict) -> tuple[Blob, Blob]:
+    """
+    Returns layers holding the Apptainer base environment of an image: the
+    directories and symlinks (to go below the image layers), and the files (to go on top).
+    """
+    below, above = [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        make_base_env(root, runscript=False)
+        generate_runscript(root, img_config)
+        generate_env(root, img_config)
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in sorted(dirnames) + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                info = tarfile.TarInfo(os.path.relpath(path, root))
+                info.mode, info.mtime = st.st_mode & 0o7777, int(st.st_mtime)
+                info.uid, info.gid, info.uname, info.gname = 0, 0, "root", "root"
+                if os.path.islink(path):
+                    info.type = tarfile.SYMTYPE
+                    # Links point into the output directory, i.e. the root of the image
+                    target = os.readlink(path)
+                    info.linkname = "/" + os.path.relpath(target, root) if target.startswith(tmp) else target
+                    below.append((info, None))
+                elif os.path.isdir(path):
+                    info.type = tarfile.DIRTYPE
+                    below.append((info, None))
+                else:
+                    data = Path(path).read_bytes()
+                    info.size = len(data)
+                    above.append((info, data))
+
+    return _tar_blob("base-env-dirs", below), _tar_blob("base-env-files", above)
+
+
+def read_spooled(
+    fileobj,
+    directory: str,
+    platform: str | None = None,
+    image: str | None = None,
+    decompressors: typing.Sequence[str] = (),
+):
+    """
+    Reads an archive as a stream, spooling its layer blobs (as they are in the archive)
+    to files in `directory`, since the order of the layers is only known once the
+    manifest is read. Returns the image and its layer blobs, bottom to top.
+    """
+    blobs = {}
+
+    def spool(name: str, f, size: int):
+        path = os.path.join(directory, str(len(blobs)))
+        with open(path, "wb") as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        blobs[name] = Blob(name, size, functools.partial(open, path, "rb", buffering=1024 * 1024))
+
+    archive: ImageArchive = read_streaming(fileobj, spool, platform, image, decompressors)
+    return archive, [blobs[name] for name in archive.layers]
+
+
+def write_flat_tar(
+    blobs: list[Blob],
+    img_config: dict,
+    fileobj: typing.BinaryIO,
+    jobs: int = 1,
+    readahead_bytes: int = 512 * 1024 * 1024,
+    decompressors: typing.Sequence[str] = (),
+    path_filter: PathFilter | None = None,
+    manifest: Manifest | None = None,
+    expected: dict[str, LayerDigests] | None = None,
+):
+    """
+    Writes the merged tree of the layers (ordered bottom to top) and its Apptainer
+    base environment to `fileobj` as a tar stream. Members are written top layer
+    first, and each path appears once. The image files are filtered by
+    `path_filter`, but not the base environment. The members written are recorded
+    in `manifest`, if given, and the layers are checked against their `expected`
+    digests.
+    """
+    below, above = base_env_layers(img_config)
+    with TarWriter(fileobj, manifest) as writer:
+        write_layers(
+            [below, *blobs, above],
+            writer,
+            jobs,
+            readahead_bytes,
+            decompressors,
+            path_filter,
+            {below.name, above.name},
+            expected,
+        )
+    fileobj.flush()
+    logger.info(f"Wrote {len(blobs)} layers as a flat tar stream")
@@ -0,0 +1,409 @@
+"""
+Readers for `docker save` archives and OCI image layouts.
+
+Seekable, uncompressed archives are indexed once (headers only) and layer blobs are
+read in place through `os.pread`, without copying them anywhere. Image layouts in a
+directory are read in place as well. Other inputs (stdin, compressed archives) are
+consumed as a stream: small metadata members are kept in memory, and layer blobs are
+handed to a callback as they arrive.
+"""
+
+import collections.abc
+import functools
+import io
+import json
+import os
+import platform as _platform
+import posixpath
+import tarfile
+import typing
+
+from watcloud_utils.logging import logger
+
+from .decompress import CHUNK_SIZE, PrefixedReader, open_decompressed
+from .stats import STATS
+from .utils import MyTarFile, StreamProxy
+
+# Non-layer members (manifest, configs, index) larger than this are rejected
+MAX_METADATA_SIZE = 64 * 1024 * 1024
+
+# Media types of descriptors pointing to other indexes (multi-platform images)
+INDEX_MEDIA_TYPES = {
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+}
+
+# `platform.machine()` values that differ from the OCI architecture names
+_ARCHITECTURES = {
+    "x86_64": "amd64",
+    "aarch64": "arm64",
+    "armv7l": "arm/v7",
+    "armv6l": "arm/v6",
+    "i386": "386",
+    "i686": "386",
+}
+
+
+def host_platform() -> str:
+    """
+    Returns the platform of this machine, e.g. `linux/amd64`.
+    """
+    machine = _platform.machine().lower()
+    return f"linux/{_ARCHITECTURES.get(machine, machine)}"
+
+
+def _format_platform(platform: dict) -> str:
+    parts = [platform.get("os", ""), platform.get("architecture", "")]
+    if platform.get("variant"):
+        parts.append(platform["variant"])
+    return "/".join(parts)
+
+
+def _platform_matches(platform: dict, wanted: str) -> bool:
+    """
+    Returns whether an OCI platform object matches an `os/arch[/variant]` string.
+    The variant is only compared if `wanted` has one.
+    """
+    os_, _, rest = wanted.partition("/")
+    arch, _, variant = rest.partition("/")
+    return (
+        platform.get("os") == os_
+        and platform.get("architecture") == arch
+        and (not variant or platform.get("variant") == variant)
+    )
+
+
+def select_image(entries: list, tags, image: str | None):
+    """
+    Returns the entry of a multi-image archive selected by `image`, a tag (matched
+    against `tags(entry)`) or a 0-based position. Without `image`, the archive must
+    contain exactly one image.
+    """
+    if image is None:
+        if len(entries) != 1:
+            raise Exception(f"Expected exactly one image, got {len(entries)}. Select one by tag or position.")
+        return entries[0]
+    for entry in entries:
+        if image in tags(entry):
+            return entry
+    if image.isdigit() and int(image) < len(entries):
+        return entries[int(image)]
+    available = [tag for entry in entries for tag in tags(entry)]
+    raise Exception(f"Image {image!r} not found. Available: {', '.join(available) or 'no tags'}")
+
+
+def _oci_ref_names(descriptor: dict) -> list[str]:
+    name = descriptor.get("annotations", {}).get("org.opencontainers.image.ref.name")
+    return [name] if name else []
+
+
+def blob_path(digest: str) -> str:
+    """
+    Returns the path of a blob in an OCI image layout, e.g. `blobs/sha256/<hex>`.
+    """
+    algorithm, _, encoded = digest.partition(":")
+    if not encoded or "/" in digest or algorithm.startswith("."):
+        raise Exception(f"Invalid digest {digest!r}")
+    return f"blobs/{algorithm}/{encoded}"
+
+
+def is_layer_blob(head: bytes) -> bool:
+    """
+    Returns whether the first block of a blob looks like a (possibly compressed) layer tarball.
+    """
+    if StreamProxy.detect_comptype(head) != "tar":
+        return True
+    # Empty layers consist of zero blocks only
+    return head[257:262] == b"ustar" or not head.strip(b"\0")
+
+
+class FileSlice(io.RawIOBase):
+    """
+    A read-only, seekable view of a byte range of a file descriptor.
+
+    Reads use `os.pread`, so multiple slices of the same file can be read concurrently.
+    """
+
+    def __init__(self, fd: int, offset: int, size: int):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self.fd, n, self.offset + self.pos)
+        b[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+class Blob:
+    """
+    A member of an image archive.
+    """
+
+    def __init__(self, name: str, size: int, opener):
+        self.name = name
+        self.size = size
+        self._opener = opener
+
+    def open(self) -> typing.BinaryIO:
+        return self._opener()
+
+    def __repr__(self):
+        return f"Blob({self.name!r}, size={self.size})"
+
+
+class ImageArchive:
+    """
+    The manifest, config and layer blobs of a single image, from a `docker save`
+    archive (`manifest.json`) or an OCI image layout (`index.json`). In archives
+    holding several images, the one to read is selected by `image` (see
+    `select_image`). In a multi-platform OCI index, the image for `platform` (by
+    default, the host's) is used.
+    """
+
+    def __init__(
+        self,
+        metadata: dict[str, bytes],
+        links: dict[str, str],
+        blobs: typing.Mapping[str, Blob],
+        platform: str | None = None,
+        image: str | None = None,
+    ):
+        self.metadata = metadata
+        self.links = links
+        self.blobs = blobs
+
+        with STATS.phase("manifest"):
+            if self.exists("manifest.json"):
+                self._read_docker_manifest(image)
+            elif self.exists("index.json"):
+                self._read_oci_index(platform, image)
+            else:
+                raise Exception("Neither manifest.json nor index.json found in the image")
+
+    def _read_docker_manifest(self, image: str | None):
+        # All the images of the archive, for `unpack-many`
+        self.manifests = json.loads(self.read("manifest.json"))
+        self.manifest = select_image(self.manifests, lambda m: m.get("RepoTags") or [], image)
+        logger.debug(json.dumps(self.manifest, indent=2))
+
+        logger.info(f"Reading config from {self.manifest['Config']}")
+        self.config = json.loads(self.read(self.manifest["Config"]))
+        logger.debug(json.dumps(self.config, indent=2))
+
+        self.layers = [self.resolve(layer) for layer in self.manifest["Layers"]]
+
+    def _image_manifests(self, index: dict, depth: int = 0) -> list[dict]:
+        """
+        Returns the image manifest descriptors of an OCI index, including those of
+        nested indexes.
+        """
+        if depth > 8:
+            raise Exception("Too many levels of nested image indexes")
+        descriptors = []
+        for descriptor in index.get("manifests", []):
+            if descriptor.get("mediaType") in INDEX_MEDIA_TYPES:
+                nested = json.loads(self.read(blob_path(descriptor["digest"])))
+                descriptors.extend(self._image_manifests(nested, depth + 1))
+            else:
+                descriptors.append(descriptor)
+        return descriptors
+
+    def _read_oci_index(self, platform: str | None, image: str | None):
+        index = json.loads(self.read("index.json"))
+        self.manifests = index.get("manifests", [])
+        if image is not None:
+            index = {"manifests": [select_image(self.manifests, _oci_ref_names, image)]}
+        descriptors = self._image_manifests(index)
+        if not descriptors:
+            raise Exception("No image manifest found in index.json")
+
+        wanted = platform or host_platform()
+        matching = {d["digest"]: d for d in descriptors if "platform" not in d or _platform_matches(d["platform"], wanted)}
+        if not matching and platform is None and len({d["digest"] for d in descriptors}) == 1:
+            # A single-platform image is used regardless of the host
+            matching = {descriptors[0]["digest"]: descriptors[0]}
+            logger.warning(f"Using the only image in the index, for {_format_platform(descriptors[0]['platform'])}")
+        if not matching:
+            available = sorted({_format_platform(d["platform"]) for d in descriptors if "platform" in d})
+            raise Exception(f"No image for platform {wanted} in the index. Available: {', '.join(available)}")
+        if len(matching) > 1:
+            refs = [(_oci_ref_names(d) or [d["digest"]])[0] for d in matching.values()]
+            raise Exception(f"Expected exactly one image for platform {wanted}, got {len(matching)}: {', '.join(refs)}")
+
+        descriptor = next(iter(matching.values()))
+        logger.info(f"Reading image manifest {descriptor['digest']}")
+        self.manifest = json.loads(self.read(blob_path(descriptor["digest"])))
+        logger.debug(json.dumps(self.manifest, indent=2))
+
+        logger.info(f"Reading config from {self.manifest['config']['digest']}")
+        self.config = json.loads(self.read(blob_path(self.manifest["config"]["digest"])))
+        logger.debug(json.dumps(self.config, indent=2))
+
+        self.layers = [self.resolve(blob_path(layer["digest"])) for layer in self.manifest["layers"]]
+
+    def exists(self, name: str) -> bool:
+        name = self.resolve(name)
+        return name in self.metadata or name in self.blobs
+
+    def resolve(self, name: str) -> str:
+        """
+        Resolves symlinks between archive members (e.g. `<id>/layer.tar -> ../blobs/sha256/<digest>`).
+        """
+        name = posixpath.normpath(name)
+        for _ in range(32):
+            if name not in self.links:
+                return name
+            name = self.links[name]
+        raise Exception(f"Too many levels of symbolic links resolving {name}")
+
+    def read(self, name: str) -> bytes:
+        name = self.resolve(name)
+        if name in self.metadata:
+            return self.metadata[name]
+        if name in self.blobs:
+            with self.blobs[name].open() as f:
+                return f.read()
+        raise Exception(f"{name} not found in the image archive")
+
+    def layer_blobs(self) -> list[Blob]:
+        return [self.blobs[layer] for layer in self.layers]
+
+
+def _link_target(member: tarfile.TarInfo) -> str:
+    if member.issym():
+        return posixpath.normpath(posixpath.join(posixpath.dirname(member.name), member.linkname))
+    return posixpath.normpath(member.linkname)
+
+
+def open_indexed(fileobj, platform: str | None = None, image: str | None = None) -> ImageArchive:
+    """
+    Reads an uncompressed, seekable archive by indexing its member headers. Layer
+    blobs are opened in place.
+    """
+    fileobj.seek(0)
+    fd = fileobj.fileno()
+    metadata, links, blobs = {}, {}, {}
+
+    with MyTarFile.open(fileobj=fileobj, mode="r:") as tar:
+        for member in tar:
+            name = posixpath.normpath(member.name)
+            if member.issym() or member.islnk():
+                links[name] = _link_target(member)
+            elif member.isfile():
+                blobs[name] = Blob(
+                    name,
+                    member.size,
+                    lambda offset=member.offset_data, size=member.size: io.BufferedReader(
+                        FileSlice(fd, offset, size), buffer_size=1024 * 1024
+                    ),
+                )
+    logger.info(f"Indexed {len(blobs)} blobs in the image archive")
+
+    return ImageArchive(metadata, links, blobs, platform, image)
+
+
+class DirectoryBlobs(collections.abc.Mapping):
+    """
+    The files of an image laid out in a directory, as blobs opened in place. Files are
+    only looked up when accessed, so large shared layouts (e.g. of a registry mirror)
+    are not walked.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, name: str) -> str | None:
+        name = posixpath.normpath(name)
+        if name.startswith(("/", "../")) or name == "..":
+            return None
+        return os.path.join(self.root, name)
+
+    def __getitem__(self, name: str) -> Blob:
+        path = self._path(name)
+        if path is None or not os.path.isfile(path):
+            raise KeyError(name)
+        return Blob(name, os.path.getsize(path), functools.partial(open, path, "rb", buffering=1024 * 1024))
+
+    def __contains__(self, name) -> bool:
+        path = self._path(name)
+        return path is not None and os.path.isfile(path)
+
+    def __iter__(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(dirpath, filename), self.root)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def open_directory(path: str, platform: str | None = None, image: str | None = None) -> ImageArchive:
+    """
+    Reads an image from a directory: an OCI image layout, or an extracted `docker save`
+    archive. Layer blobs are opened in place.
+    """
+    return ImageArchive({}, {}, DirectoryBlobs(path), platform, image)
+
+
+def read_streaming(
+    fileobj,
+    handle_layer,
+    platform: str | None = None,
+    image: str | None = None,
+    decompressors: typing.Sequence[str] = (),
+) -> ImageArchive:
+    """
+    Reads a (possibly compressed) archive strictly forward, e.g. from a pipe. The
+    archive is decompressed with the same backends as layers (preferably
+    `decompressors`), so any supported compression is read with constant memory.
+    Small metadata members are kept in memory, and `handle_layer(name, fileobj, size)`
+    is called for each layer blob as it arrives.
+    """
+    metadata, links, blobs = {}, {}, {}
+
+    with (
+        open_decompressed(fileobj, decompressors, "image archive") as f,
+        MyTarFile.open(fileobj=f, mode="r|", bufsize=CHUNK_SIZE) as tar,
+    ):
+        for member in tar:
+            name = posixpath.normpath(member.name)
+            if member.issym() or member.islnk():
+                links[name] = _link_target(member)
+                continue
+            if not member.isfile():
+                continue
+
+            f = StreamProxy(tar.extractfile(member))
+            if is_layer_blob(f.buf):
+                logger.info(f"Receiving layer blob {name} ({member.size} bytes)")
+                handle_layer(name, PrefixedReader(f.buf, f.fileobj), member.size)
+                blobs[name] = Blob(name, member.size, None)
+            elif member.size > MAX_METADATA_SIZE:
+                raise Exception(f"Unexpected large non-layer member {name} ({member.size} bytes)")
+            else:
+                metadata[name] = f.buf + f.fileobj.read()
+
+    return ImageArchive(metadata, links, blobs, platform, image)
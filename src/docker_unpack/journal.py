@@ -0,0 +1,254 @@
+"""
+Checkpoint journal of an unpack in progress, so that an interrupted unpack can be
+resumed (`unpack --resume`) from its last completed layer.
+
+The journal is a file in the output directory (`JOURNAL_NAME`), made of records
+appended as the unpack progresses and terminated by NUL bytes (which can't appear
+in tar member names). Each record starts with a one-letter kind:
+
+- `H`: header (JSON), the layers, path filters and mode of the unpack
+- `D`, `F`, `W`, `O`: a path claimed as a directory or a non-directory, whited out,
+  or made opaque by the layer being applied (see `LayerIndex`)
+- `A`: attributes of a directory of the layer being applied (JSON)
+- `L`: a layer is applied
+- `S`: a layer is staged (JSON: its name and `StagedLayer` metadata)
+- `M`: a staged layer is merged into the output (JSON: its position and name)
+
+Layers applied top-down (`apply_layers`) record the markers they add to the layer
+index, so that resuming rebuilds the index without reading the completed layers
+again. The records of a layer only count once its `L` record follows them; a
+partially applied layer is applied again from the start, which overwrites the
+entries it already wrote, since they are exactly the entries it writes again. Staged
+layers are kept in the staging directory and skipped when their blob is read
+again, and layers are merged in a way that can be restarted (see
+`StagedLayers._merge`).
+
+The journal is flushed at each checkpoint, so it survives the process being killed
+(OOM, preemption). It is only fsynced with `--durability strict`, where the files
+written are fsynced too: after a host crash, only journals of strict unpacks can be
+trusted.
+"""
+
+import json
+import os
+import shutil
+import tarfile
+import threading
+import typing
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .cache import dump_directories, load_directories
+from .layers import JOURNAL_NAME, STAGING_DIR, StagedLayer
+from .verify import LayerDigests
+
+if typing.TYPE_CHECKING:
+    from .layers import LayerIndex
+
+JOURNAL_VERSION = 1
+
+# Records after which the journal is consistent
+_CHECKPOINTS = (b"H", b"L", b"S", b"M")
+
+_BUFFER_SIZE = 1024 * 1024
+
+
+def _encode(payload: str) -> bytes:
+    return payload.encode("utf-8", "surrogateescape")
+
+
+def _read_records(path: Path) -> tuple[list[tuple[bytes, str]], int]:
+    """
+    Returns the records of a journal up to its last checkpoint, and the length of
+    the journal up to it. Records after it (e.g. of a partially applied layer, or
+    cut short) are dropped.
+    """
+    data = path.read_bytes()
+    records: list[tuple[bytes, str]] = []
+    offset = committed = count = 0
+    for token in data.split(b"\0")[:-1]:
+        offset += len(token) + 1
+        kind = token[:1]
+        records.append((kind, token[1:].decode("utf-8", "surrogateescape")))
+        if kind in _CHECKPOINTS:
+            committed, count = offset, len(records)
+    return records[:count], committed
+
+
+class Journal:
+    """
+    The journal of the unpack into `root`. Use `create` to start one and `open` to
+    resume from an existing one.
+    """
+
+    def __init__(self, root: Path, header: dict, sync: bool = False):
+        self.root = root
+        self.path = root / JOURNAL_NAME
+        self.header = header
+        self.sync = sync
+        # Layers applied, top to bottom, and the records to rebuild their index from
+        self.applied: list[str] = []
+        self._applied_records: list[tuple[bytes, str]] = []
+        # Metadata of the staged layers by name, and the layers merged by position
+        self.staged: dict[str, dict] = {}
+        self.merged: dict[int, str] = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    @classmethod
+    def create(cls, root: Path, header: dict, sync: bool = False) -> "Journal":
+        journal = cls(root, {"version": JOURNAL_VERSION, **header}, sync)
+        root.mkdir(parents=True, exist_ok=True)
+        journal.file = open(journal.path, "wb", buffering=_BUFFER_SIZE)
+        journal._checkpoint(b"H", json.dumps(journal.header))
+        return journal
+
+    @classmethod
+    def open(cls, root: Path, sync: bool = False) -> "Journal | None":
+        """
+        Reads the journal of `root`, if it has one, and reopens it to append to its
+        last checkpoint.
+        """
+        path = root / JOURNAL_NAME
+        try:
+            records, length = _read_records(path)
+        except FileNotFoundError:
+            return None
+        if not records or records[0][0] != b"H":
+            logger.warning(f"Ignoring journal {path} without a header")
+            return None
+        header = json.loads(records[0][1])
+        if header.get("version") != JOURNAL_VERSION:
+            logger.warning(f"Ignoring journal {path} of unknown version {header.get('version')}")
+            return None
+
+        journal = cls(root, header, sync)
+        pending = []
+        for kind, payload in records[1:]:
+            if kind == b"L":
+                journal.applied.append(payload)
+                journal._applied_records += pending
+                journal._applied_records.append((kind, payload))
+                pending = []
+            elif kind == b"S":
+                name, meta = json.loads(payload)
+                journal.staged[name] = meta
+            elif kind == b"M":
+                i, name = json.loads(payload)
+                journal.merged[i] = name
+            else:
+                pending.append((kind, payload))
+
+        # Drop the records of the layer that was being applied
+        with open(path, "r+b") as f:
+            f.truncate(length)
+        journal.file = open(path, "ab", buffering=_BUFFER_SIZE)
+        return journal
+
+    def check(self, mode: str, layers: list[dict] | None = None, filters: dict | None = None):
+        """
+        Raises an exception if the journal was written by an unpack of another image,
+        with other path filters, or applying its layers another way (e.g. the same
+        image read from a seekable archive and then from stdin).
+        """
+        if self.header.get("mode") != mode:
+            raise Exception(
+                f"The unpack to {self.root} was interrupted while reading the image "
+                f"{'as a stream' if self.header.get('mode') == 'staged' else 'in place'}. "
+                "Resume it with the same input and options."
+            )
+        if layers is not None and self.header.get("layers") is not None and self.header["layers"] != layers:
+            raise Exception(f"The unpack to {self.root} was interrupted while unpacking another image")
+        if self.header.get("filters") != filters:
+            raise Exception(f"The unpack to {self.root} was interrupted while unpacking with other path filters")
+
+    def _write(self, kind: bytes, payload: str):
+        self.file.write(kind + _encode(payload) + b"\0")
+
+    def _checkpoint(self, kind: bytes, payload: str):
+        with self.lock:
+            self._write(kind, payload)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+    def claim(self, path: str, isdir: bool):
+        self.file.write((b"D" if isdir else b"F") + _encode(path) + b"\0")
+
+    def whiteout(self, path: str):
+        self._write(b"W", path)
+
+    def opaque(self, path: str):
+        self._write(b"O", path)
+
+    def directory(self, path: str, member: tarfile.TarInfo):
+        self._write(b"A", json.dumps([path, *dump_directories({path: member})[path]]))
+
+    def layer_applied(self, name: str):
+        self._checkpoint(b"L", name)
+
+    def layer_staged(self, name: str, layer: StagedLayer):
+        meta = {
+            "dir": layer.path.name,
+            "dirty": sorted(layer.dirty),
+            "directories": dump_directories(layer.directories),
+            "filtered": layer.filtered,
+            "replaced": sorted(layer.replaced),
+            "digests": list(layer.digests) if layer.digests is not None else None,
+        }
+        self._checkpoint(b"S", json.dumps([name, meta]))
+
+    def layer_merged(self, i: int, name: str):
+        self._checkpoint(b"M", json.dumps([i, name]))
+
+    def replay(self, index: "LayerIndex", directories: dict[str, tarfile.TarInfo]):
+        """
+        Adds the markers and directories of the applied layers to `index` and
+        `directories`, as if the layers were applied again.
+        """
+        for kind, payload in self._applied_records:
+            if kind == b"D" or kind == b"F":
+                index.claim(payload, kind == b"D")
+            elif kind == b"W":
+                index.whiteout(payload)
+            elif kind == b"O":
+                index.opaque(payload)
+            elif kind == b"A":
+                path, *attrs = json.loads(payload)
+                directories.update(load_directories({path: attrs}))
+            elif kind == b"L":
+                index.commit()
+        self._applied_records = []
+
+    def staged_layers(self) -> dict[str, StagedLayer]:
+        """
+        Returns the staged layers recorded in the journal that are still in the
+        staging directory, or already merged. Other entries of the staging directory
+        (e.g. a layer whose extraction was interrupted) are removed.
+        """
+        staging = self.root / STAGING_DIR
+        layers = {}
+        for name, meta in self.staged.items():
+            path = staging / meta["dir"]
+            if not path.is_dir() and name not in self.merged.values():
+                # Moved to the layer cache since, and looked up there
+                continue
+            layer = StagedLayer(path, set(meta["dirty"]), load_directories(meta["directories"]))
+            layer.filtered = meta["filtered"]
+            layer.replaced = set(meta["replaced"])
+            layer.digests = LayerDigests(*meta["digests"]) if meta["digests"] is not None else None
+            layers[name] = layer
+        if staging.is_dir():
+            kept = {layer.path.name for layer in layers.values()}
+            for entry in os.scandir(staging):
+                if entry.name not in kept:
+                    logger.info(f"Removing {entry.path}, left by the interrupted unpack")
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+        return layers
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,982 @@
+"""
+Layer application.
+
+Layers are applied top-down: the topmost layer is extracted first, and an
+in-memory index records every path it claimed along with its whiteout and
+opaque-directory markers. Members of lower layers that are shadowed or deleted
+by an upper layer are skipped without touching the disk, so every path in the
+output is written exactly once.
+
+References:
+- https://github.com/opencontainers/image-spec/blob/v1.1.0/layer.md#whiteouts
+"""
+
+import contextlib
+import copy
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .chunked import ChunkedLayer, has_toc, read_toc
+from .decompress import CHUNK_SIZE, open_decompressed
+from .image import Blob
+from .pipeline import DecompressionPipeline, ReadAheadBudget
+from .utils import MemberWriter, MyTarFile, copy_entry, directory_attrs, normalize_member_name, set_attrs
+from .stats import STATS, LayerStats
+from .verify import LayerDigests, VerifiedReader, check_digests
+from .writer import open_writer
+
+if typing.TYPE_CHECKING:
+    from .cache import LayerCache
+    from .filters import PathFilter
+    from .journal import Journal
+    from .manifest import Manifest
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# Scratch space inside the output directory, for layers received before their order is known
+STAGING_DIR = ".docker-unpack-staging"
+# Checkpoints of an unpack in progress (see `journal.Journal`)
+JOURNAL_NAME = ".docker-unpack-journal"
+
+# Flags stored in the layer index
+_DIR = 1  # claimed by an upper layer as a directory
+_NONDIR = 2  # claimed by an upper layer as a non-directory
+_WHITEOUT = 4  # deleted by an upper layer
+_OPAQUE = 8  # children hidden by an upper layer
+
+
+def parent_paths(path: str):
+    """
+    Yields the ancestors of a normalized path, from the closest to the root ("").
+    """
+    while path:
+        idx = path.rfind("/")
+        path = path[:idx] if idx >= 0 else ""
+        yield path
+
+
+class _IndexNode:
+    """
+    A directory of the layer index. `flags` holds the committed flags in its low bits
+    and the pending ones shifted by `_PENDING_SHIFT`. Children without children of
+    their own are stored as their flags alone, to keep the index small.
+    """
+
+    __slots__ = ("flags", "children")
+
+    def __init__(self, flags: int = 0):
+        self.flags = flags
+        self.children: dict[str, "_IndexNode | int"] = {}
+
+
+# Pending flags are stored above the committed ones
+_PENDING_SHIFT = 4
+_COMMITTED = (1 << _PENDING_SHIFT) - 1
+# Flags hiding everything below a path, whose children are not needed anymore
+_HIDES_CHILDREN = _NONDIR | _WHITEOUT | _OPAQUE
+
+
+class LayerIndex:
+    """
+    Tracks the paths claimed, whited out and made opaque by the layers applied so far.
+
+    Paths are stored as a trie. Since the members of a layer are mostly grouped by
+    directory, the node of the last directory looked up is cached, and resolving a
+    member usually costs a single dict access. Markers recorded while a layer is
+    being applied only take effect for the layers below it, so they are kept pending
+    until `commit` is called. A path hiding its whole subtree drops its children when
+    committed, since nothing below it can be looked up anymore.
+    """
+
+    def __init__(self):
+        self._root = _IndexNode()
+        # (parent, name) of the entries with pending flags; the root has no parent
+        self._pending: list[tuple[_IndexNode | None, str]] = []
+        self._clear_cache()
+
+    def _clear_cache(self):
+        # Last directory resolved by `is_hidden`: (path, hidden, node or None)
+        self._lookup_cache: tuple[str | None, bool, _IndexNode | None] = (None, False, None)
+        # Last directory resolved by `_mark`: (path, node or None if hidden)
+        self._mark_cache: tuple[str | None, _IndexNode | None] = (None, None)
+
+    def _find_dir(self, dirname: str) -> tuple[bool, _IndexNode | None]:
+        """
+        Returns whether the children of `dirname` are hidden, and its node if it has any.
+        """
+        node = self._root
+        if node.flags & _OPAQUE:
+            return True, None
+        if not dirname:
+            return False, node
+        for part in dirname.split("/"):
+            child = node.children.get(part)
+            if child is None:
+                return False, None
+            if child.__class__ is int:
+                return bool(child & _HIDES_CHILDREN), None
+            if child.flags & _HIDES_CHILDREN:
+                return True, None
+            node = child
+        return False, node
+
+    def is_hidden(self, path: str) -> bool:
+        """
+        Returns whether a member of the current layer at `path` is shadowed or
+        deleted by an upper layer.
+        """
+        dirname, _, name = path.rpartition("/")
+        cached_dir, hidden, node = self._lookup_cache
+        if dirname != cached_dir:
+            hidden, node = self._find_dir(dirname)
+            self._lookup_cache = (dirname, hidden, node)
+        if hidden:
+            return True
+        if node is None:
+            return False
+        child = node.children.get(name)
+        if child is None:
+            return False
+        if child.__class__ is not int:
+            child = child.flags
+        return bool(child & (_DIR | _NONDIR | _WHITEOUT))
+
+    def is_deleted(self, path: str) -> bool:
+        """
+        Returns whether a hidden member at `path` is deleted by a whiteout or an opaque
+        directory, rather than replaced by an entry of an upper layer.
+        """
+        node = self._root
+        if node.flags & _OPAQUE:
+            return True
+        parts = path.split("/")
+        for i, part in enumerate(parts):
+            child = node.children.get(part)
+            if child is None:
+                return False
+            flags = child if child.__class__ is int else child.flags
+            if i == len(parts) - 1:
+                return not flags & (_DIR | _NONDIR) and bool(flags & _WHITEOUT)
+            if flags & (_WHITEOUT | _OPAQUE):
+                return True
+            if flags & _NONDIR or child.__class__ is int:
+                return False
+            node = child
+        return False
+
+    def _make_dir(self, dirname: str) -> _IndexNode | None:
+        """
+        Returns the node of `dirname`, creating it and its parents as needed, or None
+        if it is hidden already.
+        """
+        node = self._root
+        if node.flags & _OPAQUE:
+            return None
+        if not dirname:
+            return node
+        for part in dirname.split("/"):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _IndexNode()
+            elif child.__class__ is int:
+                if child & _HIDES_CHILDREN:
+                    return None
+                child = node.children[part] = _IndexNode(child)
+            elif child.flags & _HIDES_CHILDREN:
+                return None
+            node = child
+        return node
+
+    def _mark(self, path: str, flag: int):
+        flag <<= _PENDING_SHIFT
+        if not path:
+            self._root.flags |= flag
+            self._pending.append((None, ""))
+            return
+        dirname, _, name = path.rpartition("/")
+        cached_dir, node = self._mark_cache
+        if dirname != cached_dir:
+            node = self._make_dir(dirname)
+            self._mark_cache = (dirname, node)
+        if node is None:
+            # Already hidden by a committed marker
+            return
+        child = node.children.get(name, 0)
+        if child.__class__ is int:
+            node.children[name] = child | flag
+        else:
+            child.flags |= flag
+        self._pending.append((node, name))
+
+    def claim(self, path: str, isdir: bool):
+        self._mark(path, _DIR if isdir else _NONDIR)
+
+    def whiteout(self, path: str):
+        self._mark(path, _WHITEOUT)
+
+    def opaque(self, path: str):
+        self._mark(path, _OPAQUE)
+
+    def hide_children(self, path: str):
+        """
+        Hides the children of `path` from the layers below the current one, even if
+        an upper layer claimed it as a directory. Used for hidden non-directories,
+        which still replace the directories of the lower layers.
+        """
+        self._mark(path, _OPAQUE)
+
+    def commit(self):
+        """
+        Makes the markers of the current layer visible to the layers below it.
+        """
+        for parent, name in self._pending:
+            if parent is None:
+                root = self._root
+                root.flags = (root.flags | root.flags >> _PENDING_SHIFT) & _COMMITTED
+                if root.flags & _OPAQUE:
+                    root.children.clear()
+                continue
+            child = parent.children.get(name)
+            if child is None:
+                # Dropped along with a subtree hidden earlier in this commit
+                continue
+            flags = child if isinstance(child, int) else child.flags
+            flags = (flags | flags >> _PENDING_SHIFT) & _COMMITTED
+            if isinstance(child, int) or flags & _HIDES_CHILDREN:
+                parent.children[name] = flags
+            else:
+                child.flags = flags
+        self._pending.clear()
+        self._clear_cache()
+
+
+def _apply_layer(
+    tar: tarfile.TarFile,
+    writer: MemberWriter,
+    index: LayerIndex,
+    directories: dict,
+    stats: LayerStats,
+    path_filter: "PathFilter | None" = None,
+    journal: "Journal | None" = None,
+    bottom: bool = False,
+):
+    """
+    Applies the members of a layer that aren't hidden by upper layers. Members
+    rejected by `path_filter` are claimed like the others, so that they still hide
+    the lower layers, but aren't written. Hidden non-directories aren't written
+    either, but still hide the children of their path, since they replace the
+    directories of the lower layers. The bottom layer has no layers below it
+    to hide, so its paths aren't claimed, and the index doesn't grow with its
+    size. The markers added to the index and the directories are recorded in
+    `journal`. Returns the hardlinks whose target is hidden (or filtered out),
+    grouped by target.
+    """
+    hidden_links: dict[str, list[str]] = {}
+
+    for member in tar:
+        path = normalize_member_name(member.name)
+        dirname, basename = posixpath.split(path)
+
+        if basename == OPAQUE_WHITEOUT:
+            logger.debug(f"Marking {dirname or '/'} as opaque")
+            index.opaque(dirname)
+            if journal is not None:
+                journal.opaque(dirname)
+            stats.opaque_dirs += 1
+            continue
+        if basename.startswith(WHITEOUT_PREFIX):
+            # This is a whiteout file, used to indicate that a file is removed
+            orig_path = posixpath.join(dirname, basename.removeprefix(WHITEOUT_PREFIX))
+            logger.debug(f"Marking {orig_path} as removed")
+            index.whiteout(orig_path)
+            if journal is not None:
+                journal.whiteout(orig_path)
+            stats.whiteouts += 1
+            continue
+
+        if not path or index.is_hidden(path):
+            logger.debug(f"Skipping {member.name}, shadowed by an upper layer")
+            stats.skipped += 1
+            if path and not member.isdir() and not bottom:
+                # It still replaces the directories of the lower layers
+                index.hide_children(path)
+                if journal is not None:
+                    journal.opaque(path)
+            continue
+
+        if not bottom:
+            index.claim(path, member.isdir())
+            if journal is not None:
+                journal.claim(path, member.isdir())
+
+        if path_filter and not path_filter.keep(path, member.isdir()):
+            logger.debug(f"Skipping {member.name}, filtered out")
+            stats.filtered += 1
+            continue
+
+        if member.isdir():
+            # Directory attributes are applied once all layers are extracted, so
+            # that restrictive modes don't prevent lower layers from writing into them.
+            stats.write(writer, tar, member, path)
+            directories[path] = _slim_directory(path, member)
+            if journal is not None:
+                journal.directory(path, member)
+            continue
+
+        if member.islnk():
+            target = normalize_member_name(member.linkname)
+            if index.is_hidden(target) or (path_filter and not path_filter.keep(target, False)):
+                # The on-disk copy of the target belongs to an upper layer (or doesn't
+                # exist), and the layer is read as a stream, so the target's data is
+                # extracted from this layer in a second pass.
+                hidden_links.setdefault(target, []).append(path)
+                continue
+
+        logger.debug(f"Extracting {member.name}")
+        stats.write(writer, tar, member, path)
+
+    index.commit()
+    return hidden_links
+
+
+def _slim_directory(path: str, member: tarfile.TarInfo) -> tarfile.TarInfo:
+    return directory_attrs(path, member.mode, member.uid, member.gid, member.uname, member.gname, member.mtime)
+
+
+def _materialize_links(tar: tarfile.TarFile, writer: MemberWriter, hidden_links: dict[str, list[str]]):
+    """
+    Extracts the data of hidden hardlink targets from a second pass over the layer to
+    the first link pointing to them, and links the others to that copy.
+    """
+    for member in tar:
+        links = hidden_links.get(normalize_member_name(member.name))
+        if not links or not member.isfile():
+            continue
+        writer.write(tar, member, links[0])
+        for link in links[1:]:
+            writer.link(links[0], link)
+
+
+def _set_directory_attrs(root: Path, directories: dict[str, tarfile.TarInfo]):
+    # Set directory attributes deepest-first, mirroring tarfile.extractall
+    for path in sorted(directories, reverse=True):
+        dirpath = os.path.join(root, path)
+        if not os.path.isdir(dirpath) or os.path.islink(dirpath):
+            # Removed by an upper layer
+            continue
+        set_attrs(directories[path], dirpath)
+
+
+@contextlib.contextmanager
+def open_layer(
+    fileobj,
+    decompressors: typing.Sequence[str],
+    name: str,
+    stats: LayerStats,
+    jobs: int = 1,
+    readahead_bytes: int = 512 * 1024 * 1024,
+    skip: typing.Callable[[str], bool] | None = None,
+):
+    """
+    Opens a layer blob to iterate over its members. Seekable eStargz and zstd:chunked
+    layers are read through their table of contents, with their chunks decompressed
+    by `jobs` threads (see `ChunkedLayer`, which skips the contents of the paths for
+    which `skip` is true). Other layers are read as a (possibly compressed) tar stream.
+    """
+    toc = read_toc(fileobj)
+    if toc is not None:
+        logger.info(f"Reading {name} through its {toc.format} table of contents ({len(toc.members)} members)")
+        with ChunkedLayer(fileobj, toc, jobs, readahead_bytes, stats, skip) as tar:
+            yield tar
+        return
+    with open_decompressed(fileobj, decompressors, name) as f, MyTarFile.open(fileobj=stats.meter(f), mode="r|") as tar:
+        yield tar
+
+
+def apply_layers(
+    blobs: list[Blob],
+    root: Path,
+    jobs: int = 1,
+    readahead_bytes: int = 512 * 1024 * 1024,
+    decompressors: typing.Sequence[str] = (),
+    write_jobs: int = 1,
+    path_filter: "PathFilter | None" = None,
+    manifest: "Manifest | None" = None,
+    expected: dict[str, LayerDigests] | None = None,
+    sync: bool = False,
+    journal: "Journal | None" = None,
+    sparse: bool = False,
+):
+    """
+    Applies the layers (ordered bottom to top, as in the image manifest) to `root`.
+    Up to `jobs` layers are decompressed concurrently, preferably with the given
+    `decompressors` backends, and files are written with `write_jobs` threads (and
+    fsynced with `sync`, with holes for their all-zero blocks with `sparse`). Only
+    the paths kept by `path_filter` are written, the digests of the files written
+    are recorded in `manifest`, and the layers are checked against their
+    `expected` digests. Each layer applied is checkpointed
+    in `journal`, and the layers it already lists as applied are skipped.
+    """
+    with open_writer(root, write_jobs, manifest, sync, sparse) as writer:
+        directories = write_layers(
+            blobs, writer, jobs, readahead_bytes, decompressors, path_filter, expected=expected, journal=journal
+        )
+    _set_directory_attrs(root, directories)
+
+
+def write_layers(
+    blobs: list[Blob],
+    writer: MemberWriter,
+    jobs: int = 1,
+    readahead_bytes: int = 512 * 1024 * 1024,
+    decompressors: typing.Sequence[str] = (),
+    path_filter: "PathFilter | None" = None,
+    unfiltered: typing.Collection[str] = (),
+    expected: dict[str, LayerDigests] | None = None,
+    journal: "Journal | None" = None,
+) -> dict[str, tarfile.TarInfo]:
+    """
+    Passes the members of the layers (ordered bottom to top) that make up the merged
+    tree to `writer`, top layer first. Members rejected by `path_filter` are left
+    out, except in the blobs named in `unfiltered`. Blobs with an entry in
+    `expected` are checked against its digests while they are read, except for the
+    ones read through their table of contents. Once a layer is written (and
+    verified), it is checkpointed in `journal`. Returns the directory members, whose
+    attributes are left for the caller to apply.
+    """
+    index = LayerIndex()
+    directories = {}
+
+    if journal is not None and journal.applied:
+        applied = [blob.name for blob in blobs[::-1]][: len(journal.applied)]
+        if applied != journal.applied:
+            raise Exception(f"The journal lists layers {journal.applied} as applied, but the image has {applied} on top")
+        logger.info(f"Resuming after {len(applied)} layers applied by an interrupted unpack")
+        journal.replay(index, directories)
+        blobs = blobs[: len(blobs) - len(applied)]
+
+    # Layers with a table of contents are decompressed chunk by chunk instead of as a stream
+    chunked = set()
+    for blob in blobs:
+        with blob.open() as f:
+            if has_toc(f):
+                chunked.add(blob.name)
+
+    if expected and chunked & expected.keys():
+        logger.info(f"Not verifying {len(chunked & expected.keys())} layers read through their table of contents")
+    with DecompressionPipeline(blobs[::-1], jobs, readahead_bytes, decompressors, chunked, expected) as pipeline:
+        for i, (blob, f) in enumerate(pipeline):
+            logger.info(f"Extracting {blob}")
+            bottom = i == len(blobs) - 1
+            stats = STATS.layer(blob.name)
+            stats.compressed_bytes = blob.size
+            start = time.perf_counter()
+            layer_filter = path_filter if blob.name not in unfiltered else None
+
+            if f is None:
+                # The contents of hidden and filtered files are not decompressed
+                skip = index.is_hidden
+                if layer_filter:
+
+                    def skip(path: str) -> bool:
+                        return index.is_hidden(path) or not layer_filter.keep(path, False)
+
+                with (
+                    blob.open() as raw,
+                    open_layer(raw, decompressors, blob.name, stats, jobs, readahead_bytes, skip) as tar,
+                ):
+                    hidden_links = _apply_layer(
+                        tar, writer, index, directories, stats, layer_filter, journal, bottom
+                    )
+                    if hidden_links:
+                        _materialize_links(tar, writer, hidden_links)
+            else:
+                with MyTarFile.open(fileobj=stats.meter(f), mode="r|") as tar:
+                    hidden_links = _apply_layer(
+                        tar, writer, index, directories, stats, layer_filter, journal, bottom
+                    )
+                # Read the end of the layer, so that its digests are checked before it is checkpointed
+                while f.read(CHUNK_SIZE):
+                    pass
+                if hidden_links:
+                    logger.info(f"Materializing {len(hidden_links)} hardlink targets from {blob.name}")
+                    with (
+                        open_decompressed(blob.open(), decompressors, blob.name) as f,
+                        MyTarFile.open(fileobj=f, mode="r|") as tar,
+                    ):
+                        _materialize_links(tar, writer, hidden_links)
+            if journal is not None:
+                writer.wait_all()
+                journal.layer_applied(blob.name)
+            stats.seconds += time.perf_counter() - start
+            logger.info(f"Skipped {stats.skipped} members of {blob.name} shadowed by upper layers")
+            if stats.filtered:
+                logger.info(f"Filtered out {stats.filtered} members of {blob.name}")
+
+    return directories
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _remove_inside(root: str, path: str):
+    """
+    Removes `root/path` if it exists, unless one of its parents is a symlink (which
+    could point outside of `root`).
+    """
+    dirname = os.path.join(root, posixpath.dirname(path))
+    if os.path.realpath(dirname) != os.path.join(os.path.realpath(root), posixpath.dirname(path)).rstrip("/"):
+        return
+    if os.path.lexists(os.path.join(root, path)):
+        _remove(os.path.join(root, path))
+
+
+class StagedLayer:
+    """
+    A layer extracted as-is (whiteout markers included) into a directory.
+    """
+
+    def __init__(self, path: Path, dirty=None, directories=None, shared: bool = False):
+        self.path = path
+        # Relative paths of the directories containing whiteout markers, and their parents
+        self.dirty: set[str] = dirty if dirty is not None else set()
+        # Directory attributes, applied once the layer is merged
+        self.directories: dict[str, tarfile.TarInfo] = directories if directories is not None else {}
+        # Shared layers (e.g. in the layer cache) are linked or copied, never moved
+        self.shared = shared
+        # Whether a path filter was applied when extracting the layer
+        self.filtered = False
+        # Filtered non-directories that replace a directory a lower layer may have kept
+        self.replaced: set[str] = set()
+        # Digests computed while the layer was extracted, if it was verified
+        self.digests: LayerDigests | None = None
+
+
+def extract_layer(
+    fileobj,
+    layer: StagedLayer,
+    decompressors: typing.Sequence[str] = (),
+    name: str = "",
+    write_jobs: int = 1,
+    jobs: int = 1,
+    path_filter: "PathFilter | None" = None,
+    reopen: typing.Callable[[], typing.BinaryIO] | None = None,
+    manifest: "Manifest | None" = None,
+    verify: bool = False,
+    expected: LayerDigests | None = None,
+    sync: bool = False,
+    sparse: bool = False,
+):
+    """
+    Extracts a (possibly compressed) layer tarball into `layer.path`, writing files
+    with `write_jobs` threads (fsyncing them with `sync`, and with holes for their
+    all-zero blocks with `sparse`) and recording their digests in `manifest`.
+    Seekable layers with a table of contents are decompressed with `jobs` threads.
+
+    With `verify`, the digests of other layers are computed while they are read,
+    saved to `layer.digests`, and checked against `expected` if given.
+
+    Members rejected by `path_filter` are left out if the layer can be read again
+    with `reopen`, to extract the targets of hardlinks to filtered files in a
+    second pass. Otherwise, the filter is applied when the layer is merged.
+    """
+    stats = STATS.layer(name)
+    start = time.perf_counter()
+    if reopen is None:
+        path_filter = None
+    layer.filtered = bool(path_filter)
+    filtered_links: dict[str, list[str]] = {}
+    reader = None
+    if verify and not has_toc(fileobj):
+        reader = fileobj = VerifiedReader(fileobj, decompressors, name, expected)
+    with open_writer(layer.path, write_jobs, manifest, sync, sparse) as writer:
+        with open_layer(fileobj, decompressors, name, stats, jobs) as tar:
+            _extract_members(tar, writer, layer, stats, path_filter, filtered_links)
+            if reader is not None:
+                # Read the end of the layer, so that its digests are checked
+                while reader.read(CHUNK_SIZE):
+                    pass
+                layer.digests = reader.digests
+        if filtered_links:
+            logger.info(f"Materializing {len(filtered_links)} filtered hardlink targets from {name}")
+            with open_layer(reopen(), decompressors, name, stats, jobs) as tar:
+                _materialize_links(tar, writer, filtered_links)
+    stats.seconds += time.perf_counter() - start
+
+
+def _extract_members(
+    tar: tarfile.TarFile,
+    writer: MemberWriter,
+    layer: StagedLayer,
+    stats: LayerStats,
+    path_filter: "PathFilter | None",
+    filtered_links: dict[str, list[str]],
+):
+    """
+    Writes the members of a layer as-is (whiteout markers included) to a staged
+    layer, except those rejected by `path_filter`. Hardlinks to filtered files are
+    added to `filtered_links`, grouped by target.
+    """
+    for member in tar:
+        path = normalize_member_name(member.name)
+        if not path:
+            continue
+        dirname, basename = posixpath.split(path)
+        if basename.startswith(WHITEOUT_PREFIX):
+            if path_filter and dirname and not path_filter.keep(dirname, True):
+                # Nothing below a filtered directory was written, so there is nothing to remove
+                continue
+            layer.dirty.add(dirname)
+            layer.dirty.update(parent_paths(dirname))
+            if basename == OPAQUE_WHITEOUT:
+                stats.opaque_dirs += 1
+            else:
+                stats.whiteouts += 1
+            # Markers are kept in the staged layer, and applied when it is merged
+            writer.write(tar, member, path)
+            continue
+        if path_filter:
+            if not path_filter.keep(path, member.isdir()):
+                stats.filtered += 1
+                if not member.isdir() and path_filter.keep(path, True):
+                    layer.replaced.add(path)
+                continue
+            if member.islnk() and not path_filter.keep(normalize_member_name(member.linkname), False):
+                filtered_links.setdefault(normalize_member_name(member.linkname), []).append(path)
+                continue
+        stats.write(writer, tar, member, path)
+        if member.isdir():
+            layer.directories[path] = _slim_directory(path, member)
+
+
+class StagedLayers:
+    """
+    Layers that are extracted before they are applied, e.g. because they arrive before
+    their order in the image is known, or because they come from the layer cache.
+
+    Each layer is extracted as-is (whiteout markers included) into its own directory
+    under `STAGING_DIR`, then merged bottom-up into the output directory. Merging
+    moves entries with `os.rename`, and whole directories that don't exist in the
+    output yet are moved in one step, so file contents are never copied. Layers from
+    the cache are hardlinked, reflinked or copied instead.
+
+    With `verify`, the digests of the layers are computed while they are extracted.
+    Layers are checked against the `expected` digests as soon as they are read, and
+    layers staged before the image manifest is read are checked by `check`. With
+    `sync`, extracted files are fsynced before they are closed, and with `sparse`,
+    their all-zero blocks are left as holes.
+
+    Each layer staged or merged is checkpointed in `journal`. When resuming, the
+    layers it lists as staged are kept, and the ones it lists as merged are skipped.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        jobs: int = 1,
+        readahead_bytes: int = 512 * 1024 * 1024,
+        decompressors: typing.Sequence[str] = (),
+        cache: "LayerCache | None" = None,
+        skip: typing.Collection[str] = (),
+        write_jobs: int = 1,
+        path_filter: "PathFilter | None" = None,
+        manifest: "Manifest | None" = None,
+        verify: bool = False,
+        expected: dict[str, LayerDigests] | None = None,
+        sync: bool = False,
+        journal: "Journal | None" = None,
+        sparse: bool = False,
+    ):
+        self.root = root
+        self.sync = sync
+        self.sparse = sparse
+        self.journal = journal
+        self.path_filter = path_filter
+        self.manifest = manifest
+        self.verify = verify
+        self.expected = expected if expected is not None else {}
+        self.jobs = jobs
+        self.decompressors = decompressors
+        self.write_jobs = write_jobs
+        self.cache = cache
+        # Names of layer blobs that are already applied to the output (see `unpack --update`)
+        self.skip = skip
+        self.staging = root / STAGING_DIR
+        self.layers: dict[str, StagedLayer] = journal.staged_layers() if journal is not None else {}
+        # Staging directories are numbered in order, after those of the layers kept from an interrupted unpack
+        self.next_dir = 1 + max((int(layer.path.name) for layer in self.layers.values()), default=-1)
+        if self.layers:
+            logger.info(f"Resuming with {len(self.layers)} layers staged by an interrupted unpack")
+        # Layer blobs that fit in the read-ahead budget are buffered and extracted
+        # concurrently, while the main thread keeps reading the input.
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="stage") if jobs > 1 else None
+        self.budget = ReadAheadBudget(readahead_bytes)
+        self.futures = []
+
+    def _new_layer(self, name: str) -> StagedLayer:
+        layer_dir = self.staging / str(self.next_dir)
+        self.next_dir += 1
+        layer_dir.mkdir(parents=True)
+        layer = self.layers[name] = StagedLayer(layer_dir)
+        return layer
+
+    def _staged(self, name: str, layer: StagedLayer):
+        if self.journal is not None:
+            self.journal.layer_staged(name, layer)
+
+    def stage(self, name: str, fileobj, size: int):
+        """
+        Extracts a layer tarball of `size` bytes read from `fileobj` into the staging area.
+        """
+        if name in self.skip:
+            logger.info(f"Skipping layer {name}, which is already applied")
+            return
+        if name in self.layers:
+            logger.info(f"Skipping layer {name}, staged by an interrupted unpack")
+            return
+
+        if self.cache is not None and (cached := self.cache.lookup_blob(name)) is not None:
+            logger.info(f"Using cached layer for {name}")
+            self.layers[name] = cached
+            STATS.layer(name).cached = True
+            return
+
+        STATS.layer(name).compressed_bytes = size
+
+        layer = self._new_layer(name)
+        if self.executor is None or size > self.budget.max_bytes:
+            # The stream can't be read twice, so the layer is filtered when merged
+            extract_layer(
+                fileobj,
+                layer,
+                self.decompressors,
+                name,
+                self.write_jobs,
+                self.jobs,
+                manifest=self.manifest,
+                verify=self.verify,
+                expected=self.expected.get(name),
+                sync=self.sync,
+                sparse=self.sparse,
+            )
+            self._staged(name, layer)
+            return
+
+        self.budget.acquire(size)
+        data = b"".join(iter(lambda: fileobj.read(CHUNK_SIZE), b""))
+        self.futures.append(self.executor.submit(self._extract_buffered, name, layer, data))
+
+    def _extract_buffered(self, name: str, layer: StagedLayer, data: bytes):
+        try:
+            extract_layer(
+                io.BytesIO(data),
+                layer,
+                self.decompressors,
+                name,
+                self.write_jobs,
+                self.jobs,
+                self.path_filter,
+                lambda: io.BytesIO(data),
+                self.manifest,
+                self.verify,
+                self.expected.get(name),
+                self.sync,
+                self.sparse,
+            )
+            self._staged(name, layer)
+        finally:
+            self.budget.release(len(data))
+
+    def stage_blob(self, blob: Blob, key: str | None = None):
+        """
+        Adds a layer from a seekable blob. With a layer cache, the cached copy of the
+        layer with the given `key` (diff_id) is used if there is one, and the layer is
+        cached otherwise.
+        """
+        if blob.name in self.layers:
+            return
+        STATS.layer(blob.name).compressed_bytes = blob.size
+        if self.cache is None or key is None:
+            layer = self._new_layer(blob.name)
+
+            def extract():
+                extract_layer(
+                    blob.open(),
+                    layer,
+                    self.decompressors,
+                    blob.name,
+                    self.write_jobs,
+                    self.jobs,
+                    self.path_filter,
+                    blob.open,
+                    self.manifest,
+                    self.verify,
+                    self.expected.get(blob.name),
+                    self.sync,
+                    self.sparse,
+                )
+                self._staged(blob.name, layer)
+
+        else:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"Using cached layer {key} for {blob.name}")
+                self.layers[blob.name] = cached
+                STATS.layer(blob.name).cached = True
+                return
+
+            # Cached layers are extracted whole, and filtered when merged
+            layer = self.layers[blob.name] = StagedLayer(self.cache.new_tmp_dir())
+
+            def extract():
+                extract_layer(
+                    blob.open(),
+                    layer,
+                    self.decompressors,
+                    blob.name,
+                    self.write_jobs,
+                    self.jobs,
+                    manifest=self.manifest,
+                    verify=self.verify,
+                    expected=self.expected.get(blob.name),
+                    sync=self.sync,
+                    sparse=self.sparse,
+                )
+                # Corrupted layers raise before they are cached
+                self.layers[blob.name] = self.cache.insert(key, layer, blob.name)
+
+        if self.executor is None:
+            extract()
+        else:
+            self.futures.append(self.executor.submit(extract))
+
+    def wait(self):
+        """
+        Waits for the layers being extracted in the background.
+        """
+        if self.executor is None:
+            return
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def check(self, expected: dict[str, LayerDigests]):
+        """
+        Checks the layers extracted so far against the `expected` digests, and the
+        layers staged from now on as they are read.
+        """
+        self.wait()
+        self.expected.update(expected)
+        for name, layer in self.layers.items():
+            if layer.digests is not None:
+                check_digests(name, layer.digests, expected.get(name))
+
+    def _merge(
+        self, src: str, dst: str, rel: str, dirty: set[str], transfer: str, path_filter: "PathFilter | None" = None
+    ):
+        with os.scandir(src) as it:
+            entries = list(it)
+
+        # Deletions apply to the lower layers only, so they are handled before any
+        # entry of this layer is moved into place.
+        for entry in entries:
+            if entry.name == OPAQUE_WHITEOUT:
+                for name in os.listdir(dst):
+                    if not (rel == "" and name in (STAGING_DIR, JOURNAL_NAME)):
+                        _remove(os.path.join(dst, name))
+                if transfer == "rename":
+                    # Applied once: if the merge is interrupted and resumed, the entries of
+                    # this layer already moved into place must not be removed
+                    os.unlink(entry.path)
+            elif entry.name.startswith(WHITEOUT_PREFIX):
+                orig_path = os.path.join(dst, entry.name.removeprefix(WHITEOUT_PREFIX))
+                logger.debug(f"Removing {orig_path}")
+                if os.path.lexists(orig_path):
+                    _remove(orig_path)
+
+        for entry in entries:
+            if entry.name.startswith(WHITEOUT_PREFIX):
+                continue
+            relpath = posixpath.join(rel, entry.name)
+            target = os.path.join(dst, entry.name)
+            isdir = entry.is_dir(follow_symlinks=False)
+            if path_filter and not path_filter.keep(relpath, isdir):
+                # Filtered entries still replace the entries of the lower layers
+                if os.path.lexists(target) and not (isdir and os.path.isdir(target) and not os.path.islink(target)):
+                    _remove(target)
+                continue
+            if isdir:
+                if os.path.isdir(target) and not os.path.islink(target):
+                    self._merge(entry.path, target, relpath, dirty, transfer, path_filter)
+                    continue
+                if relpath in dirty or transfer != "rename" or path_filter:
+                    # Directories containing whiteout markers (which must not end up in
+                    # the output), directories that can't be moved and directories that
+                    # may contain filtered entries are merged entry by entry
+                    if os.path.lexists(target):
+                        _remove(target)
+                    os.mkdir(target)
+                    self._merge(entry.path, target, relpath, dirty, transfer, path_filter)
+                    continue
+            if os.path.lexists(target):
+                _remove(target)
+            if transfer == "rename":
+                os.rename(entry.path, target)
+            else:
+                copy_entry(entry.path, target, transfer)
+
+    def merge(self, names: list[str], keys: list[str] | None = None, root: Path | None = None):
+        """
+        Merges the staged layers (ordered bottom to top) into the output directory, or
+        into `root` if given. When a layer cache is used, `keys` are the diff_ids of the
+        layers, under which newly extracted layers are added to the cache.
+        """
+        self.wait()
+        root = root or self.root
+        directories = {}
+        for i, name in enumerate(names):
+            layer = self.layers[name]
+            if self.journal is not None and self.journal.merged.get(i) == name:
+                directories.update(layer.directories)
+                continue
+            if self.cache is not None and not layer.shared and keys:
+                layer = self.layers[name] = self.cache.insert(keys[i], layer, name)
+
+            if layer.shared:
+                transfer = self.cache.link_mode
+            elif name in names[i + 1 :]:
+                # Layers referenced more than once are copied until their last use
+                transfer = "copy"
+            else:
+                transfer = "rename"
+
+            for path in layer.replaced:
+                _remove_inside(str(root), path)
+
+            logger.info(f"Merging layer {name} ({transfer})")
+            path_filter = self.path_filter if not layer.filtered else None
+            self._merge(str(layer.path), str(root), "", layer.dirty, transfer, path_filter)
+            directories.update(layer.directories)
+            if self.journal is not None:
+                self.journal.layer_merged(i, name)
+
+        if self.staging.exists():
+            shutil.rmtree(self.staging)
+        _set_directory_attrs(root, directories)
@@ -0,0 +1,166 @@
+"""
+Content manifest of an unpacked image.
+
+File contents are hashed as they are written, so that publishing the tree (e.g. to
+CVMFS) doesn't need another pass over it. Digests are recorded by inode, since
+staged layers are moved into place with `os.rename` and cached layers are
+hardlinked, and the manifest is assembled from a walk of the final tree that only
+stats its entries. Files that weren't written in this run (layers taken from the
+cache, files left in place by `unpack --update`, the Apptainer files) are read
+back to hash them. Inodes of removed files can be reused by files written later
+(e.g. when merging streamed layers frees the inodes of replaced files), so each
+digest is recorded with the size and mtime of its file, and files that don't match
+them anymore are read back as well. The ctime can't be checked, since renames and
+hardlinks change it.
+
+The manifest has one JSON array per line, `[path, mode, size, digest]`, in the
+order of a depth-first walk of the tree with names sorted. `mode` is the full `st_mode` (file type included), and the digest is
+`<algorithm>:<hex>` for regular files and null for other entries.
+"""
+
+import importlib
+import importlib.util
+import json
+import os
+import posixpath
+import stat
+import tarfile
+import typing
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .durability import fsync_dir
+from .utils import normalize_member_name
+
+# Hash algorithms: (module, constructor) for each name
+HASHES = {
+    "sha256": ("hashlib", "sha256"),
+    "blake3": ("blake3", "blake3"),
+    "xxh128": ("xxhash", "xxh3_128"),
+}
+
+_BUFFER_SIZE = 1024 * 1024
+
+_DEVICE_TYPES = {tarfile.CHRTYPE: stat.S_IFCHR, tarfile.BLKTYPE: stat.S_IFBLK}
+
+
+class Manifest:
+    """
+    Digests of the files written by an unpack, by inode, or by path for tar output.
+    """
+
+    def __init__(self, algorithm: str = "sha256"):
+        if algorithm not in HASHES:
+            raise Exception(f"Unknown hash {algorithm!r}, expected one of {list(HASHES)}")
+        module, constructor = HASHES[algorithm]
+        if importlib.util.find_spec(module) is None:
+            raise Exception(f"Hash {algorithm} needs the {module} module, install it with `pip install {module}`")
+        self.algorithm = algorithm
+        self.new = getattr(importlib.import_module(module), constructor)
+        # (st_dev, st_ino) -> (st_size, st_mtime_ns, digest)
+        self.by_inode: dict[tuple[int, int], tuple[int, int, str]] = {}
+        # Entries written to a tar stream, by path, and the targets of its hardlinks
+        self.entries: dict[str, list] = {}
+        self.links: dict[str, str] = {}
+        self.rehashed = 0
+
+    def digest(self, h) -> str:
+        return f"{self.algorithm}:{h.hexdigest()}"
+
+    def record(self, fd: int, h):
+        """
+        Records the digest `h` of the file open at `fd`.
+        """
+        st = os.fstat(fd)
+        self.by_inode[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, self.digest(h))
+
+    def record_member(self, member: tarfile.TarInfo, path: str, h=None):
+        """
+        Records a member written to a tar stream at `path`, with the digest `h` of its contents.
+        """
+        if member.islnk():
+            self.links[path] = normalize_member_name(member.linkname)
+            return
+        size = 0
+        if member.isreg():
+            file_type, size = stat.S_IFREG, member.size
+        elif member.isdir():
+            file_type = stat.S_IFDIR
+        elif member.issym():
+            file_type, size = stat.S_IFLNK, len(member.linkname.encode())
+        else:
+            file_type = _DEVICE_TYPES.get(member.type, stat.S_IFIFO)
+        self.entries[path] = [path, file_type | member.mode, size, self.digest(h) if h is not None else None]
+
+    def _tar_entries(self) -> typing.Iterator[list]:
+        # In the order of a walk of the tree
+        for path in sorted(self.entries.keys() | self.links.keys(), key=lambda p: p.split("/")):
+            if path in self.links:
+                # Hardlinks share the entry of their target
+                target = self.entries.get(self.links[path])
+                if target is not None:
+                    yield [path, *target[1:]]
+            else:
+                yield self.entries[path]
+
+    def _hash_file(self, path: str) -> str:
+        h = self.new()
+        with open(path, "rb", buffering=0) as f:
+            while chunk := f.read(_BUFFER_SIZE):
+                h.update(chunk)
+        return self.digest(h)
+
+    def _scandir(self, root: str, rel: str) -> typing.Iterator[os.DirEntry]:
+        with os.scandir(os.path.join(root, rel)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        return iter(entries)
+
+    def _walk(self, root: str, skip: typing.Collection[str]) -> typing.Iterator[list]:
+        # Depth first, without recursion since trees can be deeper than the recursion limit
+        stack = [("", self._scandir(root, ""))]
+        while stack:
+            rel, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if entry.path in skip:
+                continue
+            path = posixpath.join(rel, entry.name)
+            st = entry.stat(follow_symlinks=False)
+            digest = None
+            if stat.S_ISREG(st.st_mode):
+                size, mtime_ns, digest = self.by_inode.get((st.st_dev, st.st_ino), (None, None, None))
+                if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+                    digest = self._hash_file(entry.path)
+                    self.by_inode[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, digest)
+                    self.rehashed += 1
+            yield [path, st.st_mode, st.st_size, digest]
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((path, self._scandir(root, path)))
+
+    def write(self, path: Path, root: Path | None = None, sync: bool = False):
+        """
+        Writes the manifest of the tree at `root`, or of the tar stream written with
+        this manifest, to `path`, and fsyncs it with `sync`.
+        """
+        tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+        self.rehashed = 0
+        if root is not None:
+            entries = self._walk(os.path.abspath(root), {os.path.abspath(path), os.path.abspath(tmp_path)})
+        else:
+            entries = self._tar_entries()
+        count = 0
+        with open(tmp_path, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                count += 1
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if sync:
+            fsync_dir(path.parent)
+        logger.info(f"Wrote the manifest of {count} entries to {path} ({self.rehashed} files hashed from disk)")
+
@@ -0,0 +1,194 @@
+"""
+Parallel layer decompression.
+
+A thread pool decompresses several layers ahead of the one being applied (zlib, lzma,
+bz2 and zstandard all release the GIL while inflating). Decompressed chunks are
+buffered up to a memory cap, and the single applier consumes the layers strictly in
+order, so whiteout semantics are unaffected.
+"""
+
+import io
+import queue
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from .decompress import CHUNK_SIZE, open_decompressed
+from .image import Blob
+from .verify import LayerDigests, VerifiedReader
+
+# Chunks queued per layer, on top of the memory cap, for the layer being applied
+_QUEUE_SIZE = 16
+
+
+class ReadAheadBudget:
+    """
+    Bounds the number of decompressed bytes buffered for the layers ahead of the one
+    being applied. The layer being applied is never blocked by the budget, so the
+    pipeline always makes progress.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.current = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, n: int, seq: int | None = None):
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.closed
+                or (seq is not None and seq <= self.current)
+                or self.used + n <= self.max_bytes
+            )
+            self.used += n
+
+    def release(self, n: int):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+    def advance(self, seq: int):
+        with self.cond:
+            self.current = seq
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Reads the decompressed chunks of a layer from the queue filled by its worker.
+    """
+
+    def __init__(self, chunks: queue.Queue, budget: ReadAheadBudget):
+        self.chunks = chunks
+        self.budget = budget
+        self.chunk = memoryview(b"")
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.chunk:
+            if self.eof:
+                return 0
+            item = self.chunks.get()
+            if item is None:
+                self.eof = True
+                return 0
+            if isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            self.budget.release(len(item))
+            self.chunk = memoryview(item)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+
+class DecompressionPipeline:
+    """
+    Yields `(blob, reader)` pairs, in order, where `reader` returns the decompressed
+    contents of the layer blob. With `jobs > 1`, up to `jobs` layers are decompressed
+    concurrently and at most `max_bytes` of read-ahead is buffered. `decompressors`
+    lists the preferred decompression backends. Blobs named in `skip` (e.g. layers
+    read through their table of contents) are yielded without a reader. Blobs with an
+    entry in `expected` have their digest and diff_id checked as they are read, and
+    the reader raises once its layer turns out to be corrupted.
+    """
+
+    def __init__(
+        self,
+        blobs: list[Blob],
+        jobs: int = 1,
+        max_bytes: int = 512 * 1024 * 1024,
+        decompressors: typing.Sequence[str] = (),
+        skip: typing.Collection[str] = (),
+        expected: dict[str, LayerDigests] | None = None,
+    ):
+        self.blobs = blobs
+        self.jobs = jobs
+        self.decompressors = decompressors
+        self.skip = skip
+        self.expected = expected or {}
+        self.budget = ReadAheadBudget(max_bytes)
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.budget.close()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def _put(self, chunks: queue.Queue, item):
+        while not self.budget.closed:
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _open(self, blob: Blob) -> typing.BinaryIO:
+        if blob.name in self.expected:
+            return io.BufferedReader(
+                VerifiedReader(blob.open(), self.decompressors, blob.name, self.expected[blob.name]), CHUNK_SIZE
+            )
+        return open_decompressed(blob.open(), self.decompressors, blob.name)
+
+    def _decompress(self, seq: int, blob: Blob, chunks: queue.Queue):
+        try:
+            with self._open(blob) as f:
+                while not self.budget.closed:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.budget.acquire(len(chunk), seq)
+                    self._put(chunks, chunk)
+            self._put(chunks, None)
+        except BaseException as e:
+            self._put(chunks, e)
+
+    def __iter__(self) -> typing.Iterator[tuple[Blob, typing.BinaryIO | None]]:
+        if self.jobs <= 1:
+            for blob in self.blobs:
+                if blob.name in self.skip:
+                    yield blob, None
+                    continue
+                with self._open(blob) as f:
+                    yield blob, f
+                    # Read the end of the layer, so that its digests are checked
+                    while f.read(CHUNK_SIZE):
+                        pass
+            return
+
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="decompress")
+        queues = []
+        for seq, blob in enumerate(self.blobs):
+            chunks = queue.Queue(maxsize=_QUEUE_SIZE)
+            queues.append(chunks)
+            if blob.name not in self.skip:
+                self.executor.submit(self._decompress, seq, blob, chunks)
+
+        for seq, blob in enumerate(self.blobs):
+            self.budget.advance(seq)
+            if blob.name in self.skip:
+                yield blob, None
+                continue
+            reader = ChunkReader(queues[seq], self.budget)
+            yield blob, io.BufferedReader(reader, buffer_size=CHUNK_SIZE)
+            # Release whatever the applier didn't read (e.g. padding after the end of the archive)
+            while reader.read(CHUNK_SIZE):
+                pass
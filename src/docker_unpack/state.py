@@ -0,0 +1,74 @@
+"""
+State record of an unpacked image, kept in the output directory.
+
+The record lists the layer chain the output was built from, so that a later
+`unpack --update` can apply only the layers that changed.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+from .cache import blob_digest
+from .durability import fsync_dir
+from .image import ImageArchive
+
+STATE_PATH = ".singularity.d/docker-unpack.json"
+STATE_VERSION = 1
+
+
+def layer_chain(image: ImageArchive) -> list[dict]:
+    """
+    Returns the layers of an image, bottom to top, identified by their diff_id when the
+    config lists them, and by their blob digest (or archive member name) otherwise.
+    """
+    diff_ids = image.config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(image.layers):
+        diff_ids = [None] * len(image.layers)
+    return [
+        {"name": name, "id": diff_id or blob_digest(name) or name}
+        for name, diff_id in zip(image.layers, diff_ids)
+    ]
+
+
+def read_state(root: Path) -> dict | None:
+    try:
+        state = json.loads((root / STATE_PATH).read_text())
+    except FileNotFoundError:
+        return None
+    if state.get("version") != STATE_VERSION:
+        logger.warning(f"Ignoring state record of unknown version {state.get('version')} in {root}")
+        return None
+    return state
+
+
+def write_state(root: Path, chain: list[dict], sync: bool = False, **extra):
+    """
+    Atomically replaces the state record of `root`. With `sync`, the record is on
+    disk when this returns.
+    """
+    path = root / STATE_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps({"version": STATE_VERSION, "layers": chain, **extra}, indent=2))
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if sync:
+        fsync_dir(path.parent)
+
+
+def common_prefix(old_chain: list[dict], new_chain: list[dict]) -> int:
+    """
+    Returns the number of bottom layers shared by two layer chains.
+    """
+    n = 0
+    for old, new in zip(old_chain, new_chain):
+        if old["id"] != new["id"]:
+            break
+        n += 1
+    return n
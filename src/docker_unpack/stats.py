@@ -0,0 +1,193 @@
+"""
+Timings and counters of an unpack, reported with `unpack --stats-json`.
+
+`STATS` collects the duration of each phase and, for each layer, the bytes read,
+the members applied by type, and how the time was split between reading the
+(decompressed) layer stream and writing to the filesystem.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import resource
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from watcloud_utils.logging import logger
+
+
+class LayerStats:
+    """
+    Counters of a layer. `bytes` counts the decompressed stream, `read_seconds` the
+    time spent reading (and decompressing) it, and `write_seconds` the time spent
+    creating entries on disk.
+    """
+
+    __slots__ = (
+        "compressed_bytes",
+        "bytes",
+        "files",
+        "dirs",
+        "symlinks",
+        "hardlinks",
+        "other",
+        "whiteouts",
+        "opaque_dirs",
+        "skipped",
+        "filtered",
+        "read_seconds",
+        "write_seconds",
+        "seconds",
+        "cached",
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+        self.cached = False
+
+    def meter(self, fileobj) -> "MeteredReader":
+        """
+        Wraps a layer stream, counting the bytes and the time spent reading it.
+        """
+        return MeteredReader(fileobj, self)
+
+    def count(self, member):
+        if member.isreg():
+            self.files += 1
+        elif member.isdir():
+            self.dirs += 1
+        elif member.issym():
+            self.symlinks += 1
+        elif member.islnk():
+            self.hardlinks += 1
+        else:
+            self.other += 1
+
+    def write(self, writer, tar, member, path: str):
+        """
+        Writes a member with `writer`, accounting the time spent reading its contents
+        from the layer stream as read time.
+        """
+        start, read_seconds = time.perf_counter(), self.read_seconds
+        writer.write(tar, member, path)
+        self.write_seconds += time.perf_counter() - start - (self.read_seconds - read_seconds)
+        self.count(member)
+
+    def to_dict(self) -> dict:
+        result = {
+            name: round(value, 4) if isinstance(value, float) else value
+            for name, value in ((name, getattr(self, name)) for name in self.__slots__)
+        }
+        # The rest of the time goes to parsing tar headers and resolving whiteouts
+        result["parse_seconds"] = round(max(0, self.seconds - self.read_seconds - self.write_seconds), 4)
+        return result
+
+
+class MeteredReader(io.RawIOBase):
+    """
+    Counts the bytes read from `fileobj` and the time spent reading them (including
+    decompression, or waiting for the layers decompressed ahead).
+    """
+
+    def __init__(self, fileobj, stats: LayerStats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self.fileobj.readinto(b)
+        self.stats.read_seconds += time.perf_counter() - start
+        self.stats.bytes += n
+        return n
+
+
+class Stats:
+    """
+    The phase timings and layer counters of an unpack.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.layers: dict[str, LayerStats] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase of the unpack. Phases may be entered more than once.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def layer(self, name: str) -> LayerStats:
+        with self.lock:
+            if name not in self.layers:
+                self.layers[name] = LayerStats()
+            return self.layers[name]
+
+    def report(self) -> dict:
+        layers = {name: layer.to_dict() for name, layer in self.layers.items()}
+        totals = {}
+        for layer in layers.values():
+            for key, value in layer.items():
+                if not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+        report = {
+            "seconds": round(time.perf_counter() - self.started, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "totals": {key: round(value, 4) for key, value in totals.items()},
+            "layers": layers,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+        if tracemalloc.is_tracing():
+            report["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        return report
+
+
+STATS = Stats()
+
+
+@contextlib.contextmanager
+def collect_stats(stats_json: Path | None = None, profile: Path | None = None, trace_memory: Path | None = None):
+    """
+    Resets `STATS` and, on exit, writes the report to `stats_json`. Optionally
+    profiles the calling thread with cProfile (dumped to `profile`, for `pstats` or
+    snakeviz) and traces allocations with tracemalloc (snapshot dumped to `trace_memory`).
+    """
+    STATS.reset()
+    profiler = cProfile.Profile() if profile is not None else None
+    if trace_memory is not None:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield STATS
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            logger.info(f"Wrote profile to {profile}")
+        if trace_memory is not None:
+            tracemalloc.take_snapshot().dump(str(trace_memory))
+            logger.info(f"Wrote tracemalloc snapshot to {trace_memory}")
+        if stats_json is not None:
+            stats_json.write_text(json.dumps(STATS.report(), indent=2))
+            logger.info(f"Wrote stats to {stats_json}")
+        if trace_memory is not None:
+            tracemalloc.stop()
@@ -1,10 +1,18 @@
+import errno
+import fcntl
+import functools
 import os
+import posixpath
+import stat
 import tarfile
 import typing
 from pathlib import Path
 
 from watcloud_utils.logging import logger
 
+if typing.TYPE_CHECKING:
+    from .manifest import Manifest
+
 
 def escape(value):
     """Escapes special characters in a string for use in a shell script."""
@@ -16,7 +24,475 @@ def args_quoted(args):
     return " ".join(f'"{arg}"' for arg in args)
 
 
-def generate_runscript(root_path: Path, img_config: dict):
+def break_hardlink(path: Path):
+    """
+    Removes `path` if it is a hardlink (e.g. a file linked from the layer cache) or
+    read-only, so that it can be rewritten without modifying the other links.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if stat.S_ISREG(st.st_mode) and (st.st_nlink > 1 or not os.access(path, os.W_OK)):
+        os.unlink(path)
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_uid(uname: str, uid: int) -> int:
+    import pwd
+
+    try:
+        return pwd.getpwnam(uname).pw_uid if uname else uid
+    except KeyError:
+        return uid
+
+
+@functools.lru_cache(maxsize=None)
+def _lookup_gid(gname: str, gid: int) -> int:
+    import grp
+
+    try:
+        return grp.getgrnam(gname).gr_gid if gname else gid
+    except KeyError:
+        return gid
+
+
+def _is_root() -> bool:
+    return hasattr(os, "geteuid") and os.geteuid() == 0
+
+
+def set_attrs(member: tarfile.TarInfo, path: str):
+    """
+    Applies the ownership (when running as root), modification time and mode of a
+    tar member to `path`, the same way `tarfile.TarFile` does.
+    """
+    if _is_root():
+        os.chown(
+            path,
+            _lookup_uid(member.uname, member.uid),
+            _lookup_gid(member.gname, member.gid),
+            follow_symlinks=False,
+        )
+    if not member.issym():
+        os.utime(path, (member.mtime, member.mtime))
+        os.chmod(path, member.mode)
+
+
+def directory_attrs(path: str, mode: int, uid: int, gid: int, uname: str, gname: str, mtime: float) -> tarfile.TarInfo:
+    """
+    Returns a directory member holding just the attributes applied by `set_attrs`,
+    which takes less memory than a member read from a tar (with its PAX headers
+    and offsets) when many directories are kept until the end of an unpack.
+    """
+    member = tarfile.TarInfo(path)
+    member.type = tarfile.DIRTYPE
+    member.mode, member.uid, member.gid = mode, uid, gid
+    member.uname, member.gname, member.mtime = uname, gname, mtime
+    return member
+
+
+# Granularity of the all-zero blocks turned into holes by `write_sparse`, the block
+# size of most filesystems
+SPARSE_BLOCK_SIZE = 4096
+_ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+
+def _write_all(fd: int, view: memoryview):
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def write_sparse(fd: int, data: bytes):
+    """
+    Writes `data` at the current offset of `fd`, seeking over its all-zero blocks
+    instead of writing them, so that they are left as holes. Blocks are aligned on
+    the start of `data`. The file must be truncated to its size afterwards, in case
+    it ends with a hole.
+    """
+    view = memoryview(data)
+    if data.count(0) < SPARSE_BLOCK_SIZE:
+        # Not a single block of zeros
+        _write_all(fd, view)
+        return
+    start = offset = 0
+    while offset < len(data):
+        end = offset + SPARSE_BLOCK_SIZE
+        if data[offset:end] != _ZERO_BLOCK:
+            offset = end
+            continue
+        while data[end : end + SPARSE_BLOCK_SIZE] == _ZERO_BLOCK:
+            end += SPARSE_BLOCK_SIZE
+        _write_all(fd, view[start:offset])
+        os.lseek(fd, end - offset, os.SEEK_CUR)
+        start = offset = end
+    _write_all(fd, view[start:])
+
+
+def _hash_zeros(h, size: int):
+    zeros = memoryview(bytes(min(size, 1024 * 1024)))
+    while size > 0:
+        h.update(zeros[: min(size, len(zeros))])
+        size -= len(zeros)
+
+
+def normalize_member_name(name: str) -> str:
+    """
+    Normalizes a tar member name to a relative POSIX path ("" for the root).
+    """
+    return posixpath.normpath("/" + name).lstrip("/")
+
+
+class MemberWriter:
+    """
+    Writes tar members under `root`, as a leaner replacement for `TarFile.extract`.
+
+    Paths are opened relative to cached directory file descriptors, file contents are
+    copied with a large buffer, and attributes are applied through the open file
+    descriptor. Owner names are resolved once per name. Members that need the generic
+    handling of `tarfile` (devices, FIFOs, links to missing targets) are passed to
+    `TarFile.extract`.
+
+    Like `extract(..., set_attrs=False)`, directories are created without applying
+    their attributes; callers apply them once their contents are written. With a
+    `manifest`, the contents of regular files are hashed as they are written, and
+    with `sync`, regular files are fsynced before they are closed.
+
+    Sparse members (GNU and PAX sparse formats) are written with holes where their
+    sparse map has none of their data. With `sparse`, all-zero blocks of regular
+    files are turned into holes as well.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+    # Number of directory file descriptors kept open
+    MAX_DIR_FDS = 256
+
+    def __init__(self, root: Path, manifest: "Manifest | None" = None, sync: bool = False, sparse: bool = False):
+        self.root = str(root)
+        self.manifest = manifest
+        self.sync = sync
+        self.sparse = sparse
+        os.makedirs(self.root, exist_ok=True)
+        self.root_fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        self.dir_fds: dict[str, int] = {"": self.root_fd}
+        self.is_root = _is_root()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._forget_dirs()
+        os.close(self.root_fd)
+
+    def _close_dir(self, fd: int):
+        os.close(fd)
+
+    def _forget_dirs(self):
+        for path, fd in self.dir_fds.items():
+            if path:
+                self._close_dir(fd)
+        self.dir_fds = {"": self.root_fd}
+
+    def _dir_fd(self, path: str) -> int:
+        fd = self.dir_fds.get(path)
+        if fd is not None:
+            return fd
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC, dir_fd=self.root_fd)
+        except FileNotFoundError:
+            # Archives may omit the entries of parent directories
+            os.makedirs(os.path.join(self.root, path), exist_ok=True)
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC, dir_fd=self.root_fd)
+        if len(self.dir_fds) > self.MAX_DIR_FDS:
+            self._forget_dirs()
+        self.dir_fds[path] = fd
+        return fd
+
+    def _unlink(self, name: str, dir_fd: int):
+        try:
+            os.unlink(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            return
+        # Cached descriptors may refer to directories reached through the removed entry
+        self._forget_dirs()
+
+    def _chown(self, member: tarfile.TarInfo, name, dir_fd: int | None = None):
+        if self.is_root:
+            os.chown(
+                name,
+                _lookup_uid(member.uname, member.uid),
+                _lookup_gid(member.gname, member.gid),
+                dir_fd=dir_fd,
+                follow_symlinks=False,
+            )
+
+    def wait(self, path: str):
+        """
+        Waits until the entry at `path` is written. Entries are written synchronously,
+        but subclasses may write them in the background.
+        """
+
+    def wait_all(self):
+        """
+        Waits until all the entries passed to the writer are written.
+        """
+
+    def link(self, target: str, path: str):
+        """
+        Hardlinks `path` to the entry written at `target`.
+        """
+        self.wait(target)
+        try:
+            os.link(os.path.join(self.root, target), os.path.join(self.root, path))
+        except FileExistsError:
+            # Written before an interrupted unpack was resumed
+            os.unlink(os.path.join(self.root, path))
+            os.link(os.path.join(self.root, target), os.path.join(self.root, path))
+
+    def write(self, tar: tarfile.TarFile, member: tarfile.TarInfo, path: str):
+        """
+        Writes `member` of `tar` to `path`, a normalized path relative to the root.
+        """
+        dirname, name = os.path.split(path)
+        if member.isreg():
+            if path in self.dir_fds:
+                # A directory (or a symlink to one) is replaced by the file
+                self._forget_dirs()
+            self._write_file(tar, member, name, self._dir_fd(dirname))
+        elif member.isdir():
+            try:
+                os.mkdir(name, 0o700, dir_fd=self._dir_fd(dirname))
+            except FileExistsError:
+                pass
+        elif member.issym():
+            dir_fd = self._dir_fd(dirname)
+            self._unlink(name, dir_fd)
+            os.symlink(member.linkname, name, dir_fd=dir_fd)
+            self._chown(member, name, dir_fd)
+        elif member.islnk() and os.path.lexists(os.path.join(self.root, target := normalize_member_name(member.linkname))):
+            dir_fd = self._dir_fd(dirname)
+            self._unlink(name, dir_fd)
+            os.link(target, name, src_dir_fd=self.root_fd, dst_dir_fd=dir_fd, follow_symlinks=False)
+            self._chown(member, name, dir_fd)
+            os.chmod(name, member.mode, dir_fd=dir_fd)
+            os.utime(name, (member.mtime, member.mtime), dir_fd=dir_fd)
+        else:
+            self._forget_dirs()
+            try:
+                if not stat.S_ISDIR(os.lstat(os.path.join(self.root, path)).st_mode):
+                    # Written before an interrupted unpack was resumed: `tarfile` doesn't
+                    # replace existing devices and FIFOs
+                    os.unlink(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+            tar.extract(member, self.root)
+
+    def _open_file(self, name: str, dir_fd: int) -> int:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC
+        try:
+            return os.open(name, flags, 0o600, dir_fd=dir_fd)
+        except OSError as e:
+            if e.errno != errno.ELOOP:
+                raise
+            # Replace the symlink instead of writing through it
+            os.unlink(name, dir_fd=dir_fd)
+            return os.open(name, flags, 0o600, dir_fd=dir_fd)
+
+    def _set_file_attrs(self, fd: int, member: tarfile.TarInfo):
+        if self.is_root:
+            os.fchown(fd, _lookup_uid(member.uname, member.uid), _lookup_gid(member.gname, member.gid))
+        os.fchmod(fd, member.mode)
+        os.utime(fd, (member.mtime, member.mtime))
+
+    def _write_data(self, fd: int, data: bytes):
+        if self.sparse:
+            write_sparse(fd, data)
+        else:
+            _write_all(fd, memoryview(data))
+
+    def _write_file(self, tar: tarfile.TarFile, member: tarfile.TarInfo, name: str, dir_fd: int):
+        fd = self._open_file(name, dir_fd)
+        h = self.manifest.new() if self.manifest is not None else None
+        try:
+            source = tar.fileobj
+            source.seek(member.offset_data)
+            # The data of sparse members is stored as the (offset, size) regions of their map, back to back
+            regions = member.sparse if member.sparse is not None else [(0, member.size)]
+            position = 0
+            for offset, size in regions:
+                if offset > position:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    if h is not None:
+                        _hash_zeros(h, offset - position)
+                remaining = size
+                while remaining > 0:
+                    chunk = source.read(min(remaining, self.BUFFER_SIZE))
+                    if not chunk:
+                        raise tarfile.ReadError("unexpected end of data")
+                    if h is not None:
+                        h.update(chunk)
+                    self._write_data(fd, chunk)
+                    remaining -= len(chunk)
+                position = offset + size
+            if member.size > position and h is not None:
+                _hash_zeros(h, member.size - position)
+            if member.sparse is not None or self.sparse:
+                # Extends the file over a trailing hole
+                os.ftruncate(fd, member.size)
+            self._set_file_attrs(fd, member)
+            if h is not None:
+                self.manifest.record(fd, h)
+            if self.sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# ioctl request to share the extents of another file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+
+# How `copy_entry` transfers regular files
+TRANSFER_MODES = ("hardlink", "reflink", "copy")
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, size: int):
+    try:
+        while size > 0:
+            n = os.copy_file_range(src_fd, dst_fd, size, offset, offset)
+            if n == 0:
+                return
+            offset += n
+            size -= n
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while size > 0 and (chunk := os.pread(src_fd, min(size, 1024 * 1024), offset)):
+            _write_all(dst_fd, memoryview(chunk))
+            offset += len(chunk)
+            size -= len(chunk)
+
+
+def _data_regions(fd: int, size: int) -> typing.Iterator[tuple[int, int]]:
+    """
+    Yields the (offset, size) of the regions of a file holding data, skipping its holes.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # SEEK_DATA isn't supported by the filesystem
+            yield offset, size - offset
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _copy_data(src_fd: int, dst_fd: int, size: int, sparse: bool = False):
+    """
+    Copies `size` bytes of a file. With `sparse`, only the data regions of the source
+    are copied, so that its holes are kept.
+    """
+    for offset, length in _data_regions(src_fd, size) if sparse else [(0, size)]:
+        _copy_range(src_fd, dst_fd, offset, length)
+    if sparse:
+        os.ftruncate(dst_fd, size)
+
+
+def copy_entry(src: str, dst: str, mode: str = "copy"):
+    """
+    Copies a non-directory entry, preserving its metadata. Regular files are
+    hardlinked, reflinked (FICLONE) or copied with `copy_file_range` depending on
+    `mode`, falling back to a copy when the filesystem doesn't support it.
+    """
+    st = os.lstat(src)
+    if stat.S_ISREG(st.st_mode):
+        if mode == "hardlink":
+            try:
+                os.link(src, dst, follow_symlinks=False)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                cloned = False
+                if mode == "reflink":
+                    try:
+                        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                        cloned = True
+                    except OSError:
+                        pass
+                if not cloned:
+                    # Files with fewer blocks than their size have holes
+                    _copy_data(src_fd, dst_fd, st.st_size, st.st_blocks * 512 < st.st_size)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    elif stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    else:
+        os.mknod(dst, st.st_mode, st.st_rdev)
+
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _has_content(path: Path, data: bytes, mode: int) -> bool:
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except (FileNotFoundError, PermissionError):
+        return False
+    try:
+        st = os.fstat(fd)
+        return stat.S_IMODE(st.st_mode) == mode and st.st_size == len(data) and os.read(fd, len(data) + 1) == data
+    finally:
+        os.close(fd)
+
+
+def write_if_changed(path: Path, content: str, mode: int, sync: bool = False) -> bool:
+    """
+    Writes `content` to `path` with permissions `mode`, unless the file already has
+    that content and mode, and fsyncs it with `sync`. Returns whether the file was
+    written. New files (the common case, in a fresh output) take a single open.
+    """
+    data = content.encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, mode)
+    except FileExistsError:
+        if _has_content(path, data, mode):
+            return False
+        break_hardlink(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, mode)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+        # The mode of existing files, and the bits masked by the umask
+        os.fchmod(fd, mode)
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    return True
+
+
+def generate_runscript(root_path: Path, img_config: dict, sync: bool = False):
     """
     Generates the runscript (entrypoint) for the Apptainer container.
 
@@ -27,29 +503,26 @@ def generate_runscript(root_path: Path, img_config: dict):
     runscript_path = root_path / ".singularity.d/runscript"
     logger.info(f"Generating Apptainer runscript at {runscript_path}")
 
-    # Create and open the runscript file
-    runscript_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(runscript_path, "w") as f:
-        # Write the shell shebang
-        f.write("#!/bin/sh\n")
-
-        # Write OCI_ENTRYPOINT
-        if img_config.get("Entrypoint"):
-            entrypoint = args_quoted(img_config["Entrypoint"])
-            f.write(f"OCI_ENTRYPOINT='{entrypoint}'\n")
-        else:
-            f.write("OCI_ENTRYPOINT=''\n")
-
-        # Write OCI_CMD
-        if img_config.get("Cmd"):
-            cmd = args_quoted(img_config["Cmd"])
-            f.write(f"OCI_CMD='{cmd}'\n")
-        else:
-            f.write("OCI_CMD=''\n")
-
-        # Write the rest of the script
-        f.write(
-            r"""CMDLINE_ARGS=""
+    # Write the shell shebang
+    lines = ["#!/bin/sh\n"]
+
+    # Write OCI_ENTRYPOINT
+    if img_config.get("Entrypoint"):
+        entrypoint = args_quoted(img_config["Entrypoint"])
+        lines.append(f"OCI_ENTRYPOINT='{entrypoint}'\n")
+    else:
+        lines.append("OCI_ENTRYPOINT=''\n")
+
+    # Write OCI_CMD
+    if img_config.get("Cmd"):
+        cmd = args_quoted(img_config["Cmd"])
+        lines.append(f"OCI_CMD='{cmd}'\n")
+    else:
+        lines.append("OCI_CMD=''\n")
+
+    # Write the rest of the script
+    lines.append(
+        r"""CMDLINE_ARGS=""
 # prepare command line arguments for evaluation
 for arg in "$@"; do
 CMDLINE_ARGS="${CMDLINE_ARGS} \"$arg\""
@@ -82,13 +555,15 @@ fi
 eval "set ${SINGULARITY_OCI_RUN}"
 exec "$@"
 """
-        )
+    )
 
-    # Change permissions
-    os.chmod(runscript_path, 0o755)
+    # Create the runscript file and change permissions
+    runscript_path.parent.mkdir(parents=True, exist_ok=True)
+    if not write_if_changed(runscript_path, "".join(lines), 0o755, sync):
+        logger.info(f"{runscript_path} is up to date")
 
 
-def generate_env(root_path: Path, img_config: dict):
+def generate_env(root_path: Path, img_config: dict, sync: bool = False):
     """
     Generates the environment script for the Apptainer container.
 
@@ -98,33 +573,28 @@ def generate_env(root_path: Path, img_config: dict):
     env_path = root_path / ".singularity.d/env/10-docker2singularity.sh"
     logger.info(f"Generating Apptainer environment script at {env_path}")
 
-    # Ensure the directory exists
-    env_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write the shell shebang
+    lines = ["#!/bin/sh\n"]
 
-    # Create and open the environment script file
-    with open(env_path, "w") as f:
-        # Write the shell shebang
-        f.write("#!/bin/sh\n")
-
-        # Write environment variables
-        for element in img_config.get("Env", []):
-            env_parts = element.split("=", 1)
-            if len(env_parts) == 1:
-                export_line = f'export {env_parts[0]}="${{{env_parts[0]}:-}}"\n'
+    # Write environment variables
+    for element in img_config.get("Env", []):
+        env_parts = element.split("=", 1)
+        if len(env_parts) == 1:
+            export_line = f'export {env_parts[0]}="${{{env_parts[0]}:-}}"\n'
+        else:
+            if env_parts[0] == "PATH":
+                export_line = f"export {env_parts[0]}={escape(env_parts[1])!r}\n"
             else:
-                if env_parts[0] == "PATH":
-                    export_line = f"export {env_parts[0]}={escape(env_parts[1])!r}\n"
-                else:
-                    export_line = f'export {env_parts[0]}="${{{env_parts[0]}:-{escape(env_parts[1])!r}}}"\n'
+                export_line = f'export {env_parts[0]}="${{{env_parts[0]}:-{escape(env_parts[1])!r}}}"\n'
 
-            f.write(export_line)
+        lines.append(export_line)
 
-        # Sync file to disk
-        f.flush()
-        os.fsync(f.fileno())
+    # Ensure the directory exists
+    env_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Set executable permissions
-    os.chmod(env_path, 0o755)
+    # Create the environment script file with executable permissions
+    if not write_if_changed(env_path, "".join(lines), 0o755, sync):
+        logger.info(f"{env_path} is up to date")
 
 
 class StreamProxy:
@@ -143,28 +613,29 @@ class StreamProxy:
         return self.buf
 
     def getcomptype(self):
-        if self.buf.startswith(b"\x1f\x8b\x08"):
+        return self.detect_comptype(self.buf)
+
+    @staticmethod
+    def detect_comptype(buf: bytes):
+        if buf.startswith(b"\x1f\x8b\x08"):
             return "gz"
-        elif self.buf[0:3] == b"BZh" and self.buf[4:10] == b"1AY&SY":
+        elif buf[0:3] == b"BZh" and buf[4:10] == b"1AY&SY":
             return "bz2"
-        elif self.buf.startswith((b"\x5d\x00\x00\x80", b"\xfd7zXZ")):
+        elif buf.startswith((b"\x5d\x00\x00\x80", b"\xfd7zXZ")):
             return "xz"
-        elif self.buf.startswith(b"\x28\xb5\x2f\xfd"):
+        elif buf.startswith(b"\x28\xb5\x2f\xfd"):
             return "zst"
         else:
             return "tar"
 
-    def supports_streaming(self):
-        comptype = self.getcomptype()
-        return comptype not in ("zst",)
-
     def close(self):
         self.fileobj.close()
 
 
 class MyTarFile(tarfile.TarFile):
     """
-    A custom TarFile class that supports more compression types.
+    A custom TarFile class that supports more compression types, and iterates over
+    its members without keeping them.
 
     Derived from:
     - https://github.com/python/cpython/issues/81276#issuecomment-1966037544
@@ -172,6 +643,23 @@ class MyTarFile(tarfile.TarFile):
 
     OPEN_METH = {"zst": "zstopen"} | tarfile.TarFile.OPEN_METH
 
+    def __iter__(self) -> typing.Iterator[tarfile.TarInfo]:
+        """
+        Yields the members of the archive, reading their headers as it goes like
+        `TarFile.__iter__`, but without adding them to `members`, so that memory
+        doesn't grow with the number of members. Layers are read once, and the
+        targets of hardlinks are resolved on disk by `MemberWriter`, so nothing
+        looks members up afterwards.
+        """
+        while (member := self.next()) is not None:
+            # Dropped as soon as the caller is done with it
+            self.members.clear()
+            yield member
+
+    def _find_link_target(self, tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        # Looking the target up would read the rest of a stream into `members`
+        raise KeyError(f"linkname {tarinfo.linkname!r} not found")
+
     @classmethod
     def zstopen(
         cls,
@@ -0,0 +1,191 @@
+"""
+Verification of layer digests.
+
+A layer blob is identified by the digest of its (compressed) contents in the image
+manifest, and by the digest of its uncompressed tarball (its diff_id) in the image
+config. Both are computed as the layer streams through the decompressor, with
+each hash updated by a helper thread (hashlib releases the GIL on large updates),
+so checking them costs no extra pass over the layer. Layers are checked when the
+end of their stream is reached, or, for layers extracted before the image manifest
+is read, once the expected digests are known.
+"""
+
+import hashlib
+import io
+import queue
+import threading
+import typing
+
+from .decompress import CHUNK_SIZE, open_decompressed
+
+if typing.TYPE_CHECKING:
+    from .image import ImageArchive
+
+# Algorithm of the digests computed when the expected ones aren't known yet
+DEFAULT_ALGORITHM = "sha256"
+
+# Bytes handed to a hashing thread at once
+_BLOCK_SIZE = 1024 * 1024
+# Blocks queued per hashing thread
+_QUEUE_SIZE = 4
+
+
+class LayerDigests(typing.NamedTuple):
+    # Digest of the layer blob, as in the image manifest
+    digest: str | None
+    # Digest of the uncompressed layer tarball, as in the image config
+    diff_id: str | None
+
+
+def expected_digests(image: "ImageArchive") -> dict[str, LayerDigests]:
+    """
+    Returns the digests of the layers of an image, by blob name. Blobs of `docker
+    save` archives in the legacy format (`<id>/layer.tar`) only have a diff_id.
+    """
+    from .cache import blob_digest
+
+    diff_ids = image.config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(image.layers):
+        diff_ids = [None] * len(image.layers)
+    descriptors = image.manifest.get("layers") if isinstance(image.manifest.get("layers"), list) else None
+    expected = {}
+    for i, (name, diff_id) in enumerate(zip(image.layers, diff_ids)):
+        digest = descriptors[i].get("digest") if descriptors is not None else blob_digest(name)
+        expected[name] = LayerDigests(digest, diff_id)
+    return expected
+
+
+def _algorithm(digest: str | None) -> str:
+    if digest is None:
+        return DEFAULT_ALGORITHM
+    algorithm = digest.partition(":")[0]
+    if algorithm not in hashlib.algorithms_available:
+        raise Exception(f"Unsupported digest algorithm in {digest}")
+    return algorithm
+
+
+class _HashThread:
+    """
+    A hash updated by a helper thread, in blocks of `_BLOCK_SIZE` bytes.
+    """
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+        self.buffer = bytearray()
+        self.blocks = queue.Queue(maxsize=_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._run, name="hash", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while (block := self.blocks.get()) is not None:
+            self.hash.update(block)
+
+    def update(self, data: bytes):
+        if not self.buffer and len(data) >= _BLOCK_SIZE:
+            self.blocks.put(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= _BLOCK_SIZE:
+            self.blocks.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.blocks.put(None)
+            self.thread.join()
+
+    def digest(self) -> str:
+        self.blocks.put(bytes(self.buffer))
+        self.buffer.clear()
+        self.close()
+        return f"{self.algorithm}:{self.hash.hexdigest()}"
+
+
+class _HashingReader(io.RawIOBase):
+    """
+    Passes reads through to `fileobj`, hashing the bytes read.
+    """
+
+    def __init__(self, fileobj, hash: _HashThread):
+        self.fileobj = fileobj
+        self.hash = hash
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fileobj.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.hash.update(data)
+        return n
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+class VerifiedReader(io.RawIOBase):
+    """
+    Reads the decompressed contents of a layer blob from `fileobj`, computing the
+    digests of the blob and of its contents. Once the end of the contents is read,
+    the rest of the blob is read as well (e.g. a trailing gzip member or padding),
+    the digests are saved to `digests`, and they are compared to `expected`.
+    """
+
+    def __init__(
+        self, fileobj, decompressors: typing.Sequence[str], name: str, expected: LayerDigests | None = None
+    ):
+        self.name = name
+        self.expected = expected or LayerDigests(None, None)
+        self.blob_hash = _HashThread(_algorithm(self.expected.digest))
+        self.content_hash = _HashThread(_algorithm(self.expected.diff_id))
+        self.raw = _HashingReader(fileobj, self.blob_hash)
+        # Not seekable, so the blob is decompressed as a stream
+        self.stream = open_decompressed(io.BufferedReader(self.raw, CHUNK_SIZE), decompressors, name)
+        self.digests: LayerDigests | None = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.digests is not None:
+            return 0
+        data = self.stream.read(len(b))
+        n = len(data)
+        if n:
+            b[:n] = data
+            self.content_hash.update(data)
+        else:
+            self._finish()
+        return n
+
+    def _finish(self):
+        while self.raw.read(CHUNK_SIZE):
+            pass
+        self.digests = LayerDigests(self.blob_hash.digest(), self.content_hash.digest())
+        check_digests(self.name, self.digests, self.expected)
+
+    def close(self):
+        self.blob_hash.close()
+        self.content_hash.close()
+        self.stream.close()
+        super().close()
+
+
+def check_digests(name: str, actual: LayerDigests, expected: LayerDigests | None):
+    """
+    Raises an exception if the digests computed for layer `name` don't match the
+    expected ones. Expected digests of another algorithm than the computed ones
+    can't be checked, and are skipped.
+    """
+    if expected is None:
+        return
+    for kind, value, wanted in (("digest", actual.digest, expected.digest), ("diff_id", actual.diff_id, expected.diff_id)):
+        if wanted is None or value.partition(":")[0] != wanted.partition(":")[0]:
+            continue
+        if value != wanted:
+            raise Exception(
+                f"Layer {name} is corrupted: its {kind} is {value}, but the image expects {wanted}"
+            )
@@ -0,0 +1,164 @@
+"""
+Concurrent writing of layer members.
+
+On network and overlay filesystems, unpacking many small files is bound by the
+latency of each file creation rather than by decompression. The main thread keeps
+reading the layer and hands the contents of regular files to a pool of writer
+threads, which create, fill and close them concurrently.
+
+Ordering constraints are preserved:
+- directories, symlinks and hardlinks are created by the main thread, in archive
+  order, so parent directories exist before their children are handed off;
+- an entry waits for pending writes to the same path, so later members (and the
+  whiteouts applied between layers) always land after earlier ones;
+- a hardlink waits until its target is written.
+"""
+
+import functools
+import os
+import tarfile
+import threading
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from .pipeline import ReadAheadBudget
+from .utils import MemberWriter, normalize_member_name
+
+if typing.TYPE_CHECKING:
+    from .manifest import Manifest
+
+
+class ThreadedMemberWriter(MemberWriter):
+    """
+    A `MemberWriter` that writes regular files with `jobs` threads, buffering at most
+    `max_bytes` of file contents. Larger files are written by the calling thread.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        jobs: int,
+        max_bytes: int = 64 * 1024 * 1024,
+        manifest: "Manifest | None" = None,
+        sync: bool = False,
+        sparse: bool = False,
+    ):
+        super().__init__(root, manifest, sync, sparse)
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="write")
+        self.budget = ReadAheadBudget(max_bytes)
+        self.lock = threading.Lock()
+        # Writes in progress, by path
+        self.pending: dict[str, Future] = {}
+        # Directory descriptors in use by pending writes, and those to close once unused
+        self.dir_refs: dict[int, int] = {}
+        self.retired: set[int] = set()
+        self.error: BaseException | None = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        super().close()
+        if self.error is not None:
+            raise self.error
+
+    def _close_dir(self, fd: int):
+        with self.lock:
+            if self.dir_refs.get(fd):
+                self.retired.add(fd)
+                return
+        os.close(fd)
+
+    def _release_dir(self, fd: int):
+        with self.lock:
+            refs = self.dir_refs[fd] - 1
+            if refs:
+                self.dir_refs[fd] = refs
+                return
+            del self.dir_refs[fd]
+            if fd in self.retired:
+                self.retired.remove(fd)
+                os.close(fd)
+
+    def wait(self, path: str):
+        future = self.pending.get(path)
+        if future is not None:
+            future.result()
+
+    def wait_all(self):
+        for future in list(self.pending.values()):
+            future.result()
+        if self.error is not None:
+            raise self.error
+
+    def _done(self, path: str, future: Future):
+        with self.lock:
+            if self.pending.get(path) is future:
+                del self.pending[path]
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+
+    def write(self, tar: tarfile.TarFile, member: tarfile.TarInfo, path: str):
+        if self.error is not None:
+            raise self.error
+        self.wait(path)
+        if member.islnk():
+            self.wait(normalize_member_name(member.linkname))
+        # Sparse members are written by the calling thread, region by region
+        if not member.isreg() or member.sparse is not None or member.size > self.budget.max_bytes:
+            super().write(tar, member, path)
+            return
+
+        dirname, name = os.path.split(path)
+        if path in self.dir_fds:
+            self._forget_dirs()
+        dir_fd = self._dir_fd(dirname)
+        with self.lock:
+            self.dir_refs[dir_fd] = self.dir_refs.get(dir_fd, 0) + 1
+
+        self.budget.acquire(member.size)
+        tar.fileobj.seek(member.offset_data)
+        data = tar.fileobj.read(member.size)
+        if len(data) != member.size:
+            self.budget.release(member.size)
+            self._release_dir(dir_fd)
+            raise tarfile.ReadError("unexpected end of data")
+
+        future = self.executor.submit(self._write_buffered, member, name, dir_fd, data)
+        self.pending[path] = future
+        future.add_done_callback(functools.partial(self._done, path))
+
+    def _write_buffered(self, member: tarfile.TarInfo, name: str, dir_fd: int, data: bytes):
+        try:
+            fd = self._open_file(name, dir_fd)
+            try:
+                self._write_data(fd, data)
+                if self.sparse:
+                    os.ftruncate(fd, len(data))
+                self._set_file_attrs(fd, member)
+                if self.manifest is not None:
+                    # Hashed by the writer threads
+                    h = self.manifest.new()
+                    h.update(data)
+                    self.manifest.record(fd, h)
+                if self.sync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            self.budget.release(len(data))
+            self._release_dir(dir_fd)
+
+
+def open_writer(
+    root: Path, jobs: int = 1, manifest: "Manifest | None" = None, sync: bool = False, sparse: bool = False
+) -> MemberWriter:
+    """
+    Returns a writer for the members extracted to `root`, using `jobs` threads,
+    recording the digests of the files written in `manifest`, fsyncing each file
+    with `sync`, and leaving holes for the all-zero blocks of files with `sparse`.
+    """
+    if jobs > 1:
+        return ThreadedMemberWriter(root, jobs, manifest=manifest, sync=sync, sparse=sparse)
+    return MemberWriter(root, manifest, sync, sparse)
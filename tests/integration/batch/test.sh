@@ -0,0 +1,28 @@
+#!/bin/bash
+
+# Integration test: batch
+# This test aims to verify that unpack-many unpacks every image of a batch
+
+set -o errexit -o nounset -o pipefail
+
+trap 'echo "Error on line $LINENO: $BASH_COMMAND"; exit 1' ERR
+
+docker pull alpine:3.19
+docker pull python:3.12-alpine3.19
+
+__tmpdir=$(mktemp -d)
+
+# MARK: Multi-image archive
+docker save alpine:3.19 python:3.12-alpine3.19 > "$__tmpdir/images.tar"
+APP_LOG_LEVEL=INFO pdm run docker-unpack unpack-many --archive "$__tmpdir/images.tar" --output-root "$__tmpdir/out"
+test -f "$__tmpdir/out/alpine_3.19/etc/alpine-release"
+test -x "$__tmpdir/out/python_3.12-alpine3.19/usr/local/bin/python3"
+
+# MARK: List of archives
+docker save alpine:3.19 | gzip > "$__tmpdir/alpine.tar.gz"
+echo "$__tmpdir/alpine.tar.gz $__tmpdir/list/alpine" > "$__tmpdir/list.txt"
+APP_LOG_LEVEL=INFO pdm run docker-unpack unpack-many --list "$__tmpdir/list.txt"
+test -f "$__tmpdir/list/alpine/etc/alpine-release"
+
+rm -rf "$__tmpdir"
+echo "PASS"
@@ -32,6 +32,10 @@ for compression in zstd gzip estargz; do
     APP_LOG_LEVEL=INFO pdm run docker-unpack unpack "$__tmpdir/image.tar" "$__tmpdir/unpacked"
     test -f "$__tmpdir/unpacked/largefile"
     test $(stat -c %s "$__tmpdir/unpacked/largefile") -eq $((128 * 1024 * 1024)) # check that the unpacked file is the correct size
+
+    APP_LOG_LEVEL=INFO pdm run docker-unpack unpack --sparse "$__tmpdir/image.tar" "$__tmpdir/sparse"
+    test $(stat -c %s "$__tmpdir/sparse/largefile") -eq $((128 * 1024 * 1024))
+    test $(du -k "$__tmpdir/sparse/largefile" | cut -f1) -lt 1024 # check that the zeros are holes, not written out
     rm -rf "$__tmpdir"
 done
 
@@ -0,0 +1,82 @@
+import gzip
+import json
+import tarfile
+
+import pytest
+
+from docker_unpack.cli import analyze
+from docker_unpack.image import open_indexed
+from docker_unpack.layers import apply_layers
+
+from test_batch import make_archive
+from test_chunked import layer_data
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_analyze(tmp_path, compressed, capsys):
+    lower = layer_data(
+        {
+            "usr": None,
+            "usr/lib": None,
+            "usr/lib/big": b"x" * 5000,
+            "usr/lib/replaced": b"x" * 300,
+            "usr/lib/removed": b"x" * 200,
+            "opt": None,
+            "opt/old/file": b"x" * 100,
+            "link": (tarfile.LNKTYPE, "usr/lib/big"),
+        }
+    )
+    upper = layer_data(
+        {
+            "usr/lib/replaced": b"y" * 30,
+            "usr/lib/.wh.removed": b"",
+            "opt/.wh..wh..opq": b"",
+            "opt/new": b"y" * 10,
+        }
+    )
+    archive = make_archive(tmp_path / "image.tar", {"test:latest": [lower, upper]})
+    if compressed:
+        # Read as a stream
+        archive.with_suffix(".tar.gz").write_bytes(gzip.compress(archive.read_bytes()))
+        archive = archive.with_suffix(".tar.gz")
+
+    analyze(archive, platform=None, image_name=None, decompressor=[], top=2, as_json=True)
+    report = json.loads(capsys.readouterr().out)
+
+    assert report["files"] == 4
+    assert report["bytes"] == 5000 + 30 + 10
+    assert report["largest"] == [["usr/lib/big", 5000], ["usr/lib/replaced", 30]]
+    assert [layer["overwritten_bytes"] for layer in report["layers"]] == [300, 0]
+    assert [layer["deleted_bytes"] for layer in report["layers"]] == [300, 0]
+    assert [layer["bytes"] for layer in report["layers"]] == [5600, 40]
+
+    # Same tree as unpacked
+    with open(tmp_path / "image.tar", "rb") as f:
+        apply_layers(open_indexed(f).layer_blobs(), tmp_path / "out")
+    unpacked = [p for p in (tmp_path / "out").rglob("*") if not p.is_dir()]
+    assert len(unpacked) == report["files"]
+    assert report["directories"] == sum(1 for p in (tmp_path / "out").rglob("*") if p.is_dir())
+
+    analyze(archive, platform=None, image_name=None, decompressor=[], top=2, as_json=False)
+    assert "Unpacked size: 4.9 KiB in 4 files" in capsys.readouterr().out
+
+
+def test_analyze_replaced_directory(tmp_path, capsys):
+    # The symlink of the middle layer is hidden by the top directory, but still
+    # deletes the files of the bottom one
+    layers = [
+        layer_data({"b": None, "b/a": b"x" * 100}),
+        layer_data({"b": (tarfile.SYMTYPE, "elsewhere")}),
+        layer_data({"b": None, "b/c": b"y" * 10}),
+    ]
+    archive = make_archive(tmp_path / "image.tar", {"test:latest": layers})
+    analyze(archive, platform=None, image_name=None, decompressor=[], top=2, as_json=True)
+    report = json.loads(capsys.readouterr().out)
+
+    assert (report["files"], report["directories"], report["bytes"]) == (1, 1, 10)
+    assert [layer["deleted_bytes"] for layer in report["layers"]] == [100, 0, 0]
+    assert [layer["overwritten_files"] for layer in report["layers"]] == [0, 1, 0]
+
+    with open(archive, "rb") as f:
+        apply_layers(open_indexed(f).layer_blobs(), tmp_path / "out")
+    assert [p.name for p in (tmp_path / "out").rglob("*") if not p.is_dir()] == ["c"]
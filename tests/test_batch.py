@@ -0,0 +1,95 @@
+import functools
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from docker_unpack.batch import expand_archive, read_job_list, run_batch
+from docker_unpack.cli import unpack
+
+
+def layer_tar(entries: dict[str, bytes]) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, content in entries.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def make_archive(path, images: dict[str, list[bytes]]):
+    """
+    Writes a `docker save` archive of the images (tag -> uncompressed layer tarballs).
+    """
+    manifests, members = [], {}
+    for tag, layers in images.items():
+        digests = [hashlib.sha256(layer).hexdigest() for layer in layers]
+        members.update({f"blobs/sha256/{d}": layer for d, layer in zip(digests, layers)})
+        config = json.dumps(
+            {"config": {"Env": [f"TAG={tag}"]}, "rootfs": {"type": "layers", "diff_ids": [f"sha256:{d}" for d in digests]}}
+        ).encode()
+        config_name = f"blobs/sha256/{hashlib.sha256(config).hexdigest()}"
+        members[config_name] = config
+        manifests.append({"Config": config_name, "RepoTags": [tag], "Layers": [f"blobs/sha256/{d}" for d in digests]})
+    members["manifest.json"] = json.dumps(manifests).encode()
+
+    with tarfile.open(path, "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def unpack_image(input_file, output_dir, image_name=None, cache_dir=None, **options):
+    return unpack(
+        input_file,
+        output_dir,
+        **{
+            "platform": None,
+            "image_name": image_name,
+            "jobs": 1,
+            "readahead_mb": 16,
+            "write_jobs": 1,
+            "decompressor": [],
+            "cache_dir": cache_dir,
+            "cache_max_gb": 1,
+            "cache_link": "hardlink",
+            "update": False,
+            "include": [],
+            "exclude": [],
+            "include_from": None,
+            "exclude_from": None,
+            "manifest_path": None,
+            "manifest_hash": "sha256",
+            "verify": True,
+            "durability": "end",
+            "sparse": False,
+            "resume": False,
+            "stats_json": None,
+            "profile": None,
+            "trace_memory": None,
+            **options,
+        },
+    )
+
+
+def test_batch(tmp_path):
+    base = layer_tar({"base": b"shared"})
+    make_archive(tmp_path / "a.tar", {"a:1": [base, layer_tar({"app": b"a"})]})
+    make_archive(tmp_path / "multi.tar", {"b:1": [base, layer_tar({"app": b"b"})], "c:1": [layer_tar({"app": b"c"})]})
+    (tmp_path / "list.txt").write_text(f"# comment\n{tmp_path / 'a.tar'} '{tmp_path / 'out dir' / 'a'}'\n")
+
+    jobs = read_job_list(tmp_path / "list.txt") + expand_archive(tmp_path / "multi.tar", tmp_path / "out dir")
+    assert [(job.output_dir.name, job.image) for job in jobs] == [("a", None), ("b_1", "0"), ("c_1", "1")]
+
+    run_batch(jobs, unpack_image, 2, tmp_path / "cache", shared_cache=True)
+    out = tmp_path / "out dir"
+    for name, app in [("a", b"a"), ("b_1", b"b"), ("c_1", b"c")]:
+        assert (out / name / "app").read_bytes() == app
+    assert not (out / "c_1" / "base").exists()
+    # The shared layer was extracted once, and hardlinked into both images
+    assert os.stat(out / "a" / "base").st_ino == os.stat(out / "b_1" / "base").st_ino
+    assert len(os.listdir(tmp_path / "cache" / "layers")) == 4
@@ -0,0 +1,53 @@
+import os
+
+from docker_unpack.cache import LayerCache, blob_digest
+from docker_unpack.layers import StagedLayer, StagedLayers, extract_layer
+
+from test_layers import make_layer
+
+KEY = "sha256:" + "a" * 64
+
+
+def test_blob_digest():
+    assert blob_digest("blobs/sha256/" + "b" * 64) == "sha256:" + "b" * 64
+    assert blob_digest("0123/layer.tar") is None
+
+
+def test_cache_roundtrip(tmp_path):
+    blob = make_layer(tmp_path / "0.tar", {"dir": None, "dir/file": b"data", "dir/.wh.gone": b""})
+    cache = LayerCache(tmp_path / "cache", max_bytes=1024**3)
+    assert cache.get(KEY) is None
+
+    layer = StagedLayer(cache.new_tmp_dir())
+    with blob.open() as f:
+        extract_layer(f, layer)
+    cached = cache.insert(KEY, layer, "blobs/sha256/" + "b" * 64)
+
+    assert cached.shared
+    assert cached.dirty == {"dir", ""}
+    assert list(cached.directories) == ["dir"]
+    assert cache.lookup_blob("blobs/sha256/" + "b" * 64).path == cached.path
+
+    root = tmp_path / "root"
+    root.mkdir()
+    staged = StagedLayers(root, cache=cache)
+    staged.layers["0.tar"] = cached
+    staged.merge(["0.tar"])
+
+    assert (root / "dir/file").read_bytes() == b"data"
+    assert not (root / "dir/.wh.gone").exists()
+    # Files are hardlinked from the cache
+    assert os.stat(root / "dir/file").st_ino == os.stat(cached.path / "dir/file").st_ino
+
+
+def test_cache_eviction(tmp_path):
+    blob = make_layer(tmp_path / "0.tar", {"file": b"x" * 100_000})
+    cache = LayerCache(tmp_path / "cache", max_bytes=0)
+
+    layer = StagedLayer(cache.new_tmp_dir())
+    with blob.open() as f:
+        extract_layer(f, layer)
+    cache.insert(KEY, layer)
+    cache.evict()
+
+    assert cache.get(KEY) is None
@@ -0,0 +1,152 @@
+import io
+import json
+import lzma
+import random
+import tarfile
+import zlib
+
+import pytest
+import zstandard
+
+from docker_unpack import catalog
+from docker_unpack.catalog import load_catalog
+from docker_unpack.cli import cat, ls
+from docker_unpack.image import open_directory
+
+from test_chunked import layer_data
+from test_image import add_blob
+
+# Incompressible enough to span several checkpoints
+_BIG = random.Random(0).randbytes(200_000) * 3
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == "gz-sync":
+        # Blocks ending with a sync flush, as written by pigz
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        parts = [c.compress(data[i : i + 65536]) + c.flush(zlib.Z_SYNC_FLUSH) for i in range(0, len(data), 65536)]
+        return b"".join(parts) + c.flush()
+    if compression == "gz":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    if compression == "zst":
+        # One frame per 64 KiB, as written by `zstd -T0 --long` or zstd:chunked layers
+        return b"".join(zstandard.compress(data[i : i + 65536]) for i in range(0, len(data), 65536))
+    if compression == "xz":
+        return lzma.compress(data)
+    return data
+
+
+@pytest.fixture
+def image(tmp_path):
+    """
+    Returns a function writing an OCI image layout with layers compressed as given.
+    """
+
+    def make(compression: str):
+        layout = tmp_path / "layout"
+        lower = layer_data(
+            {
+                "etc": None,
+                "etc/os-release": b"ID=lower\n",
+                "usr": None,
+                "usr/lib": None,
+                "usr/lib/big": _BIG,
+                "usr/lib/os-release": b"ID=test\n",
+                "usr/lib/removed": b"gone",
+                "lib": (tarfile.SYMTYPE, "usr/lib"),
+                "opt/old/file": b"old",
+                "target": b"hardlink target",
+                "hard": (tarfile.LNKTYPE, "target"),
+            }
+        )
+        upper = layer_data(
+            {
+                "etc/os-release": (tarfile.SYMTYPE, "../usr/lib/os-release"),
+                "usr/lib/.wh.removed": b"",
+                "opt/.wh..wh..opq": b"",
+                "opt/new": b"new",
+                "target": b"replaced",
+            }
+        )
+        layers = [add_blob(layout, _compress(data, compression)) for data in (lower, upper)]
+        config = add_blob(layout, json.dumps({"config": {}}).encode())
+        manifest = add_blob(layout, json.dumps({"schemaVersion": 2, "config": config, "layers": layers}).encode())
+        (layout / "index.json").write_text(json.dumps({"schemaVersion": 2, "manifests": [manifest]}))
+        return layout
+
+    return make
+
+
+@pytest.mark.parametrize("compression", ["tar", "gz", "gz-sync", "zst", "xz"])
+def test_catalog(image, compression, monkeypatch):
+    monkeypatch.setattr(catalog, "CHECKPOINT_SPACING", 100_000)
+    layout = image(compression)
+    image_catalog = load_catalog(open_directory(str(layout)), layout)
+
+    assert list(image_catalog.walk("")) == ["etc", "hard", "lib", "opt", "target", "usr"]
+    assert list(image_catalog.walk("opt")) == ["opt/new"]
+    assert list(image_catalog.walk("usr", recursive=True)) == ["usr/lib", "usr/lib/big", "usr/lib/os-release"]
+    assert b"".join(image_catalog.read("/etc/os-release")) == b"ID=test\n"
+    assert b"".join(image_catalog.read("lib/../lib/big")) == _BIG
+    assert b"".join(image_catalog.read("target")) == b"replaced"
+    # The hardlink's target is shadowed by the upper layer, but it still links to the lower one
+    assert b"".join(image_catalog.read("hard")) == b"hardlink target"
+    with pytest.raises(Exception, match="no such file"):
+        b"".join(image_catalog.read("usr/lib/removed"))
+
+    checkpoints = image_catalog.layers[0]["checkpoints"]
+    if compression in ("gz-sync", "zst"):
+        assert len(checkpoints) > 3
+        assert {c[2] for c in checkpoints} == ({"gzip", "deflate"} if compression == "gz-sync" else {"zstd"})
+    else:
+        assert len(checkpoints) == 1
+
+
+def test_catalog_replaced_directory(tmp_path):
+    # The symlink of the middle layer is hidden by the top directory, but still
+    # deletes the files of the bottom one
+    layout = tmp_path / "layout"
+    layers = [
+        layer_data({"b": None, "b/a": b"deleted"}),
+        layer_data({"b": (tarfile.SYMTYPE, "elsewhere")}),
+        layer_data({"b": None, "b/c": b"c"}),
+    ]
+    descriptors = [add_blob(layout, data) for data in layers]
+    config = add_blob(layout, json.dumps({"config": {}}).encode())
+    manifest = add_blob(layout, json.dumps({"schemaVersion": 2, "config": config, "layers": descriptors}).encode())
+    (layout / "index.json").write_text(json.dumps({"schemaVersion": 2, "manifests": [manifest]}))
+    image_catalog = load_catalog(open_directory(str(layout)), layout)
+
+    assert list(image_catalog.walk("", recursive=True)) == ["b", "b/c"]
+    assert "b/a" not in image_catalog.entries
+
+
+def test_catalog_is_saved(image, monkeypatch, capsysbinary):
+    monkeypatch.setattr(catalog, "CHECKPOINT_SPACING", 100_000)
+    layout = image("gz-sync")
+    options = dict(platform=None, image_name=None, index=None)
+    cat(layout, "usr/lib/big", **options)
+    assert capsysbinary.readouterr().out == _BIG
+    assert (layout.parent / "layout.docker-unpack-index").exists()
+
+    # Later lookups use the saved index
+    def index_layer(*args):
+        raise AssertionError("layer indexed again")
+
+    monkeypatch.setattr(catalog, "index_layer", index_layer)
+    ls(layout, "/etc", long=True, recursive=False, **options)
+    assert capsysbinary.readouterr().out.decode().split("\n")[0].endswith("/etc/os-release -> ../usr/lib/os-release")
+    cat(layout, "/etc/os-release", **options)
+    assert capsysbinary.readouterr().out == b"ID=test\n"
+
+
+def test_checkpoints_resume(monkeypatch):
+    monkeypatch.setattr(catalog, "CHECKPOINT_SPACING", 100_000)
+    data = layer_data({"a": _BIG, "b": _BIG[::-1]})
+    f = io.BytesIO(_compress(data, "gz-sync"))
+    checkpoints = [[0, 0, "gzip", None]]
+    assert b"".join(catalog._inflate(f, checkpoints[0], checkpoints)) == data
+    for checkpoint in checkpoints[1:]:
+        f.seek(checkpoint[0])
+        assert b"".join(catalog._inflate(f, checkpoint)) == data[checkpoint[1] :]
@@ -0,0 +1,204 @@
+import datetime
+import gzip
+import io
+import json
+import struct
+import tarfile
+
+import pytest
+import zstandard
+
+from docker_unpack.chunked import ChunkedLayer, read_toc
+from docker_unpack.image import Blob
+from docker_unpack.layers import LayerIndex
+
+from test_layers import ALL_ENGINES, apply_layers
+from test_utils import make_archive, snapshot
+
+_TYPES = {
+    tarfile.REGTYPE: "reg",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+}
+
+
+def chunked_layer(path, data: bytes, format: str, chunk_size: int = 1024) -> Blob:
+    """
+    Writes a layer tarball as eStargz or zstd:chunked: the tar stream is split where
+    each chunk of file contents starts, and each part is compressed separately.
+    """
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        members = tar.getmembers()
+        # eStargz layers end with the TOC (a tar of its own) instead of end-of-archive blocks
+        end = tar.offset if format == "estargz" else len(data)
+
+    cuts = sorted({m.offset_data + i for m in members if m.isreg() for i in range(0, m.size, chunk_size)})
+    out, offsets = io.BytesIO(), {}
+    for start, stop in zip([0, *cuts], [*cuts, end]):
+        offsets[start] = out.tell()
+        out.write(gzip.compress(data[start:stop]) if format == "estargz" else zstandard.compress(data[start:stop]))
+    offsets[end] = out.tell()
+
+    entries = []
+    for m in members:
+        entry = {
+            "name": m.name,
+            "type": _TYPES[m.type],
+            "mode": m.mode,
+            "modtime": datetime.datetime.fromtimestamp(m.mtime, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "linkName": m.linkname,
+        }
+        entries.append(entry)
+        if not m.isreg():
+            continue
+        entry["size"] = m.size
+        for i in range(0, m.size, chunk_size):
+            chunk = entry if i == 0 else {"name": m.name, "type": "chunk"}
+            if i:
+                entries.append(chunk)
+            start = m.offset_data + i
+            chunk |= {"offset": offsets[start], "chunkOffset": i, "chunkSize": min(chunk_size, m.size - i)}
+            if format == "estargz" and i + chunk_size >= m.size:
+                # The last chunk extends to the end of the file
+                chunk["chunkSize"] = 0
+            if format == "zstd:chunked":
+                chunk["endOffset"] = offsets[min([c for c in cuts if c > start] + [end])]
+    toc = json.dumps({"version": 1, "entries": entries}).encode()
+
+    if format == "estargz":
+        toc_offset = out.tell()
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            info = tarfile.TarInfo("stargz.index.json")
+            info.size = len(toc)
+            tar.addfile(info, io.BytesIO(toc))
+        out.write(gzip.compress(buf.getvalue()))
+        extra = b"SG" + struct.pack("<H", 22) + b"%016xSTARGZ" % toc_offset
+        out.write(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff" + struct.pack("<H", len(extra)) + extra)
+        out.write(b"\x01\x00\x00\xff\xff" + b"\0" * 8)
+    else:
+        manifest = zstandard.compress(toc)
+        out.write(b"\x50\x2a\x4d\x18" + struct.pack("<I", len(manifest)))
+        offset = out.tell()
+        out.write(manifest)
+        out.write(b"\x50\x2a\x4d\x18" + struct.pack("<I", 64))
+        out.write(struct.pack("<7Q", offset, len(manifest), len(toc), 1, 0, 0, 0) + b"GNUlInUx")
+
+    path.write_bytes(out.getvalue())
+    return Blob(path.name, path.stat().st_size, lambda: open(path, "rb"))
+
+
+def layer_data(entries: dict) -> bytes:
+    """
+    Returns a layer tarball. `entries` maps member names to file contents (bytes),
+    None for directories, or (type, target) for symlinks and hardlinks.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, content in entries.items():
+            info = tarfile.TarInfo(name)
+            info.mtime = 1700000000
+            if content is None:
+                info.type, info.mode = tarfile.DIRTYPE, 0o755
+            elif isinstance(content, tuple):
+                info.type, info.linkname = content
+            else:
+                info.size = len(content)
+            tar.addfile(info, io.BytesIO(content) if isinstance(content, bytes) else None)
+    return buf.getvalue()
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.fileobj.readinto(b)
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+def as_stream(blob: Blob) -> Blob:
+    """
+    Returns a blob opened as a non-seekable stream, which is never read through its TOC.
+    """
+    return Blob(blob.name, blob.size, lambda: io.BufferedReader(_Unseekable(blob.open())))
+
+
+@pytest.mark.parametrize("format", ["estargz", "zstd:chunked"])
+def test_read_toc(tmp_path, format):
+    data = make_archive().getvalue()
+    blob = chunked_layer(tmp_path / "layer", data, format, chunk_size=512)
+    with blob.open() as f:
+        toc = read_toc(f)
+    assert toc.format == format
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        expected = [(m.name, m.type, m.size, m.mode, m.mtime, m.linkname) for m in tar.getmembers()]
+    if format == "estargz":
+        expected.append(("stargz.index.json", tarfile.REGTYPE, toc.members[-1].size, 0o644, 0, ""))
+    assert [(m.name, m.type, m.size, m.mode, m.mtime, m.linkname) for m in toc.members] == expected
+    # bin/tool is split in chunks
+    assert len(toc.chunks) > len([m for m in toc.members if m.isreg() and m.size])
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar, blob.open() as f, ChunkedLayer(f, toc, jobs=4) as layer:
+        for member, toc_member in zip(tar.getmembers(), toc.members):
+            if member.isreg():
+                assert layer.extractfile(toc_member).read(member.size) == tar.extractfile(member).read()
+
+
+def test_read_toc_plain(tmp_path):
+    (tmp_path / "layer").write_bytes(gzip.compress(make_archive().getvalue()))
+    with open(tmp_path / "layer", "rb") as f:
+        assert read_toc(f) is None
+
+
+@pytest.mark.parametrize("format", ["estargz", "zstd:chunked"])
+@pytest.mark.parametrize("apply", ALL_ENGINES)
+def test_apply_chunked(tmp_path, format, apply):
+    lower = layer_data(
+        {
+            "bin": None,
+            "bin/tool": b"#!/bin/sh\n" * 1000,
+            "bin/readonly": b"ro",
+            "bin/alias": (tarfile.SYMTYPE, "tool"),
+            "bin/hard": (tarfile.LNKTYPE, "bin/tool"),
+            "private": None,
+            "private/file": b"secret",
+            "target": b"lower",
+            "link": (tarfile.LNKTYPE, "target"),
+        }
+    )
+    upper = layer_data(
+        {"bin/.wh.readonly": b"", "private/file": b"upper", "new": b"x" * 5000, "target": b"upper"}
+    )
+    blobs = [
+        chunked_layer(tmp_path / "0", lower, format, chunk_size=1000),
+        chunked_layer(tmp_path / "1", upper, format, chunk_size=1000),
+    ]
+    apply(blobs, tmp_path / "chunked")
+    apply_layers([as_stream(blob) for blob in blobs], tmp_path / "stream")
+
+    assert snapshot(tmp_path / "chunked") == snapshot(tmp_path / "stream")
+    assert (tmp_path / "chunked" / "bin" / "tool").read_bytes() == b"#!/bin/sh\n" * 1000
+    assert (tmp_path / "chunked" / "private" / "file").read_bytes() == b"upper"
+    # Hardlink targets hidden by an upper layer are read back from the TOC
+    assert (tmp_path / "chunked" / "link").read_bytes() == b"lower"
+
+
+def test_hidden_chunks_are_not_decompressed(tmp_path):
+    blob = chunked_layer(tmp_path / "layer", make_archive().getvalue(), "estargz", chunk_size=512)
+    index = LayerIndex()
+    index.claim("bin", isdir=False)
+    index.commit()
+
+    with blob.open() as f, ChunkedLayer(f, read_toc(f), jobs=4, skip=index.is_hidden) as layer:
+        wanted = {layer.fileobj.chunks[i].member.name for i in layer.fileobj.wanted}
+    assert "bin/tool" not in wanted
+    assert "private/file" in wanted
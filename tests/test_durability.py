@@ -0,0 +1,93 @@
+import os
+import stat
+
+import pytest
+
+from docker_unpack import cli, durability
+from docker_unpack.apptainer_base_env import make_base_env
+from docker_unpack.state import STATE_PATH
+from docker_unpack.utils import write_if_changed
+
+from test_batch import layer_tar, make_archive, unpack_image
+
+
+@pytest.fixture
+def archive(tmp_path):
+    layers = [layer_tar({f"data/{i}": b"x" * i for i in range(20)}), layer_tar({"etc/conf": b"upper"})]
+    return make_archive(tmp_path / "image.tar", {"test:latest": layers})
+
+
+@pytest.fixture
+def syncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: calls.append("fsync") or fsync(fd))
+    syncfs = durability.syncfs
+    monkeypatch.setattr(cli, "syncfs", lambda path: calls.append("syncfs") or syncfs(path))
+    return calls
+
+
+@pytest.mark.parametrize("write_jobs", [1, 4])
+def test_durability(tmp_path, archive, syncs, write_jobs):
+    unpack_image(archive, tmp_path / "none", durability="none", write_jobs=write_jobs)
+    assert syncs == []
+
+    # One syncfs of the tree, then the state record (and its directory) are fsynced
+    unpack_image(archive, tmp_path / "end", durability="end", write_jobs=write_jobs)
+    assert syncs == ["syncfs", "fsync", "fsync"]
+    assert (tmp_path / "end" / STATE_PATH).exists()
+
+    syncs.clear()
+    unpack_image(archive, tmp_path / "strict", durability="strict", write_jobs=write_jobs)
+    files = [p for p in (tmp_path / "strict").rglob("*") if p.is_file() and not p.is_symlink()]
+    # Every file and the checkpoints of the journal (its header and each layer), then the
+    # syncfs and the state record and its directory
+    assert syncs.count("fsync") == len(files) + 1 + 3
+    assert syncs[-3:] == ["syncfs", "fsync", "fsync"]
+
+
+def test_unknown_durability(tmp_path, archive):
+    with pytest.raises(Exception, match="Unknown durability"):
+        unpack_image(archive, tmp_path / "out", durability="sometimes")
+
+
+def test_syncfs(tmp_path):
+    (tmp_path / "file").write_bytes(b"data")
+    durability.syncfs(tmp_path)
+    durability.fsync_dir(tmp_path)
+
+
+def test_write_if_changed(tmp_path):
+    path = tmp_path / "script"
+    old_umask = os.umask(0o077)
+    try:
+        assert write_if_changed(path, "echo\n", 0o755)
+    finally:
+        os.umask(old_umask)
+    assert stat.S_IMODE(path.stat().st_mode) == 0o755 and path.read_text() == "echo\n"
+    assert not write_if_changed(path, "echo\n", 0o755)
+    assert write_if_changed(path, "echo\n", 0o700)
+    assert stat.S_IMODE(path.stat().st_mode) == 0o700
+
+    # Hardlinks (e.g. to the layer cache) are broken instead of written through
+    os.link(path, tmp_path / "link")
+    assert write_if_changed(path, "true\n", 0o700)
+    assert (tmp_path / "link").read_text() == "echo\n" and path.read_text() == "true\n"
+
+
+def test_make_base_env(tmp_path):
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc/hosts").write_text("127.0.0.1 localhost\n")
+    os.symlink("elsewhere", tmp_path / "singularity")
+    make_base_env(tmp_path)
+    assert (tmp_path / "var/tmp").is_dir() and (tmp_path / ".singularity.d/libs").is_dir()
+    assert (tmp_path / "etc/hosts").read_text() == ""
+    # Existing entries are left alone
+    assert os.readlink(tmp_path / "singularity") == "elsewhere"
+    assert os.readlink(tmp_path / ".run") == str(tmp_path / ".singularity.d/actions/run")
+    make_base_env(tmp_path)
+
+    (tmp_path / "home").rmdir()
+    (tmp_path / "home").write_text("")
+    with pytest.raises(FileExistsError):
+        make_base_env(tmp_path)
@@ -0,0 +1,162 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from docker_unpack.cache import LayerCache
+from docker_unpack.filters import PathFilter
+from docker_unpack.flatten import TarWriter
+from docker_unpack.image import Blob
+from docker_unpack.layers import StagedLayers, apply_layers, write_layers
+
+from test_chunked import layer_data
+from test_utils import snapshot
+
+
+def test_path_filter():
+    exclude = PathFilter(exclude=["/usr/share/doc", "*.pyc", "var/cache/**/*.deb", "usr/share/locale/[!e]*"])
+    assert not exclude.keep("usr/share/doc", isdir=True)
+    assert not exclude.keep("usr/share/doc/pkg/README", isdir=False)
+    assert exclude.keep("usr/share/docs", isdir=True)
+    assert not exclude.keep("x.pyc", isdir=False)
+    assert not exclude.keep("usr/lib/__pycache__/x.pyc", isdir=False)
+    assert exclude.keep("usr/lib/x.py", isdir=False)
+    assert not exclude.keep("var/cache/apt/archives/a.deb", isdir=False)
+    assert exclude.keep("var/cache/apt/archives/lock", isdir=False)
+    assert not exclude.keep("usr/share/locale/fr", isdir=True)
+    assert exclude.keep("usr/share/locale/en", isdir=True)
+
+    include = PathFilter(include=["usr/lib/python3*/**", "etc/os-release"], exclude=["*.pyc"])
+    assert include.keep("usr/lib/python3.12/os.py", isdir=False)
+    assert not include.keep("usr/lib/python3.12/os.pyc", isdir=False)
+    assert include.keep("etc/os-release", isdir=False)
+    assert not include.keep("etc/passwd", isdir=False)
+    # Directories leading to included paths are kept, but not their other files
+    assert include.keep("usr/lib", isdir=True)
+    assert include.keep("usr/lib/python3.12", isdir=True)
+    assert not include.keep("usr/lib/libc.so", isdir=False)
+    assert not include.keep("usr/bin", isdir=True)
+    assert not PathFilter()
+
+
+def _blob(name: str, data: bytes) -> Blob:
+    return Blob(name, len(data), lambda: io.BytesIO(data))
+
+
+def apply_staged(blobs, root, path_filter, jobs=1):
+    root.mkdir()
+    staged = StagedLayers(root, jobs, path_filter=path_filter)
+    for blob in blobs:
+        with blob.open() as f:
+            staged.stage(blob.name, f, blob.size)
+    staged.merge([blob.name for blob in blobs])
+
+
+def apply_staged_blobs(blobs, root, path_filter):
+    root.mkdir()
+    staged = StagedLayers(root, path_filter=path_filter)
+    for blob in blobs:
+        staged.stage_blob(blob)
+    staged.merge([blob.name for blob in blobs])
+
+
+def apply_cached(blobs, root, path_filter):
+    root.mkdir()
+    cache = LayerCache(root.parent / "cache", max_bytes=1024**3)
+    staged = StagedLayers(root, cache=cache, path_filter=path_filter)
+    keys = ["sha256:" + str(i) * 64 for i in range(len(blobs))]
+    for blob, key in zip(blobs, keys):
+        staged.stage_blob(blob, key)
+    staged.merge([blob.name for blob in blobs], keys)
+
+
+def apply_flat_tar(blobs, root, path_filter):
+    buf = io.BytesIO()
+    with TarWriter(buf) as writer:
+        write_layers(blobs, writer, path_filter=path_filter)
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as tar:
+        tar.extractall(root)
+
+
+ENGINES = [
+    lambda blobs, root, path_filter: apply_layers(blobs, root, path_filter=path_filter),
+    lambda blobs, root, path_filter: apply_layers(blobs, root, jobs=4, readahead_bytes=1024, path_filter=path_filter),
+    # Layers read as a stream are filtered when merged
+    apply_staged,
+    # Buffered layers are filtered when extracted
+    lambda blobs, root, path_filter: apply_staged(blobs, root, path_filter, jobs=4),
+    apply_staged_blobs,
+    apply_cached,
+    apply_flat_tar,
+]
+
+
+@pytest.mark.parametrize(
+    "include,exclude",
+    [
+        ([], ["usr/share/doc", "usr/share/man", "*.pyc"]),
+        (["usr/**", "srv/data/**", "etc/conf"], ["usr/share/doc"]),
+    ],
+)
+@pytest.mark.parametrize("apply", ENGINES)
+def test_apply_filtered(tmp_path, apply, include, exclude):
+    lower = layer_data(
+        {
+            "usr": None,
+            "usr/bin": None,
+            "usr/bin/tool": b"tool",
+            "usr/bin/gone": b"gone",
+            "usr/share": None,
+            "usr/share/doc": None,
+            "usr/share/doc/pkg": None,
+            "usr/share/doc/pkg/README": b"readme",
+            "usr/share/man": None,
+            "usr/share/man/man1": None,
+            "usr/share/man/man1/tool.1": b"manual",
+            "usr/lib": None,
+            "usr/lib/mod.py": b"source",
+            "usr/lib/mod.pyc": b"bytecode",
+            # Explicit directories, since the mtimes of implied ones differ between unpacks
+            "etc": None,
+            "etc/conf": b"lower",
+            "etc/other": b"other",
+            "srv": None,
+            "srv/data": None,
+            "srv/data/keep.txt": b"kept",
+        }
+    )
+    upper = layer_data(
+        {
+            "usr/bin/.wh.gone": b"",
+            # Whiteouts of filtered paths are applied all the same
+            "usr/share/doc/.wh.pkg": b"",
+            "usr/share/doc/new/README": b"new",
+            # Hardlink to a filtered file
+            "usr/bin/readme": (tarfile.LNKTYPE, "usr/share/doc/new/README"),
+            "etc/conf": b"upper",
+            # A file that is filtered out still replaces the directory of the lower layer
+            "srv/data": b"not a directory",
+        }
+    )
+    blobs = [_blob("0", lower), _blob("1", upper)]
+    path_filter = PathFilter(include, exclude)
+
+    apply_layers(blobs, tmp_path / "full")
+    apply(blobs, tmp_path / "filtered", path_filter)
+
+    def without_nlink(entries: dict) -> dict:
+        return {path: entry[:3] + entry[4:] if len(entry) == 5 else entry for path, entry in entries.items()}
+
+    expected = {
+        path: entry
+        for path, entry in snapshot(tmp_path / "full").items()
+        if path_filter.keep(path, os.path.isdir(tmp_path / "full" / path) and not os.path.islink(tmp_path / "full" / path))
+        and all(path_filter.keep(parent, True) for parent in [os.path.dirname(path)] if parent)
+    }
+    assert without_nlink(snapshot(tmp_path / "filtered")) == without_nlink(expected)
+    assert (tmp_path / "filtered" / "usr/bin/readme").read_bytes() == b"new"
+    assert not (tmp_path / "filtered" / "usr/share/doc").exists()
+    if include:
+        assert not (tmp_path / "filtered" / "srv/data").exists()
@@ -0,0 +1,74 @@
+import io
+import os
+import tarfile
+
+from docker_unpack.flatten import write_flat_tar
+from docker_unpack.layers import apply_layers
+
+from test_layers import make_layer
+
+
+def test_write_flat_tar(tmp_path):
+    layers = [
+        make_layer(tmp_path / "0.tar", {"etc": None, "etc/hosts": b"127.0.0.1 image", "etc/os-release": b"x"}),
+        make_layer(tmp_path / "1.tar", {"tmp": None, "app": b"app"}),
+    ]
+    buf = io.BytesIO()
+    write_flat_tar(layers, {"Cmd": ["/app"], "Env": ["A=b"]}, buf)
+    buf.seek(0)
+
+    with tarfile.open(fileobj=buf) as tar:
+        members = {member.name: member for member in tar}
+        assert len(members) == len(tar.getmembers())
+        # The base environment replaces files of the image, but not its directories
+        assert tar.extractfile("etc/hosts").read() == b""
+        assert tar.extractfile("etc/os-release").read() == b"x"
+        assert members["etc"].uname == members["tmp"].uname == ""
+        assert b"/app" in tar.extractfile(".singularity.d/runscript").read()
+        assert b"A" in tar.extractfile(".singularity.d/env/10-docker2singularity.sh").read()
+        assert members["singularity"].linkname == "/.singularity.d/runscript"
+        assert members["proc"].isdir()
+
+
+def test_write_flat_tar_implicit_parents(tmp_path):
+    # Parents without an entry of their own are created by a directory unpack
+    layers = [
+        make_layer(tmp_path / "0.tar", {"opt/tool/bin/run": b"run", "usr": None, "usr/lib/libx.so": b"x"}),
+        make_layer(tmp_path / "1.tar", {"opt/tool/etc/conf": b"conf", "usr/lib/liby.so": b"y"}),
+    ]
+    buf = io.BytesIO()
+    write_flat_tar(layers, {}, buf)
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as tar:
+        members = {member.name: member for member in tar}
+        assert len(members) == len(tar.getmembers())
+
+    apply_layers(layers, tmp_path / "root")
+    unpacked = {
+        os.path.relpath(os.path.join(dirpath, name), tmp_path / "root")
+        for dirpath, dirnames, filenames in os.walk(tmp_path / "root")
+        for name in dirnames + filenames
+    }
+    assert {name for name in members if not name.startswith((".singularity.d", "singularity"))} >= unpacked
+    for name in ("opt", "opt/tool", "opt/tool/bin", "opt/tool/etc", "usr/lib"):
+        assert members[name].isdir() and members[name].mode == 0o755
+    # Explicit entries are written once, as they are
+    assert members["usr"].mode == 0o755 and members["usr"].uname == ""
+
+
+def test_write_flat_tar_replaced_directory(tmp_path):
+    # Files of a directory replaced by a symlink in a middle layer are gone, even
+    # though the top layer creates the directory again
+    layers = [
+        make_layer(tmp_path / "0.tar", {"b": None, "b/a": b"deleted"}),
+        make_layer(tmp_path / "1.tar", {"b": ("sym", "elsewhere")}),
+        make_layer(tmp_path / "2.tar", {"b": None, "b/c": b"c"}),
+    ]
+    buf = io.BytesIO()
+    write_flat_tar(layers, {}, buf)
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as tar:
+        names = set(tar.getnames())
+        assert tar.getmember("b").isdir()
+    assert "b/c" in names
+    assert "b/a" not in names
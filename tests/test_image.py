@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import tarfile
+import threading
+
+import pytest
+
+from docker_unpack.image import open_directory, open_indexed, read_streaming
+from docker_unpack.layers import apply_layers
+
+from test_layers import make_layer
+
+
+def add_blob(layout, data: bytes) -> dict:
+    digest = hashlib.sha256(data).hexdigest()
+    (layout / "blobs" / "sha256").mkdir(parents=True, exist_ok=True)
+    (layout / "blobs" / "sha256" / digest).write_bytes(data)
+    return {"digest": f"sha256:{digest}", "size": len(data)}
+
+
+def add_image(layout, tmp_path, arch: str) -> dict:
+    layers = []
+    for i, entries in enumerate([{"arch": arch.encode(), "both": b"lower"}, {"both": b"upper"}]):
+        blob = make_layer(tmp_path / f"{arch}-{i}.tar", entries)
+        layers.append(add_blob(layout, (tmp_path / blob.name).read_bytes()))
+    config = add_blob(layout, json.dumps({"architecture": arch, "config": {"Env": [f"ARCH={arch}"]}}).encode())
+    manifest = {"schemaVersion": 2, "config": config, "layers": layers}
+    return add_blob(layout, json.dumps(manifest).encode())
+
+
+@pytest.fixture
+def layout(tmp_path):
+    """
+    An OCI image layout with a multi-platform image (amd64 and arm64/v8).
+    """
+    layout = tmp_path / "layout"
+    amd64 = add_image(layout, tmp_path, "amd64")
+    arm64 = add_image(layout, tmp_path, "arm64")
+    index = {
+        "schemaVersion": 2,
+        "manifests": [
+            {**amd64, "platform": {"os": "linux", "architecture": "amd64"}},
+            {**arm64, "platform": {"os": "linux", "architecture": "arm64", "variant": "v8"}},
+            # Attestations pushed by buildx
+            {**amd64, "platform": {"os": "unknown", "architecture": "unknown"}},
+        ],
+    }
+    nested = add_blob(layout, json.dumps(index).encode())
+    top = {
+        "schemaVersion": 2,
+        "manifests": [{**nested, "mediaType": "application/vnd.oci.image.index.v1+json"}],
+    }
+    (layout / "index.json").write_text(json.dumps(top))
+    (layout / "oci-layout").write_text('{"imageLayoutVersion": "1.0.0"}')
+    return layout
+
+
+def archive(layout):
+    path = layout.with_suffix(".tar")
+    with tarfile.open(path, mode="w") as tar:
+        for name in sorted(os.listdir(layout)):
+            tar.add(layout / name, name)
+    return path
+
+
+@pytest.mark.parametrize("arch", ["amd64", "arm64"])
+def test_oci_layout(layout, tmp_path, arch):
+    image = open_directory(str(layout), f"linux/{arch}")
+    assert image.config["config"]["Env"] == [f"ARCH={arch}"]
+    assert all(name.startswith("blobs/sha256/") for name in image.layers)
+
+    apply_layers(image.layer_blobs(), tmp_path / "out")
+    assert (tmp_path / "out" / "arch").read_bytes() == arch.encode()
+    assert (tmp_path / "out" / "both").read_bytes() == b"upper"
+
+
+def test_oci_archive(layout):
+    path = archive(layout)
+    with open(path, "rb") as f:
+        image = open_indexed(f, "linux/arm64/v8")
+        assert image.config["architecture"] == "arm64"
+        with image.layer_blobs()[0].open() as blob, tarfile.open(fileobj=blob) as tar:
+            assert sorted(tar.getnames()) == ["arch", "both"]
+
+    received = []
+    with open(path, "rb") as f:
+        image = read_streaming(f, lambda name, blob, size: received.append(name), "linux/amd64")
+    assert image.config["architecture"] == "amd64"
+    # Layers of every platform are received, before the index is read
+    assert set(image.layers) < set(received)
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, lzma.compress])
+def test_streaming_compressed(layout, compress):
+    data = compress(archive(layout).read_bytes())
+    r, w = os.pipe()
+
+    def feed():
+        with open(w, "wb") as f:
+            f.write(data)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    received = []
+    with open(r, "rb") as f:
+        assert not f.seekable()
+        image = read_streaming(f, lambda name, blob, size: received.append(blob.read()), "linux/arm64")
+    feeder.join()
+    assert image.config["architecture"] == "arm64"
+    assert len(received) == 3
+
+
+def test_oci_platform_not_found(layout):
+    with pytest.raises(Exception, match="Available: linux/amd64, linux/arm64/v8, unknown/unknown"):
+        open_directory(str(layout), "linux/riscv64")
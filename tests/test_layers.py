@@ -0,0 +1,230 @@
+import io
+import tarfile
+
+import pytest
+
+from docker_unpack.flatten import TarWriter
+from docker_unpack.image import Blob
+from docker_unpack.layers import LayerIndex, StagedLayers, apply_layers, write_layers
+
+
+def make_layer(path, entries):
+    """
+    Writes a layer tarball. `entries` maps member names to file contents (bytes),
+    None for directories, ("link", target) for hardlinks or ("sym", target) for
+    symlinks.
+    """
+    with tarfile.open(path, "w") as tar:
+        for name, content in entries.items():
+            info = tarfile.TarInfo(name)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif isinstance(content, tuple):
+                info.type = tarfile.SYMTYPE if content[0] == "sym" else tarfile.LNKTYPE
+                info.linkname = content[1]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    return Blob(path.name, path.stat().st_size, lambda: open(path, "rb"))
+
+
+def apply_parallel(blobs, root):
+    apply_layers(blobs, root, jobs=4, readahead_bytes=1024)
+
+
+def apply_staged(blobs, root, jobs=1):
+    root.mkdir()
+    staged = StagedLayers(root, jobs)
+    for blob in blobs:
+        with blob.open() as f:
+            staged.stage(blob.name, f, blob.size)
+    staged.merge([blob.name for blob in blobs])
+
+
+def apply_staged_parallel(blobs, root):
+    apply_staged(blobs, root, jobs=4)
+
+
+def apply_threaded_writes(blobs, root):
+    apply_layers(blobs, root, write_jobs=4)
+
+
+def apply_staged_threaded_writes(blobs, root):
+    root.mkdir()
+    staged = StagedLayers(root, write_jobs=4)
+    for blob in blobs:
+        with blob.open() as f:
+            staged.stage(blob.name, f, blob.size)
+    staged.merge([blob.name for blob in blobs])
+
+
+def apply_flat_tar(blobs, root):
+    buf = io.BytesIO()
+    with TarWriter(buf) as writer:
+        write_layers(blobs, writer)
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as tar:
+        names = tar.getnames()
+        assert len(names) == len(set(names))
+        tar.extractall(root)
+
+
+ALL_ENGINES = [
+    apply_layers,
+    apply_parallel,
+    apply_staged,
+    apply_staged_parallel,
+    apply_threaded_writes,
+    apply_staged_threaded_writes,
+    apply_flat_tar,
+]
+
+
+def test_layer_index():
+    index = LayerIndex()
+    index.claim("a", isdir=True)
+    index.claim("b", isdir=False)
+    index.whiteout("c")
+    index.opaque("d")
+
+    # Markers only apply to lower layers once committed
+    assert not index.is_hidden("a")
+    index.commit()
+
+    assert index.is_hidden("a")
+    assert not index.is_hidden("a/x")
+    assert index.is_hidden("b")
+    assert index.is_hidden("b/x")
+    assert index.is_hidden("c")
+    assert index.is_hidden("c/x/y")
+    assert not index.is_hidden("d")
+    assert index.is_hidden("d/x")
+    assert not index.is_hidden("e")
+    # Hidden paths are either replaced or deleted
+    assert not index.is_deleted("b")
+    assert not index.is_deleted("b/x")
+    assert index.is_deleted("c")
+    assert index.is_deleted("c/x/y")
+    assert index.is_deleted("d/x")
+
+    # Markers below a path hidden by an upper layer are dropped
+    index.claim("a/x/y", isdir=False)
+    index.claim("c/x", isdir=True)
+    index.whiteout("a/x")
+    index.commit()
+    assert index.is_hidden("a/x")
+    assert index.is_hidden("a/x/y")
+    assert not index.is_hidden("a/z")
+    assert index._root.children["c"] == 4
+
+    # Whiteouts of lower layers still hide the layers below them
+    index.whiteout("a")
+    index.commit()
+    assert index.is_hidden("a/z")
+
+    # A hidden non-directory replacing a directory still hides the children of the
+    # lower layers, below the directory claimed by an upper layer
+    index.claim("f", isdir=True)
+    index.claim("f/x", isdir=False)
+    index.commit()
+    assert index.is_hidden("f") and not index.is_hidden("f/y")
+    index.hide_children("f")
+    assert not index.is_hidden("f/y")
+    index.commit()
+    assert index.is_hidden("f")
+    assert index.is_hidden("f/x")
+    assert index.is_hidden("f/y/z")
+    assert index.is_deleted("f/y")
+
+    index.opaque("")
+    index.commit()
+    assert index.is_hidden("e")
+    assert not index._root.children
+
+
+@pytest.mark.parametrize("apply", ALL_ENGINES)
+def test_apply_layers(tmp_path, apply):
+    layers = [
+        make_layer(
+            tmp_path / "0.tar",
+            {
+                "1": b"one",
+                "2": b"two",
+                "3": b"three",
+                "dir": None,
+                "dir/4": None,
+                "dir/5": None,
+                "dir/5/file": b"five",
+                "opq": None,
+                "opq/old": b"old",
+            },
+        ),
+        make_layer(
+            tmp_path / "1.tar",
+            {
+                ".wh.2": b"",
+                "3": b"hello",
+                "dir/.wh.5": b"",
+                "opq/.wh..wh..opq": b"",
+                "opq/new": b"new",
+            },
+        ),
+    ]
+    root = tmp_path / "root"
+    apply(layers, root)
+
+    assert (root / "1").read_bytes() == b"one"
+    assert not (root / "2").exists()
+    assert (root / "3").read_bytes() == b"hello"
+    assert (root / "dir/4").is_dir()
+    assert not (root / "dir/5").exists()
+    assert sorted(p.name for p in (root / "opq").iterdir()) == ["new"]
+    assert sorted(p.name for p in root.iterdir()) == ["1", "3", "dir", "opq"]
+
+
+@pytest.mark.parametrize("apply", ALL_ENGINES)
+def test_apply_layers_replaced_directory(tmp_path, apply):
+    # The symlink is hidden by the directory of the top layer, but still deletes the
+    # contents of the directory it replaced
+    layers = [
+        make_layer(tmp_path / "0.tar", {"b": None, "b/a": b"a", "d": None, "d/a": b"a"}),
+        make_layer(tmp_path / "1.tar", {"b": ("sym", "target"), "d": b"file"}),
+        make_layer(tmp_path / "2.tar", {"b": None, "b/c": b"c", "d": None}),
+    ]
+    root = tmp_path / "root"
+    apply(layers, root)
+
+    assert sorted(p.name for p in (root / "b").iterdir()) == ["c"]
+    assert not list((root / "d").iterdir())
+
+
+@pytest.mark.parametrize("apply", ALL_ENGINES)
+def test_apply_layers_shadowed_hardlink_target(tmp_path, apply):
+    layers = [
+        make_layer(tmp_path / "0.tar", {"target": b"lower", "link": ("link", "target")}),
+        make_layer(tmp_path / "1.tar", {"target": b"upper"}),
+    ]
+    root = tmp_path / "root"
+    apply(layers, root)
+
+    assert (root / "target").read_bytes() == b"upper"
+    assert (root / "link").read_bytes() == b"lower"
+
+
+def test_bottom_layer_not_indexed(tmp_path, monkeypatch):
+    claimed = []
+    claim = LayerIndex.claim
+    monkeypatch.setattr(LayerIndex, "claim", lambda self, path, *args: claimed.append(path) or claim(self, path, *args))
+    layers = [
+        make_layer(tmp_path / "0.tar", {"dir": None, "dir/file": b"lower", "link": ("link", "dir/file")}),
+        make_layer(tmp_path / "1.tar", {"dir/.wh.file": b"", "top": b"top"}),
+    ]
+    apply_layers(layers, tmp_path / "root")
+
+    # The paths of the bottom layer can't hide anything
+    assert claimed == ["top"]
+    assert not (tmp_path / "root/dir/file").exists()
+    assert (tmp_path / "root/link").read_bytes() == b"lower"
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import stat
+import sys
+import tarfile
+
+from pathlib import Path
+
+import pytest
+
+from docker_unpack import manifest as manifest_module
+
+from test_batch import layer_tar, make_archive, unpack_image
+
+
+@pytest.fixture
+def archive(tmp_path):
+    lower = layer_tar({"bin/tool": b"tool" * 1000, "etc/conf": b"lower", "etc/gone": b"gone"})
+    upper = layer_tar({"etc/conf": b"upper", "etc/.wh.gone": b"", "data/big": os.urandom(3 * 1024 * 1024)})
+    return make_archive(tmp_path / "image.tar", {"test:latest": [lower, upper]})
+
+
+def read_manifest(path) -> dict[str, list]:
+    return {entry[0]: entry for entry in map(json.loads, path.read_text().splitlines())}
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"write_jobs": 4},
+        {"stdin": True},
+        {"stdin": True, "jobs": 4},
+        {"cache": True},
+    ],
+)
+def test_manifest(tmp_path, archive, options, monkeypatch):
+    hashed_from_disk = []
+    hash_file = manifest_module.Manifest._hash_file
+    monkeypatch.setattr(
+        manifest_module.Manifest, "_hash_file", lambda self, path: hashed_from_disk.append(path) or hash_file(self, path)
+    )
+    options = dict(options)
+    if options.pop("cache", False):
+        options["cache_dir"] = tmp_path / "cache"
+    if options.pop("stdin", False):
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(open(archive, "rb")))
+        archive = Path("-")
+
+    out = tmp_path / "out"
+    unpack_image(archive, out, manifest_path=tmp_path / "manifest", **options)
+    entries = read_manifest(tmp_path / "manifest")
+
+    assert entries["etc/conf"][1:] == [
+        stat.S_IFREG | 0o644,
+        5,
+        "sha256:" + hashlib.sha256(b"upper").hexdigest(),
+    ]
+    assert "etc/gone" not in entries
+    assert entries["etc"][1] & stat.S_IFDIR and entries["etc"][3] is None
+    for path, (_, mode, size, digest) in entries.items():
+        st = os.lstat(out / path)
+        assert (mode, size) == (st.st_mode, st.st_size)
+        if stat.S_ISREG(mode):
+            assert digest == "sha256:" + hashlib.sha256((out / path).read_bytes()).hexdigest()
+    assert set(entries) == {str(p.relative_to(out)) for p in out.rglob("*")}
+    # Only the files that weren't extracted from the layers (the Apptainer files) are read back
+    assert hashed_from_disk
+    assert not {str(out / path) for path in ("bin/tool", "etc/conf", "data/big")} & set(hashed_from_disk)
+
+
+def test_manifest_reused_inodes(tmp_path, monkeypatch):
+    # Files replaced by the upper layer are removed when streamed layers are merged,
+    # and their inodes are reused by the files written afterwards (the Apptainer files)
+    lower = layer_tar({f"etc/file{i}": b"lower" * i for i in range(100)})
+    upper = layer_tar({f"etc/file{i}": b"upper" for i in range(100)})
+    archive = make_archive(tmp_path / "image.tar", {"test:latest": [lower, upper]})
+    # Compressed, so that it is read as a stream
+    archive = tmp_path / "image.tar.gz"
+    archive.write_bytes(gzip.compress((tmp_path / "image.tar").read_bytes()))
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(open(archive, "rb")))
+
+    out = tmp_path / "out"
+    unpack_image(Path("-"), out, manifest_path=tmp_path / "manifest")
+    entries = read_manifest(tmp_path / "manifest")
+    for path, (_, mode, size, digest) in entries.items():
+        if stat.S_ISREG(mode):
+            assert digest == "sha256:" + hashlib.sha256((out / path).read_bytes()).hexdigest(), path
+
+
+def test_manifest_modified_file(tmp_path):
+    # A file changed after its digest was recorded is hashed again
+    path = tmp_path / "root/file"
+    path.parent.mkdir()
+    manifest = manifest_module.Manifest()
+    with open(path, "wb") as f:
+        f.write(b"old")
+        manifest.record(f.fileno(), hashlib.sha256(b"old"))
+    os.utime(path, ns=(0, 0))
+    with open(path, "r+b") as f:
+        f.write(b"new")
+    manifest.write(tmp_path / "manifest", tmp_path / "root")
+    assert read_manifest(tmp_path / "manifest")["file"][3] == "sha256:" + hashlib.sha256(b"new").hexdigest()
+
+
+def test_manifest_tar_output(tmp_path, archive, capsysbinary):
+    unpack_image(archive, tmp_path / "out", manifest_path=tmp_path / "dir-manifest")
+    unpack_image(archive, "-", manifest_path=tmp_path / "tar-manifest")
+    with tarfile.open(fileobj=io.BytesIO(capsysbinary.readouterr().out)) as tar:
+        names = {member.name for member in tar}
+
+    dir_entries = read_manifest(tmp_path / "dir-manifest")
+    tar_entries = read_manifest(tmp_path / "tar-manifest")
+    assert set(tar_entries) == names
+    # The state record is only written to directories
+    dir_entries.pop(".singularity.d/docker-unpack.json")
+
+    def files(entries):
+        return {path: entry[1:] for path, entry in entries.items() if stat.S_ISREG(entry[1])}
+
+    assert files(tar_entries) == files(dir_entries)
+
+
+def test_manifest_unknown_hash():
+    with pytest.raises(Exception, match="Unknown hash"):
+        manifest_module.Manifest("md5")
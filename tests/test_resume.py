@@ -0,0 +1,195 @@
+import gzip
+import io
+import stat
+import tarfile
+
+import pytest
+
+from docker_unpack.journal import Journal
+from docker_unpack.layers import JOURNAL_NAME, STAGING_DIR
+from docker_unpack.state import STATE_PATH
+
+from test_batch import make_archive, unpack_image
+from test_utils import snapshot
+
+
+def layer(entries: dict) -> bytes:
+    """
+    A layer tarball. `entries` maps member names to file contents (bytes), None for
+    directories, or ("link", target) for hardlinks.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name, content in entries.items():
+            info = tarfile.TarInfo(name)
+            info.mtime = 1000
+            if content is None:
+                info.type, info.mode = tarfile.DIRTYPE, 0o750
+                tar.addfile(info)
+            elif isinstance(content, tuple):
+                info.type, info.linkname = tarfile.LNKTYPE, content[1]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+LAYERS = [
+    layer({"etc": None, "etc/conf": b"base", "opt": None, "opt/old": b"old", "bin/tool": b"tool"}),
+    layer(
+        {"opt": None, "opt/.wh..wh..opq": b"", "opt/new": b"new", "bin/.wh.tool": b"", "opt/link": ("link", "opt/new")}
+    ),
+    layer({"etc/conf": b"top", "var/log": None, "var/log/app": b"app"}),
+    layer({"etc/extra": b"extra", "usr/lib/a": b"a" * 5000}),
+]
+
+
+def tree(root) -> dict:
+    result = {}
+    for path, entry in snapshot(root).items():
+        if not stat.S_ISLNK(entry[0]) and len(entry) > 2 and entry[2] != 1000:
+            # Parents without a member of their own and the Apptainer files get the time of the unpack
+            entry = [*entry[:2], None, *entry[3:]]
+        # The Apptainer symlinks point into the output directory
+        result[path] = [str(v).replace(str(root), "<root>") for v in entry]
+    return result
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return make_archive(tmp_path / "image.tar", {"test:1": LAYERS})
+
+
+@pytest.fixture(
+    params=[{}, {"jobs": 4}, {"write_jobs": 4}, {"stream": True}, {"stream": True, "jobs": 4}, {"cache": True}]
+)
+def unpack(request, tmp_path):
+    def run(archive, out, **options):
+        options = {**request.param, **options}
+        if options.pop("cache", False):
+            options["cache_dir"] = tmp_path / "cache"
+        if options.pop("stream", False):
+            # Compressed archives are read as a stream
+            compressed = tmp_path / "image.tar.gz"
+            compressed.write_bytes(gzip.compress(archive.read_bytes()))
+            archive = compressed
+        unpack_image(archive, out, **options)
+
+    return run
+
+
+def interrupt_after(monkeypatch, method: str, count: int):
+    """
+    Makes the unpack fail after `count` calls to a method of the journal, once the
+    record is written.
+    """
+    calls = []
+    original = getattr(Journal, method)
+
+    def interrupted(self, *args):
+        original(self, *args)
+        calls.append(args)
+        if len(calls) == count:
+            raise Interrupted()
+
+    monkeypatch.setattr(Journal, method, interrupted)
+
+
+@pytest.mark.parametrize(
+    "method,count",
+    [
+        ("layer_applied", 1),
+        ("layer_applied", 3),
+        ("layer_staged", 2),
+        ("layer_merged", 1),
+        ("layer_merged", 4),
+        # In the middle of a layer
+        ("claim", 7),
+    ],
+)
+def test_resume(tmp_path, archive, unpack, monkeypatch, method, count):
+    unpack(archive, tmp_path / "clean")
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, method, count)
+        try:
+            unpack(archive, tmp_path / "out")
+        except Interrupted:
+            pass
+        else:
+            # This unpack path doesn't checkpoint with `method`
+            return
+    assert (tmp_path / "out" / JOURNAL_NAME).exists()
+    assert not (tmp_path / "out" / STATE_PATH).exists()
+
+    with pytest.raises(Exception, match="not empty"):
+        unpack(archive, tmp_path / "out")
+    unpack(archive, tmp_path / "out", resume=True)
+    assert not (tmp_path / "out" / JOURNAL_NAME).exists()
+    assert not (tmp_path / "out" / STAGING_DIR).exists()
+    assert tree(tmp_path / "out") == tree(tmp_path / "clean")
+
+
+def test_resume_skips_applied_layers(tmp_path, archive, monkeypatch):
+    with monkeypatch.context() as m:
+        interrupt_after(m, "layer_applied", 2)
+        with pytest.raises(Interrupted):
+            unpack_image(archive, tmp_path / "out")
+
+    # Only the two bottom layers are read again
+    read = []
+    original = Journal.layer_applied
+    monkeypatch.setattr(Journal, "layer_applied", lambda self, name: read.append(name) or original(self, name))
+    unpack_image(archive, tmp_path / "out", resume=True)
+    assert len(read) == 2
+    assert (tmp_path / "out/etc/conf").read_bytes() == b"top"
+    assert not (tmp_path / "out/opt/old").exists() and not (tmp_path / "out/bin/tool").exists()
+
+
+def test_resume_checks(tmp_path, archive, monkeypatch):
+    # Nothing to resume from: a fresh unpack
+    unpack_image(archive, tmp_path / "fresh", resume=True)
+    assert (tmp_path / "fresh" / STATE_PATH).exists()
+    with pytest.raises(Exception, match="no journal to resume from"):
+        unpack_image(archive, tmp_path / "fresh", resume=True)
+    with pytest.raises(Exception, match="can't be used together"):
+        unpack_image(archive, tmp_path / "fresh", resume=True, update=True)
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, "layer_applied", 1)
+        with pytest.raises(Interrupted):
+            unpack_image(archive, tmp_path / "out")
+
+    other = make_archive(tmp_path / "other.tar", {"test:2": LAYERS[:2]})
+    with pytest.raises(Exception, match="another image"):
+        unpack_image(other, tmp_path / "out", resume=True)
+    with pytest.raises(Exception, match="other path filters"):
+        unpack_image(archive, tmp_path / "out", resume=True, exclude=["var"])
+    with pytest.raises(Exception, match="interrupted while reading the image in place"):
+        unpack_image(archive, tmp_path / "out", resume=True, cache_dir=tmp_path / "cache")
+    unpack_image(archive, tmp_path / "out", resume=True)
+
+
+def test_journal_truncation(tmp_path):
+    journal = Journal.create(tmp_path, {"mode": "apply", "layers": None, "filters": None})
+    journal.claim("a", False)
+    journal.layer_applied("top")
+    journal.claim("b", True)
+    journal.whiteout("c")
+    journal.close()
+    # A record cut short by the interruption
+    with open(tmp_path / JOURNAL_NAME, "ab") as f:
+        f.write(b"Fpartial")
+
+    journal = Journal.open(tmp_path)
+    assert journal.applied == ["top"]
+    assert journal._applied_records == [(b"F", "a"), (b"L", "top")]
+    journal.layer_applied("next")
+    journal.close()
+    assert Journal.open(tmp_path).applied == ["top", "next"]
+    assert Journal.open(tmp_path / "missing") is None
@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from docker_unpack.utils import SPARSE_BLOCK_SIZE, copy_entry, write_sparse
+
+from test_batch import layer_tar, make_archive, unpack_image
+
+MIB = 1024 * 1024
+
+# Data regions of the sparse file, which is 4 MiB long and ends with a hole
+REGIONS = [(MIB, b"a" * 10000), (3 * MIB, b"b" * SPARSE_BLOCK_SIZE)]
+SIZE = 4 * MIB
+
+
+def expanded(regions=REGIONS, size=SIZE) -> bytes:
+    data = bytearray(size)
+    for offset, chunk in regions:
+        data[offset : offset + len(chunk)] = chunk
+    return bytes(data)
+
+
+def sparse_layer(version: str) -> bytes:
+    """
+    A layer with a sparse member in the PAX 0.1 or 1.0 format of GNU tar.
+    """
+    info = tarfile.TarInfo("data/sparse.img")
+    content = b"".join(chunk for _, chunk in REGIONS)
+    if version == "0.1":
+        info.pax_headers = {
+            "GNU.sparse.size": str(SIZE),
+            "GNU.sparse.map": ",".join(f"{offset},{len(chunk)}" for offset, chunk in REGIONS),
+        }
+    else:
+        # The map is stored in the first blocks of the data
+        sparse_map = "".join(f"{offset}\n{len(chunk)}\n" for offset, chunk in REGIONS)
+        sparse_map = f"{len(REGIONS)}\n{sparse_map}".encode()
+        content = sparse_map.ljust(-(-len(sparse_map) // 512) * 512, b"\0") + content
+        info.name = "data/GNUSparseFile.0/sparse.img"
+        info.pax_headers = {
+            "GNU.sparse.major": "1",
+            "GNU.sparse.minor": "0",
+            "GNU.sparse.name": "data/sparse.img",
+            "GNU.sparse.realsize": str(SIZE),
+        }
+    info.size = len(content)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def allocated(path) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+@pytest.fixture(autouse=True)
+def holes(tmp_path):
+    # Holes are only created on filesystems that support them
+    with open(tmp_path / "probe", "wb") as f:
+        f.truncate(MIB)
+    if allocated(tmp_path / "probe") >= MIB:
+        pytest.skip("The filesystem of the temporary directory doesn't support sparse files")
+    os.unlink(tmp_path / "probe")
+
+
+def read_manifest(path) -> dict[str, list]:
+    return {entry[0]: entry for entry in map(json.loads, path.read_text().splitlines())}
+
+
+@pytest.mark.parametrize("version", ["0.1", "1.0"])
+@pytest.mark.parametrize("options", [{}, {"write_jobs": 4}, {"cache": True}, {"stream": True}, {"sparse": True}])
+def test_sparse_members(tmp_path, version, options):
+    options = dict(options)
+    archive = make_archive(tmp_path / "image.tar", {"test:1": [sparse_layer(version)]})
+    if options.pop("cache", False):
+        options["cache_dir"] = tmp_path / "cache"
+        options["cache_link"] = "copy"
+    if options.pop("stream", False):
+        # Compressed archives are read as a stream
+        archive = tmp_path / "image.tar.gz"
+        archive.write_bytes(gzip.compress((tmp_path / "image.tar").read_bytes()))
+    unpack_image(archive, tmp_path / "out", manifest_path=tmp_path / "manifest.jsonl", **options)
+
+    path = tmp_path / "out/data/sparse.img"
+    assert path.read_bytes() == expanded()
+    assert allocated(path) < 2 * MIB
+    # The holes are hashed as zeros
+    digest = read_manifest(tmp_path / "manifest.jsonl")["data/sparse.img"][3]
+    assert digest == "sha256:" + hashlib.sha256(expanded()).hexdigest()
+
+
+@pytest.mark.parametrize("options", [{}, {"write_jobs": 4}, {"cache": True}])
+def test_zero_blocks(tmp_path, options):
+    options = dict(options)
+    zeros = expanded([(100, b"head"), (2 * MIB + 1, b"middle")], 8 * MIB)
+    archive = make_archive(tmp_path / "image.tar", {"test:1": [layer_tar({"disk.img": zeros, "small": b"\0" * 10})]})
+    cache = options.pop("cache", False)
+    if cache:
+        options["cache_link"] = "copy"
+
+    # The layer is cached as extracted, so each unpack gets its own cache
+    unpack_image(archive, tmp_path / "dense", cache_dir=tmp_path / "dense-cache" if cache else None, **options)
+    assert allocated(tmp_path / "dense/disk.img") >= 8 * MIB
+
+    unpack_image(archive, tmp_path / "sparse", cache_dir=tmp_path / "cache" if cache else None, sparse=True, **options)
+    path = tmp_path / "sparse/disk.img"
+    assert path.read_bytes() == zeros and path.stat().st_size == 8 * MIB
+    # Only the two blocks holding data are allocated
+    assert allocated(path) <= 4 * SPARSE_BLOCK_SIZE
+    assert (tmp_path / "sparse/small").read_bytes() == b"\0" * 10
+
+
+def test_write_sparse(tmp_path):
+    data = b"x" * 10 + bytes(3 * SPARSE_BLOCK_SIZE) + b"y" * SPARSE_BLOCK_SIZE + bytes(SPARSE_BLOCK_SIZE + 10)
+    fd = os.open(tmp_path / "file", os.O_WRONLY | os.O_CREAT)
+    try:
+        write_sparse(fd, data)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+    assert (tmp_path / "file").read_bytes() == data
+
+    # Holes are kept by copies
+    copy_entry(str(tmp_path / "file"), str(tmp_path / "copy"))
+    assert (tmp_path / "copy").read_bytes() == data
+    assert allocated(tmp_path / "copy") == allocated(tmp_path / "file") < len(data)
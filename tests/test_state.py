@@ -0,0 +1,35 @@
+from docker_unpack.layers import StagedLayers
+from docker_unpack.state import common_prefix, read_state, write_state
+
+from test_layers import apply_staged, make_layer
+
+
+def test_state_roundtrip(tmp_path):
+    assert read_state(tmp_path) is None
+    chain = [{"name": "a.tar", "id": "sha256:aa"}, {"name": "b.tar", "id": "sha256:bb"}]
+    write_state(tmp_path, chain)
+    assert read_state(tmp_path)["layers"] == chain
+
+
+def test_common_prefix():
+    a = [{"name": "a", "id": "1"}, {"name": "b", "id": "2"}]
+    b = [{"name": "a", "id": "1"}, {"name": "c", "id": "3"}, {"name": "d", "id": "4"}]
+    assert common_prefix(a, a) == 2
+    assert common_prefix(a, b) == 1
+    assert common_prefix(b[1:], a) == 0
+    assert common_prefix([], a) == 0
+
+
+def test_update_applies_new_layers(tmp_path):
+    lower = make_layer(tmp_path / "0.tar", {"dir": None, "dir/a": b"a", "dir/b": b"b", "c": b"c"})
+    upper = make_layer(tmp_path / "1.tar", {"dir/.wh.a": b"", "c": b"new"})
+    root = tmp_path / "root"
+    apply_staged([lower], root)
+
+    staged = StagedLayers(root)
+    staged.stage_blob(upper)
+    staged.merge([upper.name])
+
+    assert sorted(p.name for p in root.iterdir()) == ["c", "dir"]
+    assert sorted(p.name for p in (root / "dir").iterdir()) == ["b"]
+    assert (root / "c").read_bytes() == b"new"
@@ -0,0 +1,23 @@
+from docker_unpack.layers import apply_layers
+from docker_unpack.stats import STATS
+
+from test_layers import make_layer
+
+
+def test_layer_stats(tmp_path):
+    layers = [
+        make_layer(tmp_path / "0.tar", {"dir": None, "dir/a": b"a", "dir/b": b"b", "c": b"c", "link": ("link", "c")}),
+        make_layer(tmp_path / "1.tar", {"dir/.wh.a": b"", "dir/b": b"new", "opq/.wh..wh..opq": b""}),
+    ]
+    STATS.reset()
+    apply_layers(layers, tmp_path / "root")
+    report = STATS.report()
+
+    lower, upper = (report["layers"][layer.name] for layer in layers)
+    assert upper["whiteouts"] == 1 and upper["opaque_dirs"] == 1 and upper["files"] == 1
+    # dir/a and dir/b are hidden by the upper layer
+    assert lower["skipped"] == 2
+    assert lower["dirs"] == 1 and lower["hardlinks"] == 1
+    assert lower["compressed_bytes"] == layers[0].size
+    assert report["totals"]["files"] == 2
+    assert report["peak_rss_bytes"] > 0
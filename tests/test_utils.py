@@ -0,0 +1,87 @@
+import io
+import os
+import stat
+import tarfile
+
+from docker_unpack.utils import MemberWriter, MyTarFile, directory_attrs, set_attrs
+
+
+def make_archive():
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+
+        def add(name, type=tarfile.REGTYPE, data=b"", mode=0o644, linkname=""):
+            info = tarfile.TarInfo(name)
+            info.type, info.mode, info.linkname, info.mtime = type, mode, linkname, 1700000000
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+        add("bin", tarfile.DIRTYPE, mode=0o755)
+        add("bin/tool", data=b"#!/bin/sh\n" * 1000, mode=0o755)
+        add("bin/readonly", data=b"ro", mode=0o444)
+        add("bin/alias", tarfile.SYMTYPE, linkname="tool")
+        add("bin/hard", tarfile.LNKTYPE, linkname="bin/tool", mode=0o755)
+        add("no/parent/entry", data=b"x")
+        add("private", tarfile.DIRTYPE, mode=0o700)
+        add("private/file", data=b"secret", mode=0o600)
+        add("replaced", data=b"first")
+        add("replaced", tarfile.SYMTYPE, linkname="bin/tool")
+    buf.seek(0)
+    return buf
+
+
+# Parents without a member of their own, created at the time of extraction
+IMPLICIT_DIRS = {"no", "parent"}
+
+
+def snapshot(root):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            entry = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode)]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif not (stat.S_ISDIR(st.st_mode) and name in IMPLICIT_DIRS):
+                entry.append(int(st.st_mtime))
+            if stat.S_ISREG(st.st_mode):
+                entry += [st.st_nlink, open(path, "rb").read()]
+            result[os.path.relpath(path, root)] = entry
+    return result
+
+
+def test_member_writer_matches_tarfile(tmp_path):
+    with tarfile.open(fileobj=make_archive(), mode="r|") as tar:
+        tar.extractall(tmp_path / "tarfile")
+
+    directories = {}
+    with tarfile.open(fileobj=make_archive(), mode="r|") as tar, MemberWriter(tmp_path / "writer") as writer:
+        for member in tar:
+            writer.write(tar, member, member.name)
+            if member.isdir():
+                directories[member.name] = member
+    for path, member in sorted(directories.items(), reverse=True):
+        set_attrs(member, str(tmp_path / "writer" / path))
+
+    assert snapshot(tmp_path / "writer") == snapshot(tmp_path / "tarfile")
+
+
+def test_streamed_members_are_not_kept(tmp_path):
+    with tarfile.open(fileobj=make_archive(), mode="r|") as tar:
+        tar.extractall(tmp_path / "tarfile")
+
+    directories = {}
+    with MyTarFile.open(fileobj=make_archive(), mode="r|") as tar, MemberWriter(tmp_path / "writer") as writer:
+        for member in tar:
+            assert tar.members == []
+            writer.write(tar, member, member.name)
+            if member.isdir():
+                m = member
+                directories[m.name] = directory_attrs(m.name, m.mode, m.uid, m.gid, m.uname, m.gname, m.mtime)
+        assert tar.members == []
+    for path, member in sorted(directories.items(), reverse=True):
+        set_attrs(member, str(tmp_path / "writer" / path))
+
+    # Hardlinks are resolved on disk
+    assert snapshot(tmp_path / "writer") == snapshot(tmp_path / "tarfile")
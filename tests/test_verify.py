@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import subprocess
+import sys
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from docker_unpack.decompress import BACKENDS
+from docker_unpack.verify import LayerDigests, VerifiedReader, check_digests
+
+from test_batch import layer_tar, unpack_image
+
+
+def sha256(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def write_archive(path, blobs: list[bytes], diff_ids: list[str], names: list[str] | None = None):
+    """
+    Writes a `docker save` archive of a single image with the given layer blobs, diff_ids and blob names.
+    """
+    names = names or [f"blobs/sha256/{hashlib.sha256(blob).hexdigest()}" for blob in blobs]
+    config = json.dumps({"config": {}, "rootfs": {"type": "layers", "diff_ids": diff_ids}}).encode()
+    members = dict(zip(names, blobs))
+    members["config.json"] = config
+    members["manifest.json"] = json.dumps([{"Config": "config.json", "RepoTags": ["test:1"], "Layers": names}]).encode()
+    with tarfile.open(path, "w") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+LOWER = layer_tar({"etc/conf": b"lower", "bin/tool": b"tool" * 1000})
+UPPER = layer_tar({"etc/conf": b"upper"})
+
+
+@pytest.fixture(params=[{}, {"jobs": 4}, {"stdin": True}, {"stdin": True, "jobs": 4}, {"cache": True}, {"tar": True}])
+def unpack(request, tmp_path, monkeypatch, capsysbinary):
+    def run(archive, **options):
+        options = {**request.param, **options}
+        if options.pop("cache", False):
+            options["cache_dir"] = tmp_path / "cache"
+        if options.pop("stdin", False):
+            monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(open(archive, "rb")))
+            archive = Path("-")
+        out = tmp_path / options.pop("out", "out")
+        if options.pop("tar", False):
+            out = "-"
+        unpack_image(archive, out, **options)
+        return out
+
+    return run
+
+
+def test_verify(tmp_path, unpack):
+    upper = gzip.compress(UPPER)
+    archive = write_archive(tmp_path / "image.tar", [LOWER, upper], [sha256(LOWER), sha256(UPPER)])
+    out = unpack(archive)
+    if out != "-":
+        assert (out / "etc/conf").read_bytes() == b"upper"
+
+
+def test_verify_xz(tmp_path, unpack):
+    # The xz command is preferred to the lzma module
+    upper = lzma.compress(UPPER)
+    archive = write_archive(tmp_path / "image.tar", [LOWER, upper], [sha256(LOWER), sha256(UPPER)])
+    out = unpack(archive)
+    if out != "-":
+        assert (out / "etc/conf").read_bytes() == b"upper"
+
+
+def test_verify_diff_id(tmp_path, unpack):
+    archive = write_archive(tmp_path / "image.tar", [LOWER, UPPER], [sha256(LOWER), sha256(b"something else")])
+    with pytest.raises(Exception, match=r"Layer .* is corrupted: its diff_id is"):
+        unpack(archive)
+    if (tmp_path / "cache").exists():
+        # Corrupted layers are not cached
+        assert not [p for p in (tmp_path / "cache/layers").rglob("conf") if p.read_bytes() == b"upper"]
+    unpack(archive, out="out2", verify=False)
+
+
+def test_verify_digest(tmp_path, unpack):
+    upper = gzip.compress(UPPER)
+    names = [f"blobs/sha256/{hashlib.sha256(LOWER).hexdigest()}", f"blobs/sha256/{hashlib.sha256(b'other').hexdigest()}"]
+    archive = write_archive(tmp_path / "image.tar", [LOWER, upper], [sha256(LOWER), sha256(UPPER)], names)
+    with pytest.raises(Exception, match=r"Layer blobs/sha256/\w+ is corrupted: its digest is"):
+        unpack(archive)
+
+
+def test_verified_reader():
+    # Trailing bytes after the gzip stream (e.g. padding) are part of the blob digest
+    blob = gzip.compress(UPPER) + b"\0" * 100
+    reader = VerifiedReader(io.BytesIO(blob), [], "layer", LayerDigests(sha256(blob), sha256(UPPER)))
+    assert reader.read() == UPPER
+    assert reader.digests == LayerDigests(sha256(blob), sha256(UPPER))
+
+    reader = VerifiedReader(io.BytesIO(blob), [], "layer", LayerDigests(sha256(UPPER), None))
+    with pytest.raises(Exception, match="its digest is"):
+        reader.read()
+
+
+@pytest.mark.parametrize("backend", ["xz", "zstd"])
+def test_verified_reader_command(backend):
+    # The blob is read by the command's feeder thread, and drained once it has exited
+    if not BACKENDS[backend].available():
+        pytest.skip(f"{backend} is not installed")
+    if backend == "xz":
+        blob = lzma.compress(UPPER)
+    else:
+        blob = subprocess.run(["zstd", "-c"], input=UPPER, stdout=subprocess.PIPE, check=True).stdout
+    reader = VerifiedReader(io.BytesIO(blob), [backend], "layer", LayerDigests(sha256(blob), sha256(UPPER)))
+    assert reader.read() == UPPER
+    assert reader.digests == LayerDigests(sha256(blob), sha256(UPPER))
+    reader.close()
+
+
+def test_check_digests():
+    actual = LayerDigests(sha256(b"blob"), sha256(b"tar"))
+    check_digests("layer", actual, None)
+    check_digests("layer", actual, LayerDigests(None, sha256(b"tar")))
+    # Digests of another algorithm can't be checked
+    check_digests("layer", actual, LayerDigests("sha512:00", "sha512:00"))
+    with pytest.raises(Exception, match="its diff_id is"):
+        check_digests("layer", actual, LayerDigests(sha256(b"blob"), sha256(b"other")))
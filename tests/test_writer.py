@@ -0,0 +1,25 @@
+import tarfile
+
+from docker_unpack.utils import set_attrs
+from docker_unpack.writer import ThreadedMemberWriter
+
+from test_utils import make_archive, snapshot
+
+
+def test_threaded_writer_matches_tarfile(tmp_path):
+    with tarfile.open(fileobj=make_archive(), mode="r|") as tar:
+        tar.extractall(tmp_path / "tarfile")
+
+    directories = {}
+    with (
+        tarfile.open(fileobj=make_archive(), mode="r|") as tar,
+        ThreadedMemberWriter(tmp_path / "writer", jobs=4, max_bytes=4096) as writer,
+    ):
+        for member in tar:
+            writer.write(tar, member, member.name)
+            if member.isdir():
+                directories[member.name] = member
+    for path, member in sorted(directories.items(), reverse=True):
+        set_attrs(member, str(tmp_path / "writer" / path))
+
+    assert snapshot(tmp_path / "writer") == snapshot(tmp_path / "tarfile")